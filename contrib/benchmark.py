@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+# benchmark.py - microbenchmarks for the projrc extension
+#
+# Copyright 2017       Jeremy Lake <32113028+mercurial-extensions@users.noreply.github.com>
+#
+# This software may be used and distributed according to the terms of
+# the GNU General Public License version 2 or any later version.
+
+"""time the projrc parsing, filtering and merging code
+
+The projrc files, user configuration and repositories that are used are
+generated in a temporary directory, so this runs offline. Usage:
+
+  python contrib/benchmark.py [-o results.json] [-c old.json] [-k NAME]...
+
+The results are written as JSON with -o. With -c, they are compared with
+the results of an earlier run, and the exit status is 1 if any benchmark
+got slower by more than --threshold percent.
+"""
+
+import os, sys, time, json, shutil, tempfile, optparse, platform, imp
+import py_compile
+
+from mercurial import config, extensions, hg, ui as uimod
+try:
+    from mercurial import __version__
+    hgversion = __version__.version
+except ImportError:
+    hgversion = 'unknown'
+
+projrcpath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'projrc.py')
+projrc = imp.load_source('projrc', projrcpath)
+
+def makeui():
+    if hasattr(uimod.ui, 'load'):
+        # hg >= 4.2
+        return uimod.ui.load()
+    return uimod.ui()
+
+def ageuncached(*paths):
+    """make the files old enough for the stat based caches to trust them"""
+    old = time.time() - 10
+    for path in paths:
+        os.utime(path, (old, old))
+
+# Synthetic configuration generators
+
+def genconfig(sections=50, keys=50, multiline=0, prefix='section'):
+    """return the text of a config file with sections * keys settings
+
+    Every multiline-th key (if multiline is not 0) gets a 20 line value.
+    """
+    lines = []
+    for s in xrange(sections):
+        lines.append('[%s%d]' % (prefix, s))
+        for k in xrange(keys):
+            if multiline and k % multiline == 0:
+                lines.append('key%d = first line of a long value' % k)
+                for l in xrange(20):
+                    lines.append('  continuation line %d of key %d' % (l, k))
+            else:
+                lines.append('key%d = value %d.%d' % (k, s, k))
+        lines.append('')
+    return '\n'.join(lines)
+
+def genincludechain(directory, depth=20, sections=5, keys=20):
+    """write a chain of depth files that %include each other
+
+    Return the path of the first file of the chain.
+    """
+    paths = [os.path.join(directory, 'include%d.rc' % n)
+             for n in xrange(depth)]
+    for n, path in enumerate(paths):
+        fp = open(path, 'w')
+        fp.write(genconfig(sections, keys, prefix='chain%d-' % n))
+        if n + 1 < depth:
+            fp.write('\n%%include %s\n' % os.path.basename(paths[n + 1]))
+        fp.close()
+    ageuncached(*paths)
+    return paths[0]
+
+def genpatterns(count=200, sections=50):
+    """return include and exclude key pattern lists with count patterns
+
+    The lists mix exact keys, key globs and section globs.
+    """
+    include, exclude = [], []
+    for n in xrange(count):
+        s = n % sections
+        if n % 3 == 0:
+            include.append('section%d.key%d' % (s, n % 50))
+            exclude.append('section%d.key%d?' % (s, n % 5))
+        elif n % 3 == 1:
+            include.append('section%d.key1*' % s)
+            exclude.append('section%d.*%d' % (s, n % 10))
+        else:
+            include.append('section%d.*' % s)
+            exclude.append('other%d.*' % n)
+    return include, exclude
+
+def parse(data):
+    c = config.config()
+    c.parse('projrc', data)
+    return c
+
+# Benchmarks, each setup function returns the function to time
+
+benchmarks = []
+
+def benchmark(name):
+    def decorator(setup):
+        benchmarks.append((name, setup))
+        return setup
+    return decorator
+
+@benchmark('serializeconfig')
+def benchserialize(tmpdir):
+    conf = parse(genconfig(100, 50))
+    return lambda: projrc.serializeconfig(conf)
+
+@benchmark('serializeconfig-multiline')
+def benchserializemultiline(tmpdir):
+    conf = parse(genconfig(20, 50, multiline=2))
+    return lambda: projrc.serializeconfig(conf)
+
+@benchmark('serializeconfig-globs')
+def benchserializeglobs(tmpdir):
+    conf = parse(genconfig(100, 50))
+    include, exclude = genpatterns(200)
+    def run():
+        # A new filter every time, as for a changed projrc.include list
+        projrc._keyfilters.clear()
+        projrc.serializeconfig(conf, include, exclude)
+    return run
+
+@benchmark('isprojrcserver')
+def benchisprojrcserver(tmpdir):
+    ui = makeui()
+    servers = []
+    for n in xrange(500):
+        servers.append('https://hg%d.example.com/*' % n)
+        servers.append('ssh://hg@build%d.example.net/repo%d' % (n, n))
+    ui.setconfig('projrc', 'servers', ', '.join(servers))
+    remotes = [fakepeer({}, 'https://hg%d.example.com/repo' % n)
+               for n in xrange(0, 500, 50)]
+    remotes.append(fakepeer({}, 'https://untrusted.example.org/repo'))
+    def run():
+        for remote in remotes:
+            projrc.isprojrcserver(ui, remote)
+    return run
+
+@benchmark('import')
+def benchimport(tmpdir):
+    compiled = os.path.join(tmpdir, 'projrcimport.pyc')
+    py_compile.compile(projrcpath, compiled)
+    return lambda: imp.load_compiled('projrcimport', compiled)
+
+def benchuisetup(tmpdir, name, data=None, depth=0):
+    """time uisetup for a command run in a new repository
+
+    The command is run depth directories below the root of the
+    repository, which findrepo must walk up to find it.
+    """
+    root = os.path.join(tmpdir, name)
+    os.makedirs(os.path.join(root, '.hg'))
+    if data is not None:
+        makeprojrcrepo(tmpdir, name, data)
+    wd = os.path.join(root, *['dir%d' % n for n in xrange(depth)])
+    if depth:
+        os.makedirs(wd)
+    ui = makeui()
+    def run():
+        cwd, argv = os.getcwd(), sys.argv
+        os.chdir(wd)
+        sys.argv = ['hg', 'status']
+        try:
+            projrc.uisetup(ui.copy())
+        finally:
+            os.chdir(cwd)
+            sys.argv = argv
+    return run
+
+@benchmark('uisetup-noprojrc')
+def benchuisetupnoprojrc(tmpdir):
+    return benchuisetup(tmpdir, 'uisetupnoprojrc')
+
+@benchmark('uisetup-noprojrc-deep')
+def benchuisetupnoprojrcdeep(tmpdir):
+    # The difference with uisetup-noprojrc is the findrepo walk
+    return benchuisetup(tmpdir, 'uisetupnoprojrcdeep', depth=20)
+
+@benchmark('uisetup')
+def benchuisetupprojrc(tmpdir):
+    return benchuisetup(tmpdir, 'uisetupprojrc', genconfig(5, 10))
+
+def makeprojrcrepo(tmpdir, name, data):
+    root = os.path.join(tmpdir, name)
+    if not os.path.isdir(os.path.join(root, '.hg')):
+        os.makedirs(os.path.join(root, '.hg'))
+    path = os.path.join(root, '.hg', 'projrc')
+    fp = open(path, 'w')
+    fp.write(data)
+    fp.close()
+    ageuncached(path)
+    return root, path
+
+def makeuserui(tmpdir):
+    """return a ui with a large user configuration"""
+    userrc = os.path.join(tmpdir, 'userrc')
+    fp = open(userrc, 'w')
+    fp.write(genconfig(50, 50))
+    fp.close()
+    ui = makeui()
+    ui.readconfig(userrc)
+    # The settings must come from a user config file to take precedence
+    projrc._cfgpathclasses[userrc] = projrc.USERRC
+    return ui
+
+def benchload(tmpdir, name, data, usecache):
+    root, path = makeprojrcrepo(tmpdir, name, data)
+    ui = makeuserui(tmpdir)
+    def run():
+        if not usecache:
+            projrc.parseprojrc(path, updatecache=True)
+            ageuncached(projrc.parsedcachepath(path))
+        projrc.loadprojrc(ui.copy(), path, root)
+    return run
+
+@benchmark('loadprojrc')
+def benchloadprojrc(tmpdir):
+    return benchload(tmpdir, 'load', genconfig(50, 50, prefix='section'),
+                     True)
+
+@benchmark('loadprojrc-uncached')
+def benchloadprojrcuncached(tmpdir):
+    return benchload(tmpdir, 'loaduncached', genconfig(50, 50), False)
+
+@benchmark('loadprojrc-includes')
+def benchloadprojrcincludes(tmpdir):
+    chain = genincludechain(tmpdir)
+    return benchload(tmpdir, 'loadincludes', '%%include %s\n' % chain, False)
+
+def makerepo(tmpdir, name, data):
+    ui = makeui()
+    root = os.path.join(tmpdir, name)
+    repo = hg.repository(ui, root, create=True)
+    path = projrc.repo_join(repo, 'projrc')
+    fp = open(path, 'w')
+    fp.write(data)
+    fp.close()
+    ageuncached(path)
+    return repo
+
+@benchmark('listprojrc')
+def benchlistprojrc(tmpdir):
+    repo = makerepo(tmpdir, 'list', genconfig(100, 50))
+    return lambda: projrc.listprojrc(repo)
+
+@benchmark('listprojrc-uncached')
+def benchlistprojrcuncached(tmpdir):
+    repo = makerepo(tmpdir, 'listuncached', genconfig(100, 50))
+    def run():
+        projrc._payloadcache.discard(projrc.repo_join(repo, 'projrc'))
+        projrc.listprojrc(repo)
+    return run
+
+class fakepeer(object):
+    """a remote repository that only knows about its projrc"""
+    def __init__(self, keys, url='http://server/repo'):
+        self.keys = keys
+        self._url = url
+    def local(self):
+        return None
+    def url(self):
+        return self._url
+    def listkeys(self, namespace):
+        return self.keys
+
+@benchmark('getremoteprojrc')
+def benchgetremoteprojrc(tmpdir):
+    server = makerepo(tmpdir, 'server', genconfig(100, 50, multiline=10))
+    keys = projrc.listprojrc(server)
+    repo = makerepo(tmpdir, 'client', '')
+    include, exclude = genpatterns(100)
+    ui = repo.ui
+    ui.setconfig('projrc', 'servers', '*')
+    ui.setconfig('projrc', 'include', ', '.join(include))
+    ui.setconfig('projrc', 'exclude', ', '.join(exclude))
+    return lambda: projrc.getremoteprojrc(ui, repo, fakepeer(keys))
+
+def makeextensionsui(tmpdir, name, count=200):
+    """return a (ui, name, unload) tuple: ui has count loaded extensions,
+    and one more, name, that is not loaded yet; unload makes it new again
+
+    The user configured extensions are disabled, so that only the
+    generated ones are loaded.
+    """
+    directory = os.path.join(tmpdir, name)
+    os.makedirs(directory)
+    ui = makeui()
+    for ext, path in ui.configitems('extensions'):
+        ui.setconfig('extensions', ext, '!')
+    for n in xrange(count + 1):
+        path = os.path.join(directory, 'benchext%d.py' % n)
+        fp = open(path, 'w')
+        fp.write('cmdtable = {}\ndef uisetup(ui):\n    pass\n')
+        fp.close()
+        if n < count:
+            ui.setconfig('extensions', 'benchext%d' % n, path)
+    extensions.loadall(ui)
+    added = 'benchext%d' % count
+    addedui = ui.copy()
+    addedui.setconfig('extensions', added, os.path.join(directory,
+                                                       added + '.py'))
+    def unload():
+        # Make the added extension new again for the next run
+        extensions._extensions.pop(added, None)
+        if added in extensions._order:
+            extensions._order.remove(added)
+    return addedui, added, unload
+
+@benchmark('loadextensions-added')
+def benchloadextensionsadded(tmpdir):
+    # What a projrc update that enables one more extension does
+    ui, added, unload = makeextensionsui(tmpdir, 'extadded')
+    layer = config.config()
+    layer.set('extensions', added, ui.config('extensions', added))
+    def run():
+        projrc.loadextensions(ui, projrc.projrcextensions(ui, layer))
+        unload()
+    return run
+
+@benchmark('loadextensions-loadall')
+def benchloadextensionsloadall(tmpdir):
+    # The same update, going through every configured extension again
+    ui, added, unload = makeextensionsui(tmpdir, 'extloadall')
+    def run():
+        extensions.loadall(ui)
+        unload()
+    return run
+
+# Running and reporting
+
+def timeit(func, mintime, minruns):
+    """run func until it ran minruns times and for mintime seconds
+
+    Return the sorted durations of the runs.
+    """
+    func()
+    runs = []
+    start = time.time()
+    while len(runs) < minruns or time.time() - start < mintime:
+        t = time.time()
+        func()
+        runs.append(time.time() - t)
+    runs.sort()
+    return runs
+
+def compare(results, previous, threshold):
+    """print the change of each benchmark, return the names of regressions
+
+    The best runs are compared, they are the least affected by the noise
+    of the machine.
+    """
+    regressions = []
+    for name in sorted(results):
+        new = results[name]['best']
+        old = previous.get('results', {}).get(name, {}).get('best')
+        if not old:
+            print '%-28s %10.3f ms  (new)' % (name, new * 1000)
+            continue
+        change = (new - old) / old * 100
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print '%-28s %10.3f ms  %+6.1f%%%s' % (name, new * 1000, change, flag)
+    return regressions
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output', help='write the results to FILE')
+    parser.add_option('-c', '--compare',
+                      help='compare with the results in FILE')
+    parser.add_option('-k', '--keyword', action='append', default=[],
+                      help='only run the benchmarks containing NAME')
+    parser.add_option('-t', '--time', type='float', default=1.0,
+                      help='minimum time to run each benchmark (seconds)')
+    parser.add_option('-n', '--runs', type='int', default=5,
+                      help='minimum number of runs of each benchmark')
+    parser.add_option('--threshold', type='float', default=10.0,
+                      help='slowdown (percent) reported as a regression')
+    opts, args = parser.parse_args(argv)
+
+    results = {}
+    tmpdir = tempfile.mkdtemp(prefix='projrc-bench-')
+    try:
+        for name, setup in benchmarks:
+            if opts.keyword and not [k for k in opts.keyword if k in name]:
+                continue
+            runs = timeit(setup(tmpdir), opts.time, opts.runs)
+            results[name] = {
+                'runs': len(runs),
+                'best': runs[0],
+                'median': runs[len(runs) // 2],
+            }
+            if not opts.compare:
+                print '%-28s %10.3f ms  (best %.3f ms, %d runs)' % (
+                    name, results[name]['median'] * 1000,
+                    runs[0] * 1000, len(runs))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if opts.output:
+        fp = open(opts.output, 'w')
+        json.dump({'hg': hgversion, 'python': platform.python_version(),
+                   'time': time.time(), 'results': results},
+                  fp, indent=2, sort_keys=True)
+        fp.close()
+
+    if opts.compare:
+        fp = open(opts.compare)
+        previous = json.load(fp)
+        fp.close()
+        if compare(results, previous, opts.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# loadtest.py - load test of hg serve with the projrc extension
+#
+# Copyright 2017       Jeremy Lake <32113028+mercurial-extensions@users.noreply.github.com>
+#
+# This software may be used and distributed according to the terms of
+# the GNU General Public License version 2 or any later version.
+
+"""measure what the projrc extension costs a loaded hg serve
+
+A repository with a generated projrc file is served by a local "hg serve"
+and cloned, pulled and checked for incoming changes by concurrent
+clients, so this runs offline. Each client is a separate "hg" process,
+so the client side of the extension is measured as well. Usage:
+
+  python contrib/loadtest.py [-j CLIENTS] [-n REQUESTS] [-o results.json]
+
+The latency percentiles and throughput of the clients and the CPU time
+and peak memory of the server are reported once with the extension
+enabled on both sides and once without it (see --mode). The user
+configuration is not read; set --hg to test another Mercurial. This
+needs a POSIX system, the server resources are read from wait4().
+"""
+
+import os, sys, time, json, math, shutil, socket, tempfile, optparse
+import platform
+import subprocess, threading, signal, errno
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchmark import genconfig
+
+extpath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       os.pardir, 'projrc.py')
+
+def writehgrc(path, enabled):
+    """write the configuration used by the server and its clients"""
+    fp = open(path, 'w')
+    fp.write('[ui]\nusername = loadtest\n')
+    if enabled:
+        fp.write('[extensions]\nprojrc = %s\n' % os.path.abspath(extpath))
+        fp.write('[projrc]\nservers = *\ninclude = *\nconfirm = never\n')
+    fp.close()
+
+def freeport():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('localhost', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def runhg(opts, env, args, cwd=None, ok=(0,)):
+    """run hg, return how long it took"""
+    devnull = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        proc = subprocess.Popen([opts.hg] + args, cwd=cwd, env=env,
+                                stdout=devnull, stderr=subprocess.PIPE)
+        err = proc.communicate()[1]
+        elapsed = time.time() - start
+    finally:
+        devnull.close()
+    if proc.returncode not in ok:
+        raise RuntimeError('hg %s failed (%d): %s'
+                           % (args[0], proc.returncode, err.strip()))
+    return elapsed
+
+def makeserverrepo(opts, env, root):
+    runhg(opts, env, ['init', root])
+    for n in xrange(opts.changesets):
+        fp = open(os.path.join(root, 'file%d' % (n % 10)), 'a')
+        fp.write('line %d\n' % n)
+        fp.close()
+        runhg(opts, env, ['commit', '-q', '-A', '-m', 'changeset %d' % n],
+              cwd=root)
+    fp = open(os.path.join(root, '.hg', 'projrc'), 'w')
+    fp.write(genconfig(opts.sections, opts.keys))
+    fp.close()
+
+class server(object):
+    """a foreground hg serve process"""
+    def __init__(self, opts, env, root, log):
+        self.port = freeport()
+        self.url = 'http://localhost:%d/' % self.port
+        self.log = open(log, 'w')
+        self.proc = subprocess.Popen(
+            [opts.hg, 'serve', '-R', root, '-a', 'localhost',
+             '-p', str(self.port)],
+            env=env, stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.time() + 30
+        while True:
+            try:
+                socket.create_connection(('localhost', self.port), 1).close()
+                break
+            except socket.error:
+                if self.proc.poll() is not None or time.time() > deadline:
+                    self.stop()
+                    raise RuntimeError('hg serve did not start, see %s' % log)
+                time.sleep(0.05)
+
+    def stop(self):
+        """stop the server, return its resource usage"""
+        if self.proc.poll() is None:
+            os.kill(self.proc.pid, signal.SIGTERM)
+        try:
+            pid, status, rusage = os.wait4(self.proc.pid, 0)
+        except OSError, e:
+            if e.errno != errno.ECHILD:
+                raise
+            rusage = None
+        self.log.close()
+        if rusage is None:
+            return {}
+        maxrss = rusage.ru_maxrss * 1024
+        if sys.platform == 'darwin':
+            # bytes, not kilobytes
+            maxrss = rusage.ru_maxrss
+        return {'user': rusage.ru_utime, 'system': rusage.ru_stime,
+                'maxrss': maxrss}
+
+def client(opts, env, url, workdir, number, results, errors):
+    """run the requests of one client, appending (op, seconds) to results"""
+    ops = opts.ops.split(',')
+    local = os.path.join(workdir, 'client%d' % number)
+    if 'pull' in ops or 'incoming' in ops:
+        try:
+            runhg(opts, env, ['clone', '-q', '-U', url, local])
+        except RuntimeError, e:
+            errors.append(str(e))
+            return
+    for n in xrange(opts.requests):
+        op = ops[(number + n) % len(ops)]
+        try:
+            if op == 'clone':
+                dest = os.path.join(workdir, 'clone%d-%d' % (number, n))
+                elapsed = runhg(opts, env, ['clone', '-q', '-U', url, dest])
+                shutil.rmtree(dest)
+            elif op == 'pull':
+                elapsed = runhg(opts, env, ['pull', '-q', url], cwd=local)
+            else:
+                # incoming returns 1 when there is nothing to pull
+                elapsed = runhg(opts, env, ['incoming', '-q', url],
+                                cwd=local, ok=(0, 1))
+        except RuntimeError, e:
+            errors.append(str(e))
+            continue
+        results.append((op, elapsed))
+
+def percentile(runs, p):
+    """nearest rank percentile of the sorted runs
+
+    >>> percentile([1, 2, 3, 4], 50)
+    2
+    >>> percentile([1, 2, 3, 4], 95)
+    4
+    >>> percentile([1], 99)
+    1
+    """
+    rank = int(math.ceil(p / 100.0 * len(runs)))
+    return runs[max(0, min(rank, len(runs)) - 1)]
+
+def summarize(runs, elapsed):
+    runs = sorted(runs)
+    if not runs:
+        return {'requests': 0}
+    return {'requests': len(runs), 'rps': len(runs) / elapsed,
+            'p50': percentile(runs, 50), 'p95': percentile(runs, 95),
+            'p99': percentile(runs, 99)}
+
+def loadtest(opts, tmpdir, enabled):
+    """serve a new repository and run the clients against it"""
+    name = enabled and 'with' or 'without'
+    workdir = os.path.join(tmpdir, name)
+    os.makedirs(workdir)
+    env = dict(os.environ)
+    env['HGRCPATH'] = os.path.join(workdir, 'hgrc')
+    env.pop('HGPLAIN', None)
+    writehgrc(env['HGRCPATH'], enabled)
+    root = os.path.join(workdir, 'server')
+    makeserverrepo(opts, env, root)
+
+    srv = server(opts, env, root, os.path.join(workdir, 'server.log'))
+    results, errors = [], []
+    try:
+        threads = [threading.Thread(target=client,
+                                    args=(opts, env, srv.url, workdir, n,
+                                          results, errors))
+                   for n in xrange(opts.clients)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+    finally:
+        usage = srv.stop()
+
+    ops = {}
+    for op, seconds in results:
+        ops.setdefault(op, []).append(seconds)
+    result = {'elapsed': elapsed, 'errors': len(errors), 'server': usage,
+              'all': summarize([s for op, s in results], elapsed),
+              'ops': dict((op, summarize(runs, elapsed))
+                          for op, runs in ops.iteritems())}
+    if usage and results:
+        result['server']['cpuperrequest'] = (
+            (usage['user'] + usage['system']) / len(results))
+    for err in errors[:5]:
+        sys.stderr.write('%s: %s\n' % (name, err))
+    return name, result
+
+def report(name, result):
+    print '%s the extension: %d requests in %.1f s, %d errors' % (
+        name, result['all']['requests'], result['elapsed'], result['errors'])
+    for op in sorted(result['ops']) + ['all']:
+        s = result['ops'].get(op) or result['all']
+        if not s['requests']:
+            continue
+        print '  %-9s %7.1f req/s  p50 %7.1f ms  p95 %7.1f ms  p99 %7.1f ms' % (
+            op, s['rps'], s['p50'] * 1000, s['p95'] * 1000, s['p99'] * 1000)
+    usage = result['server']
+    if usage:
+        print '  server    %.2f s user, %.2f s system, %.1f MB peak RSS' % (
+            usage['user'], usage['system'], usage['maxrss'] / 1048576.0),
+        if 'cpuperrequest' in usage:
+            print '(%.1f ms CPU per request)' % (usage['cpuperrequest'] * 1000)
+        else:
+            print
+
+def compare(results):
+    """print the cost of the extension when both modes were run"""
+    base, ext = results['without'], results['with']
+    if not base['all']['requests'] or not ext['all']['requests']:
+        return
+    def change(new, old):
+        return old and (new - old) / old * 100 or 0.0
+    line = 'cost of the extension: %+.1f%% req/s, %+.1f%% p95' % (
+        change(ext['all']['rps'], base['all']['rps']),
+        change(ext['all']['p95'], base['all']['p95']))
+    if 'cpuperrequest' in base['server'] and 'cpuperrequest' in ext['server']:
+        line += ', %+.1f%% server CPU per request' % change(
+            ext['server']['cpuperrequest'], base['server']['cpuperrequest'])
+    print line
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-j', '--clients', type='int', default=8,
+                      help='number of concurrent clients')
+    parser.add_option('-n', '--requests', type='int', default=10,
+                      help='number of requests of each client')
+    parser.add_option('--ops', default='clone,pull,incoming',
+                      help='comma separated operations the clients run')
+    parser.add_option('--mode', default='both',
+                      choices=['both', 'with', 'without'],
+                      help='run with the extension, without it, or both')
+    parser.add_option('--sections', type='int', default=20,
+                      help='number of sections of the projrc file')
+    parser.add_option('--keys', type='int', default=20,
+                      help='number of keys of each projrc section')
+    parser.add_option('--changesets', type='int', default=20,
+                      help='number of changesets of the served repository')
+    parser.add_option('--hg', default='hg', help='the hg executable to test')
+    parser.add_option('-o', '--output', help='write the results to FILE')
+    opts, args = parser.parse_args(argv)
+    for op in opts.ops.split(','):
+        if op not in ('clone', 'pull', 'incoming'):
+            parser.error('unknown operation: %s' % op)
+
+    modes = {'both': [False, True], 'with': [True], 'without': [False]}
+    results = {}
+    tmpdir = tempfile.mkdtemp(prefix='projrc-loadtest-')
+    try:
+        for enabled in modes[opts.mode]:
+            name, result = loadtest(opts, tmpdir, enabled)
+            results[name] = result
+            report(name, result)
+    finally:
+        shutil.rmtree(tmpdir)
+    if len(results) == 2:
+        compare(results)
+
+    if opts.output:
+        fp = open(opts.output, 'w')
+        json.dump({'python': platform.python_version(), 'time': time.time(),
+                   'options': vars(opts), 'results': results},
+                  fp, indent=2, sort_keys=True)
+        fp.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -20,24 +20,126 @@ distribute an up-to-date set of configuration settings from a central
 repository.
 """
 
-import os, sys, fnmatch
+import time
+_importstart = time.time()
+
+import os, sys, re, marshal, fnmatch, hashlib, threading, inspect, itertools
+import posixpath, struct, zlib, random, shutil, Queue
 import mercurial
-from operator import itemgetter
 from mercurial import hg, extensions, pushkey, config, util, error
 from mercurial import commands, dispatch, cmdutil, localrepo, exchange
 from mercurial.i18n import _
-
-#systemrcpath imports
-if hasattr(mercurial, "scmutil") and hasattr(mercurial.scmutil, "systemrcpath"): from mercurial.scmutil import systemrcpath
-elif hasattr(mercurial, "util") and hasattr(mercurial.util, "system_rcpath"): from mercurial.util import system_rcpath as systemrcpath
-elif hasattr(mercurial, "scmwindows") and hasattr(mercurial.scmwindows, "systemrcpath"): from mercurial.scmwindows import systemrcpath
-elif hasattr(mercurial, "scmposix") and hasattr(mercurial.scmposix, "systemrcpath"): from mercurial.scmposix import systemrcpath
-
-#userrcpath imports
-if hasattr(mercurial, "scmutil") and hasattr(mercurial.scmutil, "userrcpath"): from mercurial.scmutil import userrcpath
-elif hasattr(mercurial, "util") and hasattr(mercurial.util, "user_rcpath"): from mercurial.util import user_rcpath as userrcpath
-elif hasattr(mercurial, "scmwindows") and hasattr(mercurial.scmwindows, "userrcpath"): from mercurial.scmwindows import userrcpath
-elif hasattr(mercurial, "scmposix") and hasattr(mercurial.scmposix, "userrcpath"): from mercurial.scmposix import userrcpath
+try:
+    from mercurial import registrar
+except ImportError:
+    # hg < 3.7
+    registrar = None
+try:
+    from mercurial import worker
+except ImportError:
+    # hg < 3.1
+    worker = None
+try:
+    from mercurial import bundle2
+except ImportError:
+    # hg < 3.0
+    bundle2 = None
+# The functions below moved around between Mercurial versions. They are
+# only looked up on first use, to keep the import of the extension cheap.
+
+def _systemrcpath():
+    if hasattr(mercurial, "scmutil") and hasattr(mercurial.scmutil, "systemrcpath"): from mercurial.scmutil import systemrcpath
+    elif hasattr(mercurial, "util") and hasattr(mercurial.util, "system_rcpath"): from mercurial.util import system_rcpath as systemrcpath
+    elif hasattr(mercurial, "scmwindows") and hasattr(mercurial.scmwindows, "systemrcpath"): from mercurial.scmwindows import systemrcpath
+    elif hasattr(mercurial, "scmposix") and hasattr(mercurial.scmposix, "systemrcpath"): from mercurial.scmposix import systemrcpath
+    return systemrcpath()
+
+def _userrcpath():
+    if hasattr(mercurial, "scmutil") and hasattr(mercurial.scmutil, "userrcpath"): from mercurial.scmutil import userrcpath
+    elif hasattr(mercurial, "util") and hasattr(mercurial.util, "user_rcpath"): from mercurial.util import user_rcpath as userrcpath
+    elif hasattr(mercurial, "scmwindows") and hasattr(mercurial.scmwindows, "userrcpath"): from mercurial.scmwindows import userrcpath
+    elif hasattr(mercurial, "scmposix") and hasattr(mercurial.scmposix, "userrcpath"): from mercurial.scmposix import userrcpath
+    return userrcpath()
+
+def walkrepos(*args, **kwargs):
+    if hasattr(mercurial, "scmutil") and hasattr(mercurial.scmutil, "walkrepos"): from mercurial.scmutil import walkrepos
+    else: from mercurial.util import walkrepos
+    return walkrepos(*args, **kwargs)
+
+_zstd = []
+
+def getzstd():
+    """return the zstd module bundled with Mercurial, or None"""
+    if not _zstd:
+        try:
+            from mercurial import zstd
+            # Make demandimport load it now
+            zstd.ZstdCompressor
+        except (ImportError, AttributeError):
+            # hg < 4.1, or built without zstd support
+            zstd = None
+        _zstd.append(zstd)
+    return _zstd[0]
+
+# The (phase, seconds) timings of the projrc handling in this process,
+# starting with the module imports (see debugprojrc --timing). A command
+# server starts them over for every command, and long running commands
+# (e.g. hg projrc watch) only keep the last MAXTIMINGS of them.
+_timings = [('import', time.time() - _importstart)]
+MAXTIMINGS = 100
+
+def timingenabled(ui):
+    """True if the projrc phase timings must be reported as they happen"""
+    if os.environ.get('HGPROJRCTIMING'):
+        return True
+    return ui.configbool('projrc', 'timing', False)
+
+# The reported timings that have not been sent to ui.log yet. Logging
+# extensions (e.g. blackbox) drop the messages that are logged before
+# the command runs, so the startup timings wait for runcommand.
+_pendinglog = []
+_commandrunning = False
+
+def reporttiming(ui, phase, seconds):
+    ui.write_err(_('projrc: %s took %.3f ms\n') % (phase, seconds * 1000))
+    _pendinglog.append((phase, seconds))
+    if _commandrunning:
+        logtimings(ui)
+
+def logtimings(ui):
+    if not hasattr(ui, 'log'):
+        # hg < 2.1
+        del _pendinglog[:]
+    while _pendinglog:
+        phase, seconds = _pendinglog.pop(0)
+        ms = seconds * 1000
+        ui.log('projrc', 'projrc %s took %.3f ms\n', phase, ms,
+               projrc_phase=phase, projrc_ms=ms)
+
+def recordtiming(ui, phase, start):
+    """record that phase has been running since start"""
+    recordduration(ui, phase, time.time() - start)
+
+def recordduration(ui, phase, seconds):
+    """record that phase took seconds"""
+    _timings.append((phase, seconds))
+    if len(_timings) > MAXTIMINGS:
+        del _timings[:-MAXTIMINGS]
+    if ui is not None and timingenabled(ui):
+        reporttiming(ui, phase, seconds)
+
+cmdtable = {}
+if registrar is not None and hasattr(registrar, 'command'):
+    # hg >= 4.3
+    command = registrar.command(cmdtable)
+else:
+    command = cmdutil.command(cmdtable)
+
+if hasattr(error, 'Abort'):
+    # hg >= 3.6
+    abort = error.Abort
+else:
+    abort = util.Abort
 
 # To handle different encoding with pushkey between Mercurial 1.7 and
 # 1.8 the server will send a line beginning with '#\\ ' as the first
@@ -63,16 +165,62 @@ def classifycfgpath(path):
     4
     """
     path = path.rsplit(":", 1)[0]
+    try:
+        return _cfgpathclasses[path]
+    except KeyError:
+        pass
+    if classifycfgpath.systemrcpath is None:
+        classifycfgpath.systemrcpath = _systemrcpath()
     if path in classifycfgpath.systemrcpath:
-        return SYSTEMRC
-    if util.pconvert(path).endswith(".hg/projrc"):
-        return PROJRC
-    if path in userrcpath():
-        return USERRC
-    # .hg/hgrc, file in $HGRCPATH, or an included file
-    return HGRC
-# Use a function attribute to compute this value only once.
-classifycfgpath.systemrcpath = systemrcpath()
+        order = SYSTEMRC
+    elif util.pconvert(path).endswith(".hg/projrc"):
+        order = PROJRC
+    else:
+        if classifycfgpath.userrcpath is None:
+            classifycfgpath.userrcpath = _userrcpath()
+        if path in classifycfgpath.userrcpath:
+            order = USERRC
+        else:
+            # .hg/hgrc, file in $HGRCPATH, or a file included by one of them
+            order = HGRC
+    _cfgpathclasses[path] = order
+    return order
+# Use function attributes to compute these values only once.
+classifycfgpath.systemrcpath = None
+classifycfgpath.userrcpath = None
+
+# source path -> configuration layer, filled by classifycfgpath and by
+# readprojrclayer (for the files included by a projrc)
+_cfgpathclasses = {}
+
+def classifyprojrcinclude(path):
+    """put path, a file included by a projrc, in the projrc layer
+
+    Files that were already classified, and system, user and repository
+    configuration files, keep their own layer.
+    
+    >>> classifyprojrcinclude(util.expandpath("~/.hgrc"))
+    >>> classifycfgpath(util.expandpath("~/.hgrc"))
+    3
+    >>> classifyprojrcinclude("repo/.hg/shared.rc")
+    >>> classifycfgpath("repo/.hg/shared.rc")
+    2
+    """
+    if path in _cfgpathclasses:
+        return
+    order = classifycfgpath(path)
+    if order == HGRC and not util.pconvert(path).endswith('.hg/hgrc'):
+        _cfgpathclasses[path] = PROJRC
+
+def plainsections(ui):
+    """the alias sections of a projrc that HGPLAIN drops, as ui.readconfig"""
+    try:
+        return [section for section in ('alias', 'revsetalias',
+                                        'templatealias')
+                if ui.plain(section)]
+    except TypeError:
+        # hg < 2.0 has no HGPLAINEXCEPT
+        return ui.plain() and ['alias'] or []
 
 def isfilepath(pth):
     """True if a path is not an http, https or ssh path"""
@@ -93,39 +241,149 @@ def islocalpath(pth):
             return False
     return False
 
-def findpatternmatch(searchtext, patternlist):
-    """Find whether a string matches any of the glob patterns on a pattern list
-
-    This function returns 3 values:
-        patmatch: True if there is a match
-        exactmatch: True if the match is exact (i.e. one of the "patterns"
-                    is identical to the the search text)
-        matchedpattern: The first pattern that matched the search text
-
-    Note that the function searches for exact matches first, and if no exact
-    match is found it searches for pattern matches.
-
-    Also note that the matches are not case sensitive.
+def _isglob(pat):
+    """True if pat contains any fnmatch special characters"""
+    return '*' in pat or '?' in pat or '[' in pat
+
+def _globrank(pat):
+    """sort key for the explicitness of a glob pattern (see keymatcher)"""
+    if pat in ('*', '*.*'):
+        return (0, len(pat))
+    section, dot, key = pat.partition('.')
+    if key == '*' and not _isglob(section):
+        return (1, len(pat))
+    return (2, len(pat))
+
+class keymatcher(object):
+    """match strings against a set of glob patterns, all at once
+
+    The patterns are compiled once. Patterns are first looked up in a
+    hash table for exact matches. The globs are merged into a few
+    regular expressions whose alternatives are sorted from the most to
+    the least explicit pattern, so that the first alternative that
+    matches is also the most explicit glob that matches.
+
+    match() returns None or an (exactmatch, matchedpattern) tuple. The
+    matches are not case sensitive, and a pattern identical to the string
+    (an exact match) wins over any glob.
+
+    >>> m = keymatcher(['ui.merge', 'auth.*', 'AUTH.bitbucket.*', '*'])
+    >>> m.match('UI.merge')
+    (True, 'ui.merge')
+    >>> m.match('auth.bitbucket.prefix')
+    (False, 'auth.bitbucket.*')
+    >>> m.match('auth.other.prefix')
+    (False, 'auth.*')
+    >>> m.match('diff.git')
+    (False, '*')
+    >>> print keymatcher(['ui.*']).match('diff.git')
+    None
     """
-    patmatch = False
-    exactmatch = False
-    matchedpattern = None
-
-    searchtext = searchtext.lower()
+    # Python 2's re module supports at most 100 groups per expression
+    _chunksize = 90
+
+    def __init__(self, patterns):
+        self._exact = set()
+        globs = set()
+        for pat in patterns:
+            pat = pat.lower()
+            self._exact.add(pat)
+            if _isglob(pat):
+                globs.add(pat)
+        globs = sorted(globs, key=lambda pat: _globrank(pat), reverse=True)
+        self._globs = []
+        for start in xrange(0, len(globs), self._chunksize):
+            chunk = globs[start:start + self._chunksize]
+            regex = '|'.join('(?P<p%d>%s)' % (n, self._translate(pat))
+                             for n, pat in enumerate(chunk))
+            self._globs.append((re.compile(regex, re.M | re.S), chunk))
+
+    @staticmethod
+    def _translate(pat):
+        # fnmatch appends the (?ms) flags to every expression, which is
+        # not valid in the middle of a larger expression
+        regex = fnmatch.translate(pat)
+        if regex.endswith('(?ms)'):
+            regex = regex[:-len('(?ms)')]
+        return regex
+
+    def match(self, text):
+        text = text.lower()
+        if text in self._exact:
+            return True, text
+        for regex, chunk in self._globs:
+            m = regex.match(text)
+            if m:
+                return False, chunk[int(m.lastgroup[1:])]
+        return None
+
+    def explicitness(self, text):
+        """return how explicitly text is matched, or None
+
+        Exact matches are the most explicit ones, followed by glob matches
+        (the longest glob being the most explicit), section level matches
+        (such as "ui.*") and finally the global "*" and "*.*" matches.
+        """
+        m = self.match(text)
+        if m is None:
+            return None
+        exactmatch, pat = m
+        if exactmatch:
+            return (3, len(pat))
+        return _globrank(pat)
+
+class keyfilter(object):
+    """decide which configuration keys pass a projrc include/exclude filter
+
+    A key is kept if it matches the include list and either does not
+    match the exclude list or its include match is at least as explicit
+    as its exclude match (see serializeconfig).
+
+    Use getkeyfilter() to reuse the filters built for the same lists.
+
+    >>> f = keyfilter(['*'], ['hooks.*', 'projrc.*'])
+    >>> f('ui.username'), f('hooks.commit'), f('projrc.servers')
+    (True, False, False)
+    >>> f = keyfilter(['hooks.commit'], ['hooks.*'])
+    >>> f('hooks.commit'), f('hooks.update'), f('ui.username')
+    (True, False, False)
+    """
+    def __init__(self, includedkeys, excludedkeys):
+        if excludedkeys and not includedkeys:
+            # If the excluded keys are specified but the allowed ones are not,
+            # assume that all non excluded keys are allowed
+            includedkeys = ['*']
+        self._include = keymatcher(includedkeys)
+        self._exclude = keymatcher(excludedkeys)
+
+    def __call__(self, fullkey):
+        include = self._include.explicitness(fullkey)
+        if include is None:
+            return False
+        exclude = self._exclude.explicitness(fullkey)
+        # on a draw inclusion takes precedence over exclusion
+        return exclude is None or include >= exclude
 
-    # Search for exact maches first
-    for pat in patternlist:
-        if searchtext == pat.lower():
-            return True, True, pat
+_keyfilters = {}
 
-    # No exact match was found
-    for pat in patternlist:
-        if fnmatch.fnmatch(searchtext, pat.lower()):
-            patmatch = True
-            matchedpattern = pat
-            break
+def getkeyfilter(includedkeys='*', excludedkeys=''):
+    """return a (cached) keyfilter for the given include and exclude lists
 
-    return patmatch, exactmatch, matchedpattern
+    The lists may also be given as a single pattern string, which is what
+    the serializeconfig defaults do.
+    """
+    def patternset(keys):
+        if isinstance(keys, basestring):
+            keys = keys and [keys] or []
+        return frozenset(keys)
+    cachekey = (patternset(includedkeys), patternset(excludedkeys))
+    try:
+        return _keyfilters[cachekey]
+    except KeyError:
+        if len(_keyfilters) > 100:
+            _keyfilters.clear()
+        f = _keyfilters[cachekey] = keyfilter(*cachekey)
+        return f
 
 def serializeconfig(conf, includedkeys='*', excludedkeys=''):
     """turn a config object into a string
@@ -186,26 +444,20 @@ def serializeconfig(conf, includedkeys='*', excludedkeys=''):
     [('z', 'w'), ('x', 'xxx')]
     """
 
-    if excludedkeys and not includedkeys:
-        # If the excluded keys are specified but the allowed ones are not,
-        # assume that all non excluded keys are allowed
-        includedkeys = '*'
+    return ''.join(iterserializeconfig(conf, includedkeys, excludedkeys))
 
-    includeall = '*' in includedkeys or '*.*' in includedkeys
-    # We don't need to define an equivalent "excludeall" because we exclude
-    # all keys by default
+def iterserializeconfig(conf, includedkeys='*', excludedkeys=''):
+    """like serializeconfig, but generate the output line by line
 
-    lines = []
+    This lets very large configurations be written or compared without
+    building the whole string.
+    """
+    keep = getkeyfilter(includedkeys, excludedkeys)
+
+    separator = ''
     for section in conf:
         foundsectionkey = False
-        includesection = (section + '.*').lower() in includedkeys
-        excludesection = (section + '.*').lower() in excludedkeys
-
         for key, val in conf.items(section):
-            fullkey = '%s.%s' % (section.lower(), key.lower())
-            includekey, exactinclude, matchedinclude = findpatternmatch(fullkey, includedkeys)
-            excludekey, exactexclude, matchedexclude = findpatternmatch(fullkey, excludedkeys)
-
             # Should we include the setting?
             # In particular, should we include a setting if it matches both
             # an include and an exclude pattern?:
@@ -218,50 +470,27 @@ def serializeconfig(conf, includedkeys='*', excludedkeys=''):
             # 2. If a key is found both on the include and the exclude list with
             #    the same level of "explicitness", the key is _included_
             #    (i.e. inclusion takes precedence over exclusion)
-            if includekey and excludekey:
-                # Either make includekey true and excludekey false,
-                # or make includekey false and excludekey true
-                if exactinclude == exactexclude:
-                    # if both matches are exact or both are inexact,
-                    # include the key unless its match is shorter
-                    includekey = (matchedinclude >= matchedexclude)
-                else:
-                    includekey = exactinclude
-                excludekey = not includekey
-
-            if includekey or \
-                    (not excludekey and \
-                        (includesection or \
-                            (not excludesection and includeall)
-                        )
-                    ):
+            if keep('%s.%s' % (section, key)):
                 if not foundsectionkey:
-                    lines.append("[%s]" % section)
+                    yield "%s[%s]\n" % (separator, section)
                     foundsectionkey = True
-                lines.append("%s = %s" % (key, val.replace('\n', '\n  ')))
-
-        if foundsectionkey:
-            lines.append('')
-
-    # for final newline
-    if not lines:
-        lines.append('')
-
-    return "\n".join(lines)
+                    separator = '\n'
+                yield "%s = %s\n" % (key, val.replace('\n', '\n  '))
+
+def parsekeylist(configlist):
+    """turn a list of keys and sections into a set of key patterns"""
+    keyset = set()
+    for config in set(configlist):
+        fullkey = config.strip().lower()
+        section = fullkey.split('.')[0]
+        if section == fullkey:
+            # The whole section is allowed
+            fullkey = fullkey + '.*'
+        keyset.add(fullkey)
+    return keyset
 
 def getallowedkeys(ui):
     """Get a set of the keys that we are allowed to get from the remote projrc file"""
-    def parsekeylist(configlist):
-        keyset = set()
-        for config in set(configlist):
-            fullkey = config.strip().lower()
-            section = fullkey.split('.')[0]
-            if section == fullkey:
-                # The whole section is allowed
-                fullkey = fullkey + '.*'
-            keyset.add(fullkey)
-        return keyset
-
     configlist = ui.configlist('projrc', 'include')
     includedkeys = parsekeylist(configlist)
 
@@ -274,56 +503,420 @@ def getallowedkeys(ui):
 
     return includedkeys, excludedkeys
 
-def loadprojrc(ui, projrc, root):
-    if not os.path.exists(projrc):
-        return
-    
-    cfg = ui._data(untrusted=False)
-
-    pui = ui.copy()
-    pui.readconfig(projrc, root)
-    pcfg = pui._data(untrusted=False)
-
-    # Add settings from projrc file if the key is not already loaded
-    # by a later file.
-    for section in pcfg:
-        for key, value in pcfg.items(section):
-            src = pcfg.source(section, key)
-            if key not in cfg[section] or classifycfgpath(src) < PROJRC:
-                cfg.set(section, key, value, src)
+# Version of the .hg/cache/projrc-parsed file format
+PARSEDCACHEVERSION = 2
+
+class recordingconfig(config.config):
+    """config object that remembers every file that it reads
+
+    This includes the files that are %include'd and the ones that could
+    not be read (e.g. an %include of a file that does not exist yet).
+    """
+    def __init__(self, *args, **kwargs):
+        config.config.__init__(self, *args, **kwargs)
+        self.readpaths = []
 
-    # Sort settings to simulate correct load order. ui.walkconfig is
-    # almost what we want, but it runs str on all values and replaces
-    # \n with \\n for some reason.
-    for section in cfg:
-        items = []
+    def read(self, path, fp=None, sections=None, remap=None):
+        self.readpaths.append(path)
+        return config.config.read(self, path, fp, sections=sections,
+                                  remap=remap)
+
+def filesignature(paths):
+    """return the (path, mtime, size, inode) of each file in paths
+
+    The stat fields are None for the files that do not exist.
+    """
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            signature.append((path, st.st_mtime, st.st_size, st.st_ino))
+        except OSError:
+            signature.append((path, None, None, None))
+    return tuple(signature)
+
+def isambiguous(signature):
+    """True if a file in signature may change unnoticed by a stat check
+
+    That is the case of the files modified during the current second,
+    whose mtime may not change on their next modification.
+    """
+    now = int(time.time())
+    return bool([entry for entry in signature if int(entry[1] or 0) >= now])
+
+def readcachefile(path, version, projrc, headeronly=False):
+    """read a cache file built from projrc (and the files it includes)
+
+    Cache files start with a small (version, signature, info) header,
+    followed by the cached data. The cache is validated by comparing the
+    stat signature of the projrc file and of all the files that it
+    includes with the recorded one.
+
+    This returns None if the cache is missing or stale, info if
+    headeronly is set and a (signature, info, data) tuple otherwise.
+    """
+    try:
+        fp = open(path, 'rb')
+        try:
+            cacheversion, signature, info = marshal.load(fp)
+            if cacheversion != version or not signature or \
+                    signature[0][0] != projrc or \
+                    filesignature([entry[0] for entry in signature]) \
+                        != signature:
+                return None
+            if headeronly:
+                return info
+            return signature, info, marshal.load(fp)
+        finally:
+            fp.close()
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+
+def writecachefile(path, version, signature, info, data):
+    """atomically write a cache file (see readcachefile)"""
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        fp = util.atomictempfile(path, 'wb')
+        fp.write(marshal.dumps((version, signature, info)))
+        fp.write(marshal.dumps(data))
+        fp.close()
+    except (IOError, OSError):
+        # Caches are just an optimization (e.g. the repo may be read only)
+        pass
+
+def parsedcachepath(projrc):
+    return os.path.join(os.path.dirname(projrc), 'cache', 'projrc-parsed')
+
+def readparsedcache(projrc, sectionsonly=False):
+    """return the cached parse of projrc, or None if it is missing or stale
+
+    Using the cache, config.parse can be skipped entirely when neither
+    the projrc nor the files that it includes have changed.
+
+    The cache header holds the list of sections that the projrc sets. If
+    sectionsonly is set only that list is returned, without loading the
+    settings themselves.
+    """
+    cached = readcachefile(parsedcachepath(projrc), PARSEDCACHEVERSION,
+                           projrc, headeronly=sectionsonly)
+    if cached is None or sectionsonly:
+        return cached
+    layer = recordingconfig()
+    layer.readpaths = [entry[0] for entry in cached[0]]
+    for section, key, value, source in cached[2]:
+        layer.set(section, key, value, source)
+    return layer
+
+def writeparsedcache(projrc, layer, signature):
+    """atomically store the parse of projrc in the parsed projrc cache"""
+    items = [(section, key, value, layer.source(section, key))
+             for section in layer
+             for key, value in layer.items(section)]
+    writecachefile(parsedcachepath(projrc), PARSEDCACHEVERSION, signature,
+                   layer.sections(), items)
+
+def parseprojrc(projrc, fp=None, updatecache=False):
+    """parse projrc and the files it includes, using the parsed projrc cache
+
+    The cache is not updated when one of the files was modified so
+    recently that a later change could go unnoticed by the stat based
+    validation (unless updatecache is set, which is what the code that
+    just wrote a new projrc does).
+
+    The parse of a projrc that refers to the projrc store is taken from
+    the store entry, where every repository that shares it can reuse it.
+    """
+    if not updatecache:
+        layer = readparsedcache(projrc)
+        if layer is not None:
+            return layer
+    entry = readstorereference(projrc, fp)
+    if entry is not None and os.path.exists(entry):
+        layer = parseprojrc(entry)
+        layer.readpaths.insert(0, projrc)
+    else:
+        layer = recordingconfig()
+        layer.read(projrc, fp)
+    signature = filesignature(layer.readpaths)
+    if updatecache or not isambiguous(signature):
+        writeparsedcache(projrc, layer, signature)
+    return layer
+
+def readprojrclayer(ui, projrc, root):
+    """read projrc and the files it includes into a config object of its own
+
+    Returns None if the file does not exist or is not trusted. Like
+    ui.readconfig, this honours HGPLAIN and makes the relative [paths]
+    entries absolute.
+    """
+    try:
+        fp = open(projrc, 'rb')
+    except IOError:
+        return None
+    try:
+        if hasattr(ui, '_trusted') and not ui._trusted(fp, projrc):
+            return None
+        start = time.time()
+        layer = parseprojrc(projrc, fp)
+        recordtiming(ui, 'read', start)
+    finally:
+        fp.close()
+
+    if ui.plain():
+        for k in ('debug', 'fallbackencoding', 'quiet', 'slash',
+                  'logtemplate', 'statuscopies', 'style',
+                  'traceback', 'verbose'):
+            if k in layer['ui']:
+                del layer['ui'][k]
+        for section in ('defaults', 'commands'):
+            for k, v in layer.items(section):
+                del layer[section][k]
+    for section in plainsections(ui):
+        for k, v in layer.items(section):
+            del layer[section][k]
+
+    for name, path in layer.items('paths'):
+        if not path or ':' in name:
+            continue
+        path = util.expandpath(path)
+        if '://' not in path and not os.path.isabs(path):
+            path = os.path.normpath(os.path.join(root, path))
+        layer.set('paths', name, path, layer.source('paths', name))
+
+    # The files included by the projrc are part of the projrc layer
+    for section in layer:
+        for key, value in layer.items(section):
+            classifyprojrcinclude(layer.source(section, key).rsplit(":", 1)[0])
+    return layer
+
+def applyprojrclayer(cfg, layer, sections=None):
+    """merge a projrc layer into the cfg config object
+
+    The layers are resolved as SYSTEMRC < PROJRC < USERRC < HGRC: a projrc
+    setting replaces a system wide setting but not a user or repository
+    one. Only the sections that the projrc sets (or the given subset of
+    them) are touched.
+    """
+    if sections is None:
+        sections = layer.sections()
+    for section in sections:
+        for key, value in layer.items(section):
+            if key in cfg[section] and \
+                    classifycfgpath(cfg.source(section, key)) > PROJRC:
+                continue
+            cfg.set(section, key, value, layer.source(section, key))
+
+        # Keep the section in load order (which is what e.g. decides the
+        # order in which extensions are loaded): the settings of the later
+        # layers are moved after the projrc ones. ui.walkconfig is
+        # almost what we want, but it runs str on all values and replaces
+        # \n with \\n for some reason.
         for key, value in cfg.items(section):
             src = cfg.source(section, key)
-            items.append((classifycfgpath(src), key, value, src))
-        # sort the config items according to their cfg file priority
-        items.sort(key=itemgetter(0)) # list.sort implements a stable sort
-        for order, key, value, src in items:
-            cfg.set(section, key, value, src)
+            if classifycfgpath(src) > PROJRC:
+                cfg.set(section, key, value, src)
+
+def loadprojrc(ui, projrc, root):
+    """merge projrc into ui, return its layer (or None if it was not read)"""
+    layer = readprojrclayer(ui, projrc, root)
+    if layer is None:
+        return None
+    start = time.time()
+    applyprojrclayer(ui._data(untrusted=False), layer)
+    recordtiming(ui, 'merge', start)
+    return layer
+
+# projrc path -> (signature, (root, plain, plain sections), layer) of the
+# projrc files
+# that a command server has read
+_layercache = {}
+
+def readcachedprojrclayer(ui, projrc, root):
+    """like readprojrclayer, but reuse the layer read by an earlier command
+
+    A command server (e.g. chg) runs many commands in a single process.
+    The layer is only read again when the projrc or one of the files that
+    it includes has a new stat signature.
+    """
+    key = (root, bool(ui.plain()), tuple(plainsections(ui)))
+    cached = _layercache.get(projrc)
+    if cached is not None and cached[1] == key and \
+            filesignature([entry[0] for entry in cached[0]]) == cached[0]:
+        ui.debug('projrc: reusing the settings read from %s\n' % projrc)
+        return cached[2]
+    _layercache.pop(projrc, None)
+    layer = readprojrclayer(ui, projrc, root)
+    if layer is None:
+        return None
+    signature = filesignature(getattr(layer, 'readpaths', [projrc]))
+    if not isambiguous(signature):
+        _layercache[projrc] = (signature, key, layer)
+    return layer
+
+def loadcachedprojrc(ui, projrc, root):
+    """like loadprojrc, using readcachedprojrclayer"""
+    layer = readcachedprojrclayer(ui, projrc, root)
+    if layer is None:
+        return
+    start = time.time()
+    applyprojrclayer(ui._data(untrusted=False), layer)
+    recordtiming(ui, 'merge', start)
+
+# Sections that a lazily loaded projrc still applies right away, because
+# they are used before (or without) any explicit configuration lookup
+EAGERSECTIONS = ('extensions', 'hooks')
+
+class lazyprojrcui(object):
+    """ui mixin that merges deferred projrc layers on first use
+
+    The projrc files are merged by the first configuration lookup of any
+    section that they set. Copies of the ui inherit the pending projrc
+    files that have not been merged yet.
+    """
+    _projrcpending = ()
+
+    def __init__(self, src=None):
+        self._projrcpending = list(getattr(src, '_projrcpending', ()))
+        super(lazyprojrcui, self).__init__(src)
+
+    def _loadprojrc(self, section=None):
+        """merge the pending projrc files if they set section"""
+        if not self._projrcpending:
+            return
+        if section is not None and \
+                not [p for p in self._projrcpending if section in p[2]]:
+            return
+        pending, self._projrcpending = self._projrcpending, []
+        for projrc, root, sections in pending:
+            try:
+                layer = readprojrclayer(self, projrc, root)
+            except error.ParseError, e:
+                self.warn(_("not loading projrc file: "
+                            "parse error at '%s' on %s\n") % e.args)
+                continue
+            if layer is not None:
+                applyprojrclayer(self._data(untrusted=False), layer,
+                                 [s for s in layer.sections()
+                                  if s not in EAGERSECTIONS])
+
+    def config(self, section, *args, **kwargs):
+        self._loadprojrc(section)
+        return super(lazyprojrcui, self).config(section, *args, **kwargs)
+
+    def _config(self, section, *args, **kwargs):
+        # configbool and friends skip ui.config on hg >= 4.4
+        self._loadprojrc(section)
+        return super(lazyprojrcui, self)._config(section, *args, **kwargs)
+
+    def configsource(self, section, *args, **kwargs):
+        self._loadprojrc(section)
+        return super(lazyprojrcui, self).configsource(section, *args,
+                                                      **kwargs)
+
+    def configitems(self, section, *args, **kwargs):
+        self._loadprojrc(section)
+        return super(lazyprojrcui, self).configitems(section, *args,
+                                                     **kwargs)
+
+    def hasconfig(self, section, *args, **kwargs):
+        self._loadprojrc(section)
+        return super(lazyprojrcui, self).hasconfig(section, *args, **kwargs)
+
+    def has_section(self, section, *args, **kwargs):
+        self._loadprojrc(section)
+        return super(lazyprojrcui, self).has_section(section, *args,
+                                                     **kwargs)
+
+    def walkconfig(self, *args, **kwargs):
+        self._loadprojrc()
+        return super(lazyprojrcui, self).walkconfig(*args, **kwargs)
+
+def deferprojrc(ui, projrc, root):
+    """load projrc into ui lazily (see the projrc.lazy setting)
+
+    Only the path of the projrc and the list of sections that it sets are
+    recorded, the latter from the parsed projrc cache when it is valid.
+    The settings in EAGERSECTIONS are still applied right away.
+    """
+    sections = readparsedcache(projrc, sectionsonly=True)
+    layer = None
+    if sections is None:
+        # There is no valid cache, so we must parse the file anyway
+        layer = readprojrclayer(ui, projrc, root)
+        if layer is None:
+            return
+        sections = layer.sections()
+
+    eager = [s for s in sections if s in EAGERSECTIONS]
+    if eager:
+        if layer is None:
+            layer = readprojrclayer(ui, projrc, root)
+            if layer is None:
+                return
+        applyprojrclayer(ui._data(untrusted=False), layer, eager)
+
+    lazy = set(sections).difference(EAGERSECTIONS)
+    if lazy:
+        if not isinstance(ui, lazyprojrcui):
+            cls = ui.__class__
+            if cls not in _lazyuiclasses:
+                _lazyuiclasses[cls] = type('lazyprojrcui',
+                                           (lazyprojrcui, cls), {})
+            ui.__class__ = _lazyuiclasses[cls]
+            ui._projrcpending = []
+        ui._projrcpending.append((projrc, root, lazy))
+
+# ui class -> its lazyprojrcui subclass
+_lazyuiclasses = {}
 
 def readcurrentprojrc(repo):
     """Return the contents of the current projrc file"""
-    return repo_read(repo, 'projrc')
+    projrc = localprojrcpath(repo)
+    if projrc == repo_join(repo, 'projrc'):
+        return repo_read(repo, 'projrc')
+    try:
+        fp = open(projrc, 'rb')
+        try:
+            return fp.read()
+        finally:
+            fp.close()
+    except IOError:
+        return ""
 
-def readprojrc(ui, rpath):
+def readprojrc(ui, rpath, wd=None, load=None):
     # Modelled after dispatch._getlocal but reads the projrc settings
     # directly into the ui object.
-    try:
-        wd = os.getcwd()
-    except OSError, e:
-        raise util.Abort(_("error getting current working directory: %s") %
-                         e.strerror)
+    if wd is None:
+        try:
+            wd = os.getcwd()
+        except OSError, e:
+            raise util.Abort(_("error getting current working directory: %s")
+                             % e.strerror)
+    start = time.time()
+    roots = []
     path = cmdutil.findrepo(wd) or ""
     if path:
-        loadprojrc(ui, os.path.join(path, ".hg", "projrc"), path)
-
+        roots.append(path)
     if rpath:
-        path = ui.expandpath(rpath[-1])
-        loadprojrc(ui, os.path.join(path, ".hg", "projrc"), path)
+        roots.append(ui.expandpath(rpath[-1]))
+    recordtiming(ui, 'findrepo', start)
+
+    # Only clients with projrc servers get projrc files staged for them
+    staged = ui.config('projrc', 'servers')
+    for root in roots:
+        if staged:
+            applystagedprojrc(ui, root)
+        projrc = os.path.join(root, ".hg", "projrc")
+        if not os.path.exists(projrc):
+            # Nothing else to do (or even to look up) without a projrc
+            continue
+        if load is None:
+            if ui.configbool('projrc', 'lazy', False):
+                load = deferprojrc
+            else:
+                load = loadprojrc
+        load(ui, projrc, root)
 
 def getprojrcserverset(ui):
     """Get the list of projrc servers, normalizing paths and character cases"""
@@ -338,6 +931,405 @@ def getprojrcserverset(ui):
             serverlist[n] = server.lower()
     return set(serverlist)
 
+class servermatcher(object):
+    """decide whether a repository is on a projrc.servers list
+
+    The list is parsed once. The URL patterns whose scheme and host have
+    no glob characters are indexed by their "scheme://host" prefix, so
+    only the patterns of the host of a remote URL are tried. The
+    remaining patterns (file paths, and URLs whose host has globs) are
+    merged into a single keymatcher. A URL or path is on the list if it
+    is identical to one of the patterns or matches one of the globs,
+    regardless of case.
+
+    >>> m = servermatcher(['http://hg.example.com/*', '/srv/*',
+    ...                    'ssh://hg@*.example.net/repo', 'localhost'])
+    >>> m('http://HG.example.com/foo'), m('https://hg.example.com/foo')
+    (True, False)
+    >>> m('ssh://hg@build.example.net/repo'), m('/srv/repo')
+    (True, True)
+    >>> m('http://localhost/repo'), m('http://other/repo')
+    (True, False)
+    """
+    def __init__(self, servers):
+        self._all = '*' in servers
+        self._localhost = 'localhost' in servers
+        byhost, others = {}, []
+        for server in servers:
+            host = self._hostprefix(server.lower())
+            if host is None or _isglob(host):
+                others.append(server)
+            else:
+                byhost.setdefault(host, []).append(server)
+        self._byhost = dict((host, keymatcher(patterns))
+                            for host, patterns in byhost.iteritems())
+        self._others = keymatcher(others)
+
+    @staticmethod
+    def _hostprefix(path):
+        """return the "scheme://host" part of a URL, None for file paths"""
+        if isfilepath(path):
+            return None
+        scheme, sep, rest = path.partition('://')
+        if not sep:
+            return None
+        return '%s://%s' % (scheme, rest.split('/', 1)[0])
+
+    def __call__(self, path):
+        if self._all or (self._localhost and islocalpath(path)):
+            return True
+        matcher = self._byhost.get(self._hostprefix(path.lower()))
+        if matcher is not None and matcher.match(path) is not None:
+            return True
+        return self._others.match(path) is not None
+
+_servermatchers = {}
+
+def getservermatcher(ui):
+    """return the servermatcher of the projrc.servers setting of ui
+
+    Matchers are cached by the raw setting (which is cheaper to get than
+    the parsed list) and by the [paths] section that its entries are
+    expanded with.
+    """
+    cachekey = (ui.config('projrc', 'servers'),
+                tuple(ui.configitems('paths')))
+    try:
+        return _servermatchers[cachekey]
+    except KeyError:
+        if len(_servermatchers) > 100:
+            _servermatchers.clear()
+        m = _servermatchers[cachekey] = \
+            servermatcher(getprojrcserverset(ui))
+        return m
+
+def projrctoken(remotehash, includedkeys, excludedkeys):
+    """identify a remote projrc payload as seen through the local filter
+
+    The same payload gives a different local projrc file if the
+    projrc.include or projrc.exclude settings change, so they are part
+    of the token.
+    """
+    filterkey = repr((sorted(includedkeys), sorted(excludedkeys)))
+    return hashlib.sha1('%s\0%s' % (remotehash, filterkey)).hexdigest()
+
+def readprojrcstate(repo):
+    """return the (token, revision) of the payload that the local projrc
+    came from
+
+    The revision is the server's projrc revision number (None if the
+    server does not number them). Both are None if there is no token, or
+    if the projrc file has been modified (or removed) since the token was
+    written.
+    """
+    try:
+        token, rev, signature = \
+            repo_read(repo, 'projrc.hash').split('\n', 2)
+    except ValueError:
+        return None, None
+    if signature != projrcsignature(repo):
+        return None, None
+    if not rev.isdigit():
+        return token, None
+    return token, int(rev)
+
+def projrcsignature(repo):
+    """the stat signature of the local projrc file (and of the projrc
+    store entry that it refers to)"""
+    projrc = repo_join(repo, 'projrc')
+    paths = [projrc]
+    entry = readstorereference(projrc)
+    if entry is not None:
+        paths.append(entry)
+    return repr(filesignature(paths))
+
+def readprojrctoken(repo):
+    """return the token of the payload that the local projrc came from"""
+    return readprojrcstate(repo)[0]
+
+def writeprojrctoken(repo, token, rev=None):
+    """remember the token of the payload that the local projrc came from"""
+    if token is None:
+        if os.path.exists(repo_join(repo, 'projrc.hash')):
+            os.unlink(repo_join(repo, 'projrc.hash'))
+        return
+    signature = projrcsignature(repo)
+    if rev is None:
+        rev = ''
+    repo_write(repo, 'projrc.hash', '%s\n%s\n%s' % (token, rev, signature))
+    # A projrc staged by "hg projrc watch" is not newer than this one
+    if os.path.exists(repo_join(repo, 'projrc.staged')):
+        os.unlink(repo_join(repo, 'projrc.staged'))
+
+class hgdir(object):
+    """a .hg directory, for repo_join, repo_read and repo_write
+
+    This is used to handle the projrc files when Mercurial starts, before
+    there is a repository object.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def join(self, f):
+        return os.path.join(self.path, f)
+
+    def opener(self, f, mode='r'):
+        return open(self.join(f), mode + 'b')
+
+def readstagedprojrc(repo):
+    """return the (token, rev, data) of the projrc staged by "hg projrc
+    watch", or None if there is none"""
+    try:
+        fp = open(repo_join(repo, 'projrc.staged'), 'rb')
+        try:
+            token, rev, data = fp.read().split('\n', 2)
+        finally:
+            fp.close()
+    except (IOError, ValueError):
+        return None
+    if not rev.isdigit():
+        rev = None
+    else:
+        rev = int(rev)
+    return token or None, rev, data
+
+def writestagedprojrc(repo, token, rev, data):
+    """stage a new projrc file, for the next command to install"""
+    fp = util.atomictempfile(repo_join(repo, 'projrc.staged'), 'wb')
+    fp.write('%s\n%s\n' % (token or '', rev is not None and rev or ''))
+    fp.write(data)
+    fp.close()
+
+def applystagedprojrc(ui, root):
+    """install the projrc file staged by "hg projrc watch" in root
+
+    Nothing happens if changes of the projrc must be confirmed: the next
+    pull prompts for them as usual.
+    """
+    repo = hgdir(os.path.join(root, '.hg'))
+    if not os.path.exists(repo_join(repo, 'projrc.staged')):
+        return
+    projrc = repo_join(repo, 'projrc')
+    # The projrc.confirm setting may come from the repository hgrc
+    lui = ui.copy()
+    lui.readconfig(repo_join(repo, 'hgrc'), root)
+    if mustconfirm(lui, os.path.exists(projrc)):
+        return
+    staged = readstagedprojrc(repo)
+    if staged is None:
+        return
+    token, rev, data = staged
+    try:
+        fp = util.atomictempfile(projrc, 'wb')
+        fp.write(data)
+        fp.close()
+        storeprojrc(lui, repo)
+        writeprojrctoken(repo, token, rev)
+        parseprojrc(projrc, updatecache=True)
+    except (IOError, OSError, error.ParseError), e:
+        ui.warn(_("could not install the staged projrc file: %s\n") % e)
+        return
+    ui.status(_("projrc settings file updated\n"))
+
+# The first line of the .hg/projrc files that refer to an entry of the
+# projrc store (see storeprojrc)
+STOREREFERENCE = "# projrc settings shared through the projrc store\n"
+
+def projrcstore(ui):
+    """return the directory of the projrc store, or None if it is not used
+
+    projrc.store is either a boolean, True meaning ~/.cache/hg-projrc (or
+    hg-projrc in $XDG_CACHE_HOME), or the path of the store.
+    """
+    store = ui.config('projrc', 'store')
+    if not store:
+        return None
+    enabled = util.parsebool(store)
+    if enabled is False:
+        return None
+    if enabled is True:
+        cache = os.environ.get('XDG_CACHE_HOME') or os.path.join('~', '.cache')
+        store = os.path.join(cache, 'hg-projrc')
+    return os.path.abspath(util.expandpath(store))
+
+def readstorereference(projrc, fp=None):
+    """return the projrc store entry that projrc refers to, or None
+
+    An open fp of projrc is rewound after reading the reference.
+    """
+    if fp is None:
+        try:
+            fp = open(projrc, 'rb')
+        except IOError:
+            return None
+        try:
+            return readstorereference(projrc, fp)
+        finally:
+            fp.close()
+    head = fp.read(len(STOREREFERENCE) + 4096)
+    fp.seek(0)
+    if not head.startswith(STOREREFERENCE):
+        return None
+    line = head[len(STOREREFERENCE):].split('\n', 1)[0]
+    if not line.startswith('%include '):
+        return None
+    return line[len('%include '):].strip()
+
+def localprojrcpath(repo):
+    """return the path of the file that holds the local projrc settings"""
+    projrc = repo_join(repo, 'projrc')
+    return readstorereference(projrc) or projrc
+
+def storerefname(projrc):
+    return hashlib.sha1(projrc).hexdigest()
+
+def storeprojrc(ui, repo):
+    """move the local projrc file of repo into the projrc store
+
+    The store keeps each projrc file, and its parse, once in a directory
+    named after the hash of its contents. The .hg/projrc file becomes a
+    reference to it, which %includes it (so the settings stay readable
+    without the extension). The repositories that use an entry are
+    listed in its refs directory, for "hg projrc gc". Nothing happens
+    unless projrc.store is set.
+    """
+    store = projrcstore(ui)
+    if store is None:
+        return
+    projrc = os.path.abspath(repo_join(repo, 'projrc'))
+    try:
+        fp = open(projrc, 'rb')
+        try:
+            if readstorereference(projrc, fp) is not None:
+                return
+            data = fp.read()
+        finally:
+            fp.close()
+        entrydir = os.path.join(store, hashlib.sha1(data).hexdigest())
+        entry = os.path.join(entrydir, 'projrc')
+        refs = os.path.join(entrydir, 'refs')
+        if not os.path.isdir(refs):
+            os.makedirs(refs)
+        # The repository is listed before it refers to the entry, so that
+        # "hg projrc gc" never removes an entry that is being referred to
+        fp = open(os.path.join(refs, storerefname(projrc)), 'wb')
+        fp.write(projrc)
+        fp.close()
+        if not os.path.exists(entry):
+            fp = util.atomictempfile(entry, 'wb')
+            fp.write(data)
+            fp.close()
+            parseprojrc(entry, updatecache=True)
+        fp = util.atomictempfile(projrc, 'wb')
+        fp.write('%s%%include %s\n' % (STOREREFERENCE, entry))
+        fp.close()
+    except (IOError, OSError, error.ParseError), e:
+        ui.warn(_("could not move the projrc file to the projrc store: %s\n")
+                % e)
+        return
+    ui.debug('projrc: stored as %s\n' % entry)
+
+def decoderemoteprojrc(ui, projrc):
+    """decode and check the projrc payload sent by a server
+
+    projrc is the result of listkeys('projrc'). This returns a
+    (config, valid) tuple, where config is None if there is no payload.
+    """
+    if 'data' not in projrc:
+        return None, True
+    start = time.time()
+    if projrc.get('format') == '2':
+        # The v2 wire format does not escape the data
+        data = projrc['data']
+    else:
+        data = projrc['data'].decode('string-escape')
+        if data.startswith("#\\\\ "):
+            data = data.decode('string-escape')
+    # verify that we can parse the file we got
+    try:
+        c = config.config()
+        c.parse('projrc', data)
+    except error.ParseError, e:
+        ui.warn(_("not saving retrieved projrc file: "
+                  "parse error at '%s' on %s\n") % e.args)
+        return None, False
+    recordtiming(ui, 'decode', start)
+    return c, True
+
+def iterprojrc(conf, includedkeys, excludedkeys):
+    """generate the local projrc file contents for a remote config"""
+    # Filter the received config, only allowing the sections that
+    # the user has specified in any of its hgrc files
+    return itertools.chain([ENCODING_CHECK],
+        iterserializeconfig(conf, includedkeys, excludedkeys))
+
+def filterremoteprojrc(ui, projrc, includedkeys, excludedkeys):
+    """decode, check and filter the projrc payload sent by a server
+
+    projrc is the result of listkeys('projrc'). This returns the same
+    (data, valid) tuple as getremoteprojrc.
+    """
+    c, valid = decoderemoteprojrc(ui, projrc)
+    if c is None:
+        return None, valid
+    start = time.time()
+    data = ''.join(iterprojrc(c, includedkeys, excludedkeys))
+    recordtiming(ui, 'filter', start)
+    return data, valid
+
+def isprojrcserver(ui, other):
+    """True if we may get a projrc file from the other repository"""
+    try:
+        remotepath = other.root
+        remotepath = os.path.normcase(util.normpath(remotepath))
+    except:
+        # Non local repos have no root property
+        remotepath = other.url()
+        if remotepath.startswith('file:'):
+            remotepath = remotepath[5:]
+
+    return getservermatcher(ui)(remotepath)
+
+def listremoteprojrc(other):
+    """return other.listkeys('projrc'), asking the other repository once
+
+    The result is remembered on the peer, so that it can still be used
+    after the connection has been closed (see peer).
+    """
+    try:
+        return other._projrckeys
+    except AttributeError:
+        start = time.time()
+        keys = other.listkeys('projrc')
+        recordtiming(getattr(other, 'ui', None), 'listkeys', start)
+        try:
+            other._projrckeys = keys
+        except AttributeError:
+            pass
+        return keys
+
+def applyprojrcdelta(ui, repo, projrc):
+    """apply the changes sent by a server to the local projrc file
+
+    projrc holds the changes since a revision of the server's projrc
+    (see projrcdelta). Return the resulting config, or None if they could
+    not be applied.
+    """
+    start = time.time()
+    c = config.config()
+    try:
+        c.read(repo_join(repo, 'projrc'))
+        delta = projrc['delta']
+        if projrc.get('format') != '2':
+            delta = delta.decode('string-escape')
+        c.parse('projrc', delta)
+    except (IOError, error.ParseError):
+        return None
+    recordtiming(ui, 'decode', start)
+    ui.debug('projrc: applied the changes since revision %s\n'
+             % projrc['since'])
+    return c
+
 def getremoteprojrc(ui, repo, other):
     """
     Get the contents of a remote projrc and check that they are valid
@@ -349,163 +1341,584 @@ def getremoteprojrc(ui, repo, other):
     Note that it is possible to return (None, True), which simply means
     that no data matching the projrc filter settings was found.
     """
-    if not repo.local():
-        return None, True
+    return fetchremoteprojrc(ui, repo, other)[:2]
 
-    # Get the list of repos that we are supposed to get a projrc file from
-    # (i.e. the projrc "servers")
-    projrcserverset = getprojrcserverset(ui)
+def fetchremoteprojrc(ui, repo, other, stream=False):
+    """like getremoteprojrc, but also return the token and the revision
+    of the payload
 
-    try:
-        remotepath = other.root
-        remotepath = os.path.normcase(util.normpath(remotepath))
-    except:
-        # Non local repos have no root property
-        remotepath = other.url()
-        if remotepath.startswith('file:'):
-            remotepath = remotepath[5:]
+    The token is None if the server does not publish a content hash, and
+    the revision is None if it does not number its projrc revisions. When
+    the token matches the one of the local projrc file, the payload is
+    not decoded, parsed nor filtered: the local projrc contents are
+    returned instead.
+
+    If the server only sent the changes since the revision of the local
+    projrc file, they are applied to it. The full projrc is requested if
+    the local file did not come from that revision.
+
+    With stream, the projrc contents are returned as an iterator of
+    chunks rather than as a string.
+    """
+    if not repo.local():
+        return None, True, None, None
 
-    if '*' not in projrcserverset and \
-            not findpatternmatch(remotepath, projrcserverset)[0] and \
-            not ("localhost" in projrcserverset and islocalpath(remotepath)):
+    if not isprojrcserver(ui, other):
         # The pull source is not on the projrc server list
         # Note that we keep any existing local projrc file, which may have been
         # transferred from another valid server
-        return None, True
+        return None, True, None, None
 
     # Get the list of remote keys that we must load from the remote projrc file
     includedkeys, excludedkeys = getallowedkeys(ui)
     if includedkeys or excludedkeys:
-        projrc = other.listkeys('projrc')
+        projrc = listremoteprojrc(other)
     else:
         # There are no remote keys to load
         projrc = {} # This ensures that any existing projrc file will be deleted
 
-    data = None
-    valid = True
-    if 'data' in projrc:
-        data = projrc['data'].decode('string-escape')
-        if data.startswith("#\\\\ "):
-            data = data.decode('string-escape')
-        # verify that we can parse the file we got, and filter it according
-        # to the local projrc extension settings
+    token = rev = None
+    if 'hash' in projrc:
+        token = projrctoken(projrc['hash'], includedkeys, excludedkeys)
+        if projrc.get('rev', '').isdigit():
+            rev = int(projrc['rev'])
+        if hasattr(localrepo, 'localpeer'):
+            # hg >= 2.3
+            repo = repo.local()
+        localtoken = readprojrctoken(repo)
+        if token == localtoken:
+            # This is the payload that the local projrc file came from
+            if stream:
+                return iterfile(localprojrcpath(repo)), True, token, rev
+            return readcurrentprojrc(repo), True, token, rev
+
+        c = None
+        if 'delta' in projrc:
+            if localtoken == projrctoken(projrc.get('base'), includedkeys,
+                                         excludedkeys):
+                c = applyprojrcdelta(ui, repo, projrc)
+            if c is None:
+                # Get the full projrc after all
+                try:
+                    del other._projrckeys
+                except AttributeError:
+                    pass
+                return fetchremoteprojrc(ui, repo, other, stream)
+        if c is not None:
+            chunks = iterprojrc(c, includedkeys, excludedkeys)
+            if not stream:
+                chunks = ''.join(chunks)
+            return chunks, True, token, rev
+
+    if not stream:
+        data, valid = filterremoteprojrc(ui, projrc, includedkeys,
+                                         excludedkeys)
+        return data, valid, token, rev
+    c, valid = decoderemoteprojrc(ui, projrc)
+    if c is None:
+        return None, valid, token, rev
+    return iterprojrc(c, includedkeys, excludedkeys), valid, token, rev
+
+class timedchunks(object):
+    """iterate over chunks, adding up the time spent producing them
+
+    This separates the time of a lazy producer (e.g. the filtering of
+    iterprojrc) from the time of its consumer.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self.seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = time.time()
         try:
-            c = config.config()
-            c.parse('projrc', data)
-            # Filter the received config, only allowing the sections that
-            # the user has specified in any of its hgrc files
-            data = ENCODING_CHECK + \
-                serializeconfig(c, includedkeys, excludedkeys)
-        except error.ParseError, e:
-                ui.warn(_("not saving retrieved projrc file: "
-                          "parse error at '%s' on %s\n") % e.args)
-                valid = False
-    return data, valid
+            return self._chunks.next()
+        finally:
+            self.seconds += time.time() - start
 
-def transferprojrc(ui, repo, other, confirmupdate=None):
-    data, valid = getremoteprojrc(ui, repo, other)
-    if not valid or data is None:
-        return
+def iterfile(path, size=65536):
+    """generate the contents of path in chunks"""
+    fp = open(path, 'rb')
+    try:
+        while True:
+            chunk = fp.read(size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        fp.close()
 
-    if data != "":
-        # Compare the old projrc with the new one
+def mustconfirm(ui, projrcexists):
+    """Read the projrc.confirm setting.
+
+    Valid values are:
+    - true: Always ask for confirmation
+    - first: Ask for confirmation when the projrc file
+             is transferred for the first time
+    - false: Do not ask for confirmation
+             (i.e. accept all projrc changes)
+
+    Note that you can use any valid 'boolean' value
+    instead of true and false (i.e. always, yes, on or 1
+    instead of true and never, no, off or 0 instead of false)
+    """
+    confirmchanges = ui.config(
+        'projrc', 'confirm', default=True)
+
+    if isinstance(confirmchanges, bool):
+        return confirmchanges
+    confirm = util.parsebool(confirmchanges)
+    if not confirm is None:
+        return confirm
+    confirmchanges = confirmchanges.lower()
+    if projrcexists and confirmchanges == "first":
+        return False
+    return True
+
+# Serializes the loading of transferred extensions, which changes the
+# global extension state
+_loadlock = threading.Lock()
+
+def configuredextensions(ui):
+    """return the names of the extensions enabled in the [extensions] section"""
+    return set(name for name, path in ui.configitems('extensions')
+               if not path.startswith('!'))
+
+def projrcextensions(ui, layer):
+    """return the extensions of a projrc layer that are enabled in ui"""
+    return [name for name in layer['extensions']
+            if not (ui.config('extensions', name) or '').startswith('!')]
+
+def _shortname(name):
+    if name.startswith('hgext.') or name.startswith('hgext/'):
+        return name[6:]
+    return name
+
+def _loadallwhitelist():
+    try:
+        return 'whitelist' in inspect.getargspec(extensions.loadall)[0]
+    except TypeError:
+        return False
+
+def loadextensions(ui, names=None):
+    """load the configured extensions that have not been loaded yet
+
+    Only the extensions in names are considered, if it is given. Only the
+    new extensions are imported and set up and have their command table
+    merged, instead of going through every configured extension again.
+    Return the names of the newly loaded extensions.
+    """
+    if names is None:
+        names = configuredextensions(ui)
+    builtin = getattr(extensions, '_builtin', ())
+    names = [n for n in names if _shortname(n) not in extensions._extensions
+             and _shortname(n) not in builtin]
+    if not names:
+        return []
+
+    _loadlock.acquire()
+    try:
+        # The extensions are loaded in order, so the new ones come last
+        first = len(extensions._order)
+        start = time.time()
+        if _loadallwhitelist():
+            # hg >= 4.3
+            extensions.loadall(ui, whitelist=names)
+        else:
+            extensions.loadall(ui)
+        recordtiming(ui, 'loadall', start)
+        new = [(name, extensions._extensions[name])
+               for name in extensions._order[first:]
+               if extensions._extensions.get(name) is not None]
+        if hasattr(dispatch, "_loaded"):
+            # older hg merges the command tables after extsetup, using
+            # dispatch._loaded to tell which ones were merged
+            for name, module in new:
+                if name in dispatch._loaded:
+                    continue
+                cmdtable = getattr(module, 'cmdtable', {})
+                overrides = [cmd for cmd in cmdtable if cmd in commands.table]
+                if overrides:
+                    ui.warn(_("extension '%s' overrides commands: %s\n")
+                            % (name, " ".join(overrides)))
+                commands.table.update(cmdtable)
+                dispatch._loaded.add(name)
+        return [name for name, module in new]
+    finally:
+        _loadlock.release()
+
+class sourcepeer(object):
+    """the projrc keys sent by a projrc source, standing for its peer"""
+    def __init__(self, url, keys):
+        self._url = url
+        self._projrckeys = keys
+
+    def url(self):
+        return self._url
+
+    def local(self):
+        return None
+
+def fetchsourceprojrc(ui, source):
+    """return the (url, listkeys('projrc')) of a projrc source
+
+    The keys are None if the source is not on the projrc.servers list.
+    """
+    other = hg.peer(ui, {}, source)
+    try:
+        if not isprojrcserver(ui, other):
+            return other.url(), None
+        return other.url(), other.listkeys('projrc')
+    finally:
+        if hasattr(other, 'close'):
+            other.close()
+
+def selectprojrcsource(ui, other):
+    """ask the projrc.sources for their projrc concurrently
+
+    The first source that sends a projrc is used: the revision numbers
+    of different servers count different histories, so they cannot tell
+    which projrc is the newest. The projrc that other sent along with the
+    pulled changes (see pull), if any, wins right away: the sources are
+    not asked at all, and other is returned, so that a delta that it
+    sent gets applied as usual.
+
+    Sources that do not answer within projrc.sourcetimeout seconds (10 by
+    default) are abandoned: their threads are left to finish on their
+    own, and their answer is ignored. Return a sourcepeer, or None if no
+    source sent a projrc.
+    """
+    keys = getattr(other, '_projrckeys', None)
+    if keys and isprojrcserver(ui, other):
+        ui.debug('projrc: using the projrc of %s\n' % other.url())
+        return other
+
+    sources = [ui.expandpath(s) for s in ui.configlist('projrc', 'sources')]
+    timeout = float(ui.config('projrc', 'sourcetimeout', default=10))
+    replies = Queue.Queue()
+    def fetch(n, source):
+        sui = ui.copy()
+        sui.pushbuffer(error=True)
         try:
-            if hasattr(localrepo, 'localpeer'):
-                # hg >= 2.3
-                repo = repo.local()
-            olddata = readcurrentprojrc(repo)
-            
-            if olddata != data:
-                def mustconfirm(projrcexists):
-                    """Read the projrc.confirm setting.
-
-                    Valid values are:
-                    - true: Always ask for confirmation
-                    - first: Ask for confirmation when the projrc file
-                             is transferred for the first time
-                    - false: Do not ask for confirmation
-                             (i.e. accept all projrc changes)
-
-                    Note that you can use any valid 'boolean' value
-                    instead of true and false (i.e. always, yes, on or 1
-                    instead of true and never, no, off or 0 instead of false)
-                    """
-                    confirmchanges = ui.config(
-                        'projrc', 'confirm', default=True)
-
-                    if isinstance(confirmchanges, bool):
-                        return confirmchanges
-                    confirm = util.parsebool(confirmchanges)
-                    if not confirm is None:
-                        return confirm
-                    confirmchanges = confirmchanges.lower()
-                    if projrcexists and confirmchanges == "first":
-                        return False
-                    return True
-
-                if confirmupdate is None:
-                    confirmupdate = mustconfirm(olddata != "")
-                acceptnewconfig = True
-                if confirmupdate:
-                    confirmmsg = \
-                        _("The project settings file (projrc) has changed.\n"
-                        "Do you want to update it? (y/n)")
-                    YES = _('&Yes')
-                    NO = _('&No')
-                    try:
-                        # hg < 2.7
-                        action = ui.promptchoice(confirmmsg,
-                            (YES, NO), default=0)
-                    except TypeError, ex:
-                        # hg >= 2.7+
-                        action = ui.promptchoice(confirmmsg \
-                            + _(" $$ %s $$ %s") % (YES, NO), default=0)
-                    acceptnewconfig = (action == 0)
-                if acceptnewconfig:
-                    # If there are changes and the user accepts them, save the new projrc
-                    repo_write(repo, 'projrc', data)
-
-                    # and take any transferred settings into account
-                    try:
-                        loadprojrc(repo.ui, repo_join(repo,'projrc'), repo.root)
-                        extensions.loadall(repo.ui)
-                        ui.status(_("projrc settings file updated and applied\n"))
-                    except IOError:
-                        ui.warn(_("projrc settings file updated but could not be applied\n"))
-
-        except error.ParseError, e:
-            ui.warn(_("not saving retrieved projrc file: "
-                      "parse error at '%s' on %s\n") % e.args)
-    else:
-        if os.path.exists(repo_join(repo, 'projrc')):
-            os.unlink(repo_join(repo, 'projrc'))
+            url, keys = fetchsourceprojrc(sui, source)
+        except Exception, e:
+            # Whatever the error, the source must answer, or the pull
+            # would wait for it until projrc.sourcetimeout
+            replies.put((n, source, None, str(e) or e.__class__.__name__))
+            return
+        replies.put((n, url, keys, None))
+    for n, source in enumerate(sources):
+        t = threading.Thread(target=fetch, args=(n, source))
+        t.setDaemon(True)
+        t.start()
+
+    deadline = time.time() + timeout
+    answered = set()
+    while len(answered) < len(sources):
+        try:
+            n, url, keys, err = replies.get(
+                timeout=max(0, deadline - time.time()))
+        except Queue.Empty:
+            for n, source in enumerate(sources):
+                if n not in answered:
+                    ui.warn(_("projrc source %s did not answer in time\n")
+                            % source)
+            break
+        answered.add(n)
+        if err is not None:
+            ui.warn(_("projrc source %s failed: %s\n") % (url, err))
+            continue
+        if keys and 'data' in keys:
+            ui.debug('projrc: using the projrc of %s\n' % url)
+            return sourcepeer(url, keys)
+    return None
+
+def transferprojrc(ui, repo, other, confirmupdate=None, interactive=True,
+                   apply=True):
+    """fetch the remote projrc and save it as the local projrc file
+
+    When interactive is False, changes that need a confirmation are
+    declined instead of prompting. When apply is False, the new settings
+    are saved but not loaded into repo.ui.
+
+    Return 'updated', 'unchanged', 'declined' or 'invalid',
+    or None if other does not send a projrc to this repository.
+    """
+    if ui.configlist('projrc', 'sources'):
+        other = selectprojrcsource(ui, other)
+        if other is None:
+            return None
+    data, valid, token, rev = fetchremoteprojrc(ui, repo, other, stream=True)
+    if not valid:
+        return 'invalid'
+    if data is None:
+        return None
+
+    if hasattr(localrepo, 'localpeer'):
+        # hg >= 2.3
+        repo = repo.local()
+
+    projrc = repo_join(repo, 'projrc')
+    if token is not None and token == readprojrctoken(repo):
+        # The local projrc file came from this payload
+        return 'unchanged'
+
+    # Compare the old projrc with the new one while writing the new one
+    # to a temporary file, without holding either of them in memory
+    try:
+        start = time.time()
+        fp = util.atomictempfile(projrc, 'wb')
+        chunks = timedchunks(data)
+        try:
+            changed = writechunks(fp, chunks, localprojrcpath(repo))
+        except:
+            fp.discard()
+            raise
+        recordduration(ui, 'filter', chunks.seconds)
+        if not changed:
+            fp.discard()
+            if (token, rev) != readprojrcstate(repo):
+                writeprojrctoken(repo, token, rev)
+            return 'unchanged'
+
+        try:
+            if confirmupdate is None:
+                projrcexists = os.path.exists(projrc) and \
+                    os.path.getsize(projrc) > 0
+                confirmupdate = mustconfirm(ui, projrcexists)
+            acceptnewconfig = True
+            if confirmupdate and not interactive:
+                acceptnewconfig = False
+            elif confirmupdate:
+                confirmmsg = \
+                    _("The project settings file (projrc) has changed.\n"
+                    "Do you want to update it? (y/n)")
+                YES = _('&Yes')
+                NO = _('&No')
+                try:
+                    # hg < 2.7
+                    action = ui.promptchoice(confirmmsg,
+                        (YES, NO), default=0)
+                except TypeError, ex:
+                    # hg >= 2.7+
+                    action = ui.promptchoice(confirmmsg \
+                        + _(" $$ %s $$ %s") % (YES, NO), default=0)
+                acceptnewconfig = (action == 0)
+        except:
+            fp.discard()
+            raise
+        if not acceptnewconfig:
+            fp.discard()
+            return 'declined'
+
+        # If there are changes and the user accepts them, save the new projrc
+        fp.close()
+        storeprojrc(ui, repo)
+        writeprojrctoken(repo, token, rev)
+        parseprojrc(projrc, updatecache=True)
+        recordduration(ui, 'write', time.time() - start - chunks.seconds)
+        if not apply:
+            ui.status(_("projrc settings file updated\n"))
+            return 'updated'
+
+        # and take any transferred settings into account
+        try:
+            layer = loadprojrc(repo.ui, projrc, repo.root)
+            if layer is not None and layer['extensions']:
+                # Only the extensions of the projrc can be new, there is
+                # no need to go through all the configured ones
+                loadextensions(repo.ui, projrcextensions(repo.ui, layer))
+            ui.status(_("projrc settings file updated and applied\n"))
+        except IOError:
+            ui.warn(_("projrc settings file updated but could not be applied\n"))
+        return 'updated'
+
+    except error.ParseError, e:
+        ui.warn(_("not saving retrieved projrc file: "
+                  "parse error at '%s' on %s\n") % e.args)
+        return 'invalid'
+
+def subreposources(repo, node):
+    """return the (path, source) of the hg subrepositories of revision node
+
+    Relative sources are resolved against the default path of repo, like
+    the subrepo module does when it clones them.
+    """
+    try:
+        substate = repo[node].substate
+    except (error.ParseError, abort, error.RepoError):
+        return []
+    parent = repo.ui.config('paths', 'default')
+    sources = []
+    for path, (source, rev, kind) in sorted(substate.items()):
+        if kind != 'hg' or not rev.strip('0'):
+            # Subrepositories at the null revision are not cloned
+            continue
+        url = util.url(source)
+        if not url.isabs():
+            if not parent:
+                continue
+            url.path = posixpath.normpath(url.path or '')
+            parenturl = util.url(util.pconvert(parent))
+            parenturl.path = posixpath.normpath(
+                posixpath.join(parenturl.path or '', url.path))
+            source = str(parenturl)
+        sources.append((path, source))
+    return sources
+
+def fetchsubrepoprojrc(ui, repo, source):
+    """get the projrc of the subrepository of repo at source
+
+    Return a (peer, keys, error) tuple. The peer is left open, for the
+    clone of the subrepository to use (see peer). keys is None when the
+    projrc must not be fetched from there, or when it comes with the
+    changes that clone pulls anyway (see pull).
+    """
+    ui = ui.copy()
+    ui.setconfig('ui', 'interactive', 'off', 'projrc')
+    ui.pushbuffer(error=True)
+    try:
+        try:
+            other = hg.peer(ui, {}, source)
+            try:
+                if not isprojrcserver(ui, other) or \
+                        supportsprojrcpart(repo, other):
+                    return other, None, None
+                return other, listremoteprojrc(other), None
+            except:
+                if hasattr(other, 'close'):
+                    other.close()
+                raise
+        except (error.RepoError, abort, IOError, OSError), e:
+            return None, None, str(e)
+    finally:
+        ui.popbuffer()
+
+def prefetchsubrepoprojrc(ui, repo, node, state):
+    """fetch the projrc of the subrepositories of node concurrently
+
+    Clones of large superprojects create their subrepositories one at a
+    time while updating. Their projrc files are fetched beforehand, on
+    projrc.jobs threads, and stored in the subrepos of the clonestate by
+    peer url, as (subrepo path, projrc keys, results) tuples, for when
+    each subrepository gets cloned. The peers are kept in its peers, so
+    that the subrepositories are cloned over the same connections.
+    Return the list of (path, result) of the subrepositories, which the
+    clones of the subrepositories fill in.
+    """
+    sources = subreposources(repo, node)
+    if not sources:
+        return []
+    jobs = int(ui.config('projrc', 'jobs', default=4))
+    fetched = runparallel(
+        lambda (path, source): fetchsubrepoprojrc(ui, repo, source),
+        sources, jobs)
+    results = []
+    for (path, source), (other, keys, err) in zip(sources, fetched):
+        if err is not None:
+            results.append((path, err))
+        else:
+            state.subrepos[other.url()] = (path, keys, results)
+            state.peers[source] = other
+    return results
+
+def reportsubrepoprojrc(ui, results):
+    """summarize what happened to the projrc of the cloned subrepositories"""
+    updated = failed = 0
+    for path, result in results:
+        ui.note(_("projrc: subrepository %s: %s\n")
+                % (path, result or 'skipped'))
+        if result == 'updated':
+            updated += 1
+        elif result not in ('unchanged', 'declined', None):
+            failed += 1
+    report = ui.note
+    if updated or failed:
+        report = ui.status
+    report(_("projrc: %d subrepositories, %d updated, %d failed\n")
+           % (len(results), updated, failed))
+
+class clonestate(object):
+    """what the projrc handling of one hg.clone call keeps until its end"""
+    def __init__(self):
+        # Whether hg.update calls are recorded instead of run
+        self.deferring = True
+        # The revision that hg.clone wanted to update to
+        self.node = None
+        # peer url -> (subrepo path, projrc keys, results), filled by
+        # prefetchsubrepoprojrc for the clones of the subrepositories
+        self.subrepos = {}
+        # source -> the peer opened by prefetchsubrepoprojrc, which the
+        # clone of the subrepository uses instead of opening another one
+        self.peers = {}
+
+    def close(self):
+        """close the prefetched peers that were not used"""
+        for other in self.peers.values():
+            if hasattr(other, 'close'):
+                other.close()
+        self.peers.clear()
+
+# The clones in progress in each thread, innermost last. Subrepositories
+# are cloned by the update of their parent, in the same thread.
+_clones = threading.local()
+
+def deferupdate(orig, repo, node, *args, **kwargs):
+    """record the update that ends hg.clone instead of doing it (see clone)
+
+    Updates that are not part of a clone of this thread are left alone.
+    """
+    stack = getattr(_clones, 'stack', None)
+    if stack and stack[-1].deferring:
+        stack[-1].node = node
+        return None
+    return orig(repo, node, *args, **kwargs)
 
 def clone(orig, ui, *args, **kwargs):
     # hg.clone calls hg._update as the very last thing. We need to
     # transfer the .hg/projrc file before this happens in order for it
-    # to take effect for things like subrepos. We do this by wrapping
-    # hg._update in our own function that just stores the target
-    # revision for later.
-
-    uprev = [None]
-    def update(orig, repo, node):
-        uprev[0] = node
-
-    origupdate = extensions.wrapfunction(hg, 'update', update)
-    hg._update = hg.update
-    src, dst = orig(ui, *args, **kwargs)
-    hg.update = origupdate
-    hg._update = hg.update
+    # to take effect for things like subrepos. deferupdate (which wraps
+    # hg._update for good) just stores the target revision for later
+    # while this thread is in clone. The state lives in this call, so
+    # that clones in other threads don't get in the way.
+    stack = getattr(_clones, 'stack', None)
+    if stack is None:
+        stack = _clones.stack = []
+
+    # Subrepositories pick up the projrc that was prefetched for them
+    subrepo = None
+    source = args[1:2] and args[1] or kwargs.get('source')
+    if stack and hasattr(source, 'url'):
+        subrepo = stack[-1].subrepos.pop(source.url(), None)
+        if subrepo is not None and subrepo[1] is not None:
+            source._projrckeys = subrepo[1]
+
+    state = clonestate()
+    stack.append(state)
+    try:
+        src, dst = orig(ui, *args, **kwargs)
+        state.deferring = False
 
-    transferprojrc(ui, dst, src)
+        result = transferprojrc(ui, dst, src)
+        if subrepo is not None:
+            subrepo[2].append((subrepo[0], result))
 
-    # We then do the update, if necessary.
-    if uprev[0]:
-        dstrepo = dst
-        if hasattr(localrepo, 'localpeer'):
-            # hg >= 2.3
-            dstrepo = dst.local()
-        origupdate(dstrepo, uprev[0])
+        # We then do the update, if necessary.
+        if state.node:
+            dstrepo = dst
+            if hasattr(localrepo, 'localpeer'):
+                # hg >= 2.3
+                dstrepo = dst.local()
+            results = prefetchsubrepoprojrc(ui, dstrepo, state.node, state)
+            hg.update(dstrepo, state.node)
+            if results:
+                reportsubrepoprojrc(ui, results)
+    finally:
+        stack.pop()
+        state.close()
     return src, dst
 
 def incoming(orig, ui, repo, srcpath, *args, **kwargs):
@@ -531,13 +1944,23 @@ def incoming(orig, ui, repo, srcpath, *args, **kwargs):
     will behave as if it was set to 'prompt'.
     """
 
-    res = orig(ui, repo, srcpath, *args, **kwargs)
+    pool = {}
+    outerpool = getattr(_peerpool, 'peers', None)
+    _peerpool.peers = pool
+    try:
+        res = orig(ui, repo, srcpath, *args, **kwargs)
+    finally:
+        _peerpool.peers = outerpool
 
     expandedpath = ui.expandpath(srcpath)
 
     if hasattr(localrepo, 'localpeer'):
         # hg >= 2.3
-        other = hg.peer(repo, {}, expandedpath)
+        # Reuse the peer that hg.incoming opened rather than connecting
+        # (and e.g. doing a full ssh handshake) once more
+        other = pool.get(hg.parseurl(expandedpath)[0])
+        if other is None:
+            other = hg.peer(repo, {}, expandedpath)
         localother = other.local()
         if localother is not None:
             other = localother
@@ -594,28 +2017,1022 @@ def incoming(orig, ui, repo, srcpath, *args, **kwargs):
 
     return res
 
+# The peers opened while running a command that needs the remote projrc
+# afterwards (see incoming), keyed by url, per thread
+_peerpool = threading.local()
+
+def peer(orig, uiorrepo, opts, path, *args, **kwargs):
+    """record the peers opened by incoming, prefetching their projrc
+
+    hg.incoming closes its peer before returning, so the projrc keys are
+    requested on the same connection as soon as it is open.
+
+    The subrepositories that a clone of this thread creates get the peer
+    that prefetchsubrepoprojrc opened for them.
+    """
+    stack = getattr(_clones, 'stack', None)
+    if stack and not args and not kwargs:
+        other = stack[-1].peers.pop(path, None)
+        if other is not None:
+            return other
+    other = orig(uiorrepo, opts, path, *args, **kwargs)
+    pool = getattr(_peerpool, 'peers', None)
+    if pool is not None:
+        pool[path] = other
+        ui = getattr(uiorrepo, 'ui', uiorrepo)
+        if other.local() is None and isprojrcserver(ui, other):
+            listremoteprojrc(other)
+    return other
+
+def supportsprojrcpart(repo, remote):
+    """True if the remote can send its projrc along with the changes that
+    repo pulls from it"""
+    if bundle2 is None or not hasattr(bundle2, 'bundle2caps') or \
+            'projrc' not in bundle2.getrepocaps(repo):
+        return False
+    return 'projrc' in bundle2.bundle2caps(remote)
+
+def getrepocaps(orig, repo, *args, **kwargs):
+    """add the projrc part and its wire formats to the bundle2 capabilities"""
+    caps = orig(repo, *args, **kwargs)
+    caps['projrc'] = tuple(['v2'] + wireengines())
+    return caps
+
 def pull(orig, repo, remote, *args, **kwargs):
+    if not supportsprojrcpart(repo, remote):
+        # Old servers need a separate listkeys round trip
+        transferprojrc(repo.ui, repo, remote)
+        return orig(repo, remote, *args, **kwargs)
+
+    # The projrc comes in the bundle2 reply to the pull, ahead of the
+    # changesets, and is applied before they are (see handleprojrcpart),
+    # so that its hooks and settings apply to this pull
+    unfi = repo.unfiltered()
+    unfi._projrcpull = [remote, False]
+    try:
+        res = orig(repo, remote, *args, **kwargs)
+        received = unfi._projrcpull[1]
+    finally:
+        del unfi._projrcpull
+    if not received:
+        # The server did not send it: ask for it with listkeys
+        transferprojrc(repo.ui, repo, remote)
+    return res
+
+def pullbundle2extraprepare(orig, pullop, kwargs):
+    """ask a projrc server for its projrc, and tell it which revision of
+    the projrc we already have"""
+    repo, remote = pullop.repo, pullop.remote
+    if supportsprojrcpart(repo, remote) and isprojrcserver(repo.ui, remote):
+        bundlecaps = set(kwargs.get('bundlecaps') or ())
+        bundlecaps.add('projrc')
+        rev = readprojrcstate(repo.unfiltered())[1]
+        if rev is not None:
+            bundlecaps.add('projrcrev=%d' % rev)
+        kwargs['bundlecaps'] = bundlecaps
+    return orig(pullop, kwargs)
+
+def getbundleprojrcpart(bundler, repo, source, bundlecaps=None, b2caps=None,
+                        **kwargs):
+    """add the projrc to the getbundle replies of the clients that want it
+
+    Only the clients that pull from this repository as a projrc server
+    ask for it (see pullbundle2extraprepare). Clients that have a
+    revision of the projrc only get the changes since then, if the
+    history of the projrc reaches back that far.
+    """
+    if b2caps and 'projrc' in b2caps and 'projrc' in (bundlecaps or ()):
+        keys = None
+        for cap in bundlecaps or ():
+            if cap.startswith('projrcrev=') and cap[10:].isdigit():
+                keys = projrcdelta(repo, int(cap[10:]))
+        if keys is None:
+            keys = listprojrc(repo)
+        part = bundler.newpart('projrc', mandatory=False)
+        clientcaps = b2caps['projrc']
+        engines = [e for e in wireengines() if e in clientcaps]
+        if 'v2' in clientcaps and engines and keys:
+            part.addparam('format', '2', mandatory=False)
+            part.data = projrcframe(keys, engines[0])
+        else:
+            part.data = pushkey.encodekeys(keys.items())
+
+def handleprojrcpart(op, part):
+    """apply the projrc sent by the server in the reply to a pull
+
+    The part contains the same keys that listkeys('projrc') returns, in
+    the v2 wire format if the client said that it supports it. It comes
+    before the changesets, so the new projrc already applies to them.
+    """
+    repo = op.repo
+    state = getattr(repo.unfiltered(), '_projrcpull', None)
+    if state is None or state[1]:
+        return
+    data = part.read()
+    if part.params.get('format') != '2':
+        keys = pushkey.decodekeys(data)
+    else:
+        try:
+            keys = decodeframe(data)
+        except ValueError, e:
+            # The pull wrapper asks for the projrc with listkeys instead
+            repo.ui.warn(_("ignoring invalid projrc payload: %s\n") % e)
+            return
+        repo.ui.debug('projrc: received a %d bytes %s payload\n'
+                      % (len(data), data[1:ord(data[0]) + 1]))
+    remote = state[0]
+    try:
+        remote._projrckeys = keys
+    except AttributeError:
+        pass
+    state[1] = True
     transferprojrc(repo.ui, repo, remote)
-    return orig(repo, remote, *args, **kwargs)
-    
+
 def pushprojrc(repo, key, old, new):
     return False
 
+# Version of the .hg/cache/projrc-wire file format
+WIRECACHEVERSION = 2
+
+class payloadcache(object):
+    """in-process cache of the encoded projrc payloads served by listprojrc
+
+    The payloads are keyed by projrc path and validated by the stat
+    signature of the projrc and of the files that it includes. Payloads
+    with identical contents are stored only once, however many
+    repositories serve them.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # projrc path -> (signature, payload hash, revision)
+        self._entries = {}
+        self._payloads = {} # payload hash -> [payload, reference count]
+
+    def get(self, projrc):
+        """return the (payload, hash, revision) cached for projrc, or None"""
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(projrc)
+            if entry is None:
+                return None
+            signature, payloadhash, rev = entry
+            payload = self._payloads[payloadhash][0]
+        finally:
+            self._lock.release()
+        if filesignature([e[0] for e in signature]) != signature:
+            return None
+        return payload, payloadhash, rev
+
+    def set(self, projrc, signature, payload, payloadhash, rev=None):
+        """cache payload and return the shared copy of its contents"""
+        self._lock.acquire()
+        try:
+            self._discard(projrc)
+            ref = self._payloads.setdefault(payloadhash, [payload, 0])
+            ref[1] += 1
+            self._entries[projrc] = (signature, payloadhash, rev)
+            return ref[0]
+        finally:
+            self._lock.release()
+
+    def discard(self, projrc):
+        self._lock.acquire()
+        try:
+            self._discard(projrc)
+        finally:
+            self._lock.release()
+
+    def _discard(self, projrc):
+        entry = self._entries.pop(projrc, None)
+        if entry is not None:
+            ref = self._payloads[entry[1]]
+            ref[1] -= 1
+            if not ref[1]:
+                del self._payloads[entry[1]]
+
+_payloadcache = payloadcache()
+
+def wirecachepath(repo):
+    return repo_join(repo, os.path.join('cache', 'projrc-wire'))
+
+def encodeprojrc(repo):
+    """serialize and encode the projrc of repo for the wire
+
+    Returns a (signature, payload, config) tuple, where signature is the
+    stat signature of the files that the payload was built from, and
+    config is None if the projrc could not be parsed.
+    """
+    projrc = repo_join(repo, 'projrc')
+    conf = recordingconfig()
+    try:
+        conf.read(projrc)
+        chunks = itertools.chain([ENCODING_CHECK], iterserializeconfig(conf))
+    except error.ParseError:
+        # Send broken file to client so that it can detect and
+        # report the error there.
+        chunks = iterfile(projrc)
+        conf = None
+    # string-escape works character by character, so the chunks can be
+    # encoded one at a time
+    data = ''.join([chunk.encode('string-escape') for chunk in chunks])
+    signature = filesignature(conf is not None and conf.readpaths or [projrc])
+    return signature, data, conf
+
 def listprojrc(repo):
-    if os.path.exists(repo_join(repo, 'projrc')):
+    projrc = repo_join(repo, 'projrc')
+    if not os.path.exists(projrc):
+        _payloadcache.discard(projrc)
+        return {}
+
+    cached = _payloadcache.get(projrc)
+    if cached is None:
+        # The optional on-disk wire file lets any server process return the
+        # payload without parsing the projrc
+        usewirecache = repo.ui.configbool('projrc', 'wirecache', False)
+        if usewirecache:
+            cached = readcachefile(wirecachepath(repo), WIRECACHEVERSION,
+                                   projrc)
+        if cached is not None:
+            signature, (payloadhash, rev), data = cached
+        else:
+            signature, data, conf = encodeprojrc(repo)
+            # The hash lets clients skip payloads that they already have
+            payloadhash = hashlib.sha1(data).hexdigest()
+            rev = None
+            if conf is not None:
+                rev = updateprojrchistory(repo, conf, payloadhash)
+            if usewirecache and not isambiguous(signature):
+                writecachefile(wirecachepath(repo), WIRECACHEVERSION,
+                               signature, (payloadhash, rev), data)
+        if not isambiguous(signature):
+            data = _payloadcache.set(projrc, signature, data, payloadhash,
+                                     rev)
+        cached = data, payloadhash, rev
+
+    data, payloadhash, rev = cached
+    keys = {'data': data, 'hash': payloadhash}
+    if rev is not None:
+        keys['rev'] = str(rev)
+    return keys
+
+def listprojrchash(repo):
+    """the listprojrc keys without the projrc itself, to check for changes"""
+    keys = listprojrc(repo)
+    keys.pop('data', None)
+    return keys
+
+# Version of the .hg/cache/projrc-history file format
+HISTORYVERSION = 1
+
+def historypath(repo):
+    return repo_join(repo, os.path.join('cache', 'projrc-history'))
+
+def readprojrchistory(repo):
+    """return the (revision, items, history) of the served projrc
+
+    items are the (section, key, value) settings of the current revision,
+    and history is a list of (revision, payload hash, changes) entries,
+    where changes are the (section, key, value) settings that changed
+    since the previous revision (value is None for removed settings).
+    """
+    try:
+        fp = open(historypath(repo), 'rb')
         try:
-            conf = config.config()
-            conf.read(repo_join(repo, 'projrc'))
-            data = ENCODING_CHECK + serializeconfig(conf)
-        except error.ParseError, e:
-            # Send broken file to client so that it can detect and
-            # report the error there.
-            print "error"
-            data = repo_read(repo, 'projrc')
-        return {'data': data.encode('string-escape')}
+            version, rev, items, history = marshal.load(fp)
+        finally:
+            fp.close()
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if version != HISTORYVERSION:
+        return None
+    return rev, items, history
+
+def updateprojrchistory(repo, conf, payloadhash):
+    """record the projrc as a new revision, unless it is the current one
+
+    Up to projrc.history revisions are kept (20 by default, 0 disables
+    the history). Return the revision number of the projrc, or None.
+    """
+    size = int(repo.ui.config('projrc', 'history', default=20))
+    if size <= 0:
+        return None
+    items = [(section, key, value)
+             for section in conf for key, value in conf.items(section)]
+    state = readprojrchistory(repo)
+    if state is None:
+        rev, olditems, history = 0, None, []
     else:
-        return {}
+        rev, olditems, history = state
+        if history and history[-1][1] == payloadhash:
+            return rev
+
+    changes = None
+    if olditems is not None:
+        old = dict(((section, key), value)
+                   for section, key, value in olditems)
+        changes = [(section, key, value) for section, key, value in items
+                   if old.pop((section, key), None) != value]
+        new = set((section, key) for section, key, value in items)
+        changes.extend([(section, key, None)
+                        for section, key, value in olditems
+                        if (section, key) not in new])
+        # Reordering the keys of a section changes the projrc too
+        def keyorder(items):
+            order = {}
+            for section, key, value in items:
+                order.setdefault(section, []).append(key)
+            return order
+        oldorder, neworder = keyorder(olditems), keyorder(items)
+        changed = set([section for section, key, value in changes])
+        for section, keys in sorted(neworder.items()):
+            if section not in changed and keys != oldorder.get(section):
+                changes.append((section, keys[0],
+                                conf.get(section, keys[0])))
+    rev += 1
+    history = (history + [(rev, payloadhash, changes)])[-size:]
+    try:
+        if not os.path.isdir(os.path.dirname(historypath(repo))):
+            os.makedirs(os.path.dirname(historypath(repo)))
+        fp = util.atomictempfile(historypath(repo), 'wb')
+        fp.write(marshal.dumps((HISTORYVERSION, rev, items, history)))
+        fp.close()
+    except (IOError, OSError):
+        # Without a history the clients get the full projrc
+        return None
+    return rev
+
+def projrcdelta(repo, since):
+    """return the listprojrc keys, with only the changes since a revision
+
+    The full projrc is replaced by a 'delta' key holding the changes as
+    projrc settings (using %unset for the removed ones), and a 'base'
+    key with the hash of the payload of revision since. Every setting of
+    a changed section is sent, in order, so that the client ends up with
+    the keys in the same order as the server (which e.g. decides the
+    order in which hooks run). Return None if the history does not reach
+    back to that revision.
+    """
+    keys = listprojrc(repo)
+    if 'rev' not in keys:
+        return None
+    state = readprojrchistory(repo)
+    if state is None or state[0] != int(keys['rev']):
+        return None
+    revs = [entry[0] for entry in state[2]]
+    if since not in revs:
+        return None
+    entries = state[2][revs.index(since):]
+    if None in [changes for rev, payloadhash, changes in entries[1:]]:
+        return None
+
+    # The sections changed by any of the revisions
+    changed = set()
+    for rev, payloadhash, changes in entries[1:]:
+        changed.update([section for section, key, value in changes])
+    current = {}
+    for section, key, value in state[1]:
+        current.setdefault(section, []).append((key, value))
+    lines = []
+    for section in sorted(changed):
+        lines.append('[%s]\n' % section)
+        # The section is rebuilt: its keys are removed, then set again
+        # in the order of the current revision
+        unset = set([key for key, value in current.get(section, [])])
+        for rev, payloadhash, changes in entries[1:]:
+            unset.update([key for s, key, value in changes if s == section])
+        for key in sorted(unset):
+            lines.append('%%unset %s\n' % key)
+        for key, value in current.get(section, []):
+            lines.append('%s = %s\n' % (key, value.replace('\n', '\n  ')))
+    return {'hash': keys['hash'], 'rev': keys['rev'], 'since': str(since),
+            'base': entries[0][1],
+            'delta': ''.join(lines).encode('string-escape')}
+
+# The version 2 wire format of the projrc keys, which bundle2 parts use
+# when the client supports it:
+#
+# - the length (1 byte) and name of the compression engine
+# - the sha1 of the uncompressed body (20 bytes)
+# - the length of the uncompressed body (4 bytes)
+# - the compressed body
+#
+# The body is a sequence of length prefixed (4 bytes) keys and values.
+# Unlike the listkeys values, 'data' and 'delta' are not string-escape'd:
+# the keys decoded from it have a 'format' key set to '2' to tell.
+
+def wireengines():
+    """return the compression engines of the v2 format, preferred first"""
+    engines = ['zlib', 'none']
+    if getzstd() is not None:
+        engines.insert(0, 'zstd')
+    return engines
+
+def encodeframe(keys, engine):
+    """encode listprojrc keys in the v2 wire format"""
+    body = []
+    for key, value in sorted(keys.items()):
+        if key in ('data', 'delta'):
+            value = value.decode('string-escape')
+        body.append('%s%s%s%s' % (struct.pack('>I', len(key)), key,
+                                  struct.pack('>I', len(value)), value))
+    body = ''.join(body)
+    if engine == 'zstd':
+        compressed = getzstd().ZstdCompressor(level=3).compress(body)
+    elif engine == 'zlib':
+        compressed = zlib.compress(body)
+    else:
+        compressed = body
+    return ''.join([chr(len(engine)), engine, hashlib.sha1(body).digest(),
+                    struct.pack('>I', len(body)), compressed])
+
+def decodeframe(frame):
+    """decode a v2 wire format frame (see encodeframe)
+
+    Raise ValueError if the frame is corrupted or uses an unknown
+    compression engine.
+
+    >>> frame = encodeframe({'data': 'b = c\\\\n', 'hash': 'abc'}, 'zlib')
+    >>> sorted(decodeframe(frame).items())
+    [('data', 'b = c\\n'), ('format', '2'), ('hash', 'abc')]
+    >>> frame = encodeframe({'data': 'b = c', 'hash': 'abc'}, 'none')
+    >>> decodeframe(frame[:-1] + 'x')
+    Traceback (most recent call last):
+    ...
+    ValueError: corrupted projrc payload
+    """
+    zstd = getzstd()
+    errors = (ValueError, IndexError, struct.error, zlib.error)
+    if zstd is not None:
+        errors += (zstd.ZstdError,)
+    try:
+        offset = ord(frame[0]) + 1
+        engine = frame[1:offset]
+        digest = frame[offset:offset + 20]
+        size = struct.unpack('>I', frame[offset + 20:offset + 24])[0]
+        compressed = buffer(frame, offset + 24)
+        if engine == 'zstd' and zstd is not None:
+            body = zstd.ZstdDecompressor().decompress(compressed,
+                                                      max_output_size=size)
+        elif engine == 'zlib':
+            body = zlib.decompress(compressed)
+        elif engine == 'none':
+            body = str(compressed)
+        else:
+            raise ValueError('unknown compression engine %r' % engine)
+        if len(body) != size or hashlib.sha1(body).digest() != digest:
+            raise ValueError('corrupted projrc payload')
+
+        keys = {}
+        offset = 0
+        while offset < size:
+            fields = []
+            for i in (0, 1):
+                length = struct.unpack('>I', body[offset:offset + 4])[0]
+                fields.append(body[offset + 4:offset + 4 + length])
+                offset += 4 + length
+            keys[fields[0]] = fields[1]
+    except errors, e:
+        raise ValueError(str(e))
+    keys['format'] = '2'
+    return keys
+
+# (payload hash, revision, engine) -> v2 frame of the full payloads
+_framecache = {}
+
+def projrcframe(keys, engine):
+    """return the v2 frame of listprojrc or projrcdelta keys
+
+    The frames of full payloads are kept, to serve them to many clients.
+    """
+    if 'delta' in keys:
+        return encodeframe(keys, engine)
+    key = (keys.get('hash'), keys.get('rev'), engine)
+    frame = _framecache.get(key)
+    if frame is None:
+        if len(_framecache) >= 32:
+            _framecache.clear()
+        frame = _framecache[key] = encodeframe(keys, engine)
+    return frame
+
+def findrepos(paths):
+    """return the roots of the repositories at or below the given paths
+
+    Paths that are neither a repository nor a directory are returned as
+    well, so that they can be reported as failures.
+    """
+    roots = []
+    for path in paths:
+        if os.path.isdir(os.path.join(path, '.hg')):
+            roots.append(path)
+        elif os.path.isdir(path):
+            roots.extend(sorted(walkrepos(path, followsym=True)))
+        else:
+            roots.append(path)
+    return roots
 
+def runparallel(func, items, jobs):
+    """call func on each of items, on a pool of jobs threads
+
+    Return the list of the results, in the order of items. If func raised
+    an exception for any item, the first one is raised again here, once
+    all the threads are done.
+    """
+    jobs = max(1, min(jobs, len(items)))
+    results = [None] * len(items)
+    pending = list(enumerate(items))
+    errors = []
+    lock = threading.Lock()
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if not pending:
+                    return
+                i, item = pending.pop(0)
+            finally:
+                lock.release()
+            try:
+                results[i] = func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+    threads = [threading.Thread(target=worker) for i in range(jobs)]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+def withdefaultpeer(ui, path, func):
+    """call func(repo, other) on the repository at path and its default path
+
+    Nothing is prompted. Return a (result, failed, output) tuple, where
+    result describes what happened (what func returned, or 'skipped' if
+    it returned None), failed is True if func returned 'invalid' or if
+    something went wrong, and output is what was written to the ui
+    meanwhile.
+    """
+    ui = ui.copy()
+    ui.setconfig('ui', 'interactive', 'off', 'projrc')
+    uis = [ui]
+    ui.pushbuffer(error=True)
+    result, failed = None, True
+    try:
+        repo = hg.repository(ui, path)
+        uis.append(repo.ui)
+        repo.ui.pushbuffer(error=True)
+        source = repo.ui.expandpath('default')
+        if source == 'default':
+            result = _('no default path')
+        else:
+            other = hg.peer(repo, {}, source)
+            try:
+                result = func(repo, other)
+            finally:
+                if hasattr(other, 'close'):
+                    other.close()
+            failed = result == 'invalid'
+            result = result or 'skipped'
+    except (error.RepoError, abort, IOError, OSError), e:
+        result = str(e)
+    except error.ParseError, e:
+        # e.g. a broken .hg/hgrc
+        if len(e.args) == 2:
+            result = _("parse error at '%s' on %s") % e.args
+        else:
+            result = _("parse error: %s") % e
+    return result, failed, ''.join([u.popbuffer() for u in uis])
+
+def syncrepoprojrc(ui, path, accept=False):
+    """fetch the projrc of the repository at path from its default path
+
+    Nothing is prompted: changes that need a confirmation are declined
+    unless accept is True. Return the same tuple as withdefaultpeer.
+    """
+    confirmupdate = None
+    if accept:
+        confirmupdate = False
+    def sync(repo, other):
+        return transferprojrc(repo.ui, repo, other,
+                              confirmupdate=confirmupdate,
+                              interactive=False, apply=False)
+    return withdefaultpeer(ui, path, sync)
+
+def projrcsync(ui, repo, *paths, **opts):
+    """update the projrc file of many repositories in parallel"""
+    if not paths:
+        if repo is None:
+            raise abort(_('no repositories specified'))
+        paths = [repo.root]
+    roots = findrepos(paths)
+
+    jobs = opts.get('jobs') or int(ui.config('projrc', 'jobs', default=4))
+    results = runparallel(lambda root: syncrepoprojrc(ui, root,
+                                                      opts.get('accept')),
+                          roots, jobs)
+
+    updated = failed = 0
+    for root, (result, failure, output) in zip(roots, results):
+        ui.write('%s: %s\n' % (root, result))
+        if output:
+            ui.note(''.join(['  %s\n' % l for l in output.splitlines()]))
+        if failure:
+            failed += 1
+        elif result == 'updated':
+            updated += 1
+    ui.status(_('%d repositories, %d updated, %d failed\n')
+              % (len(roots), updated, failed))
+    return failed and 1 or 0
+
+def stageprojrc(ui, repo, other):
+    """stage the projrc of other for repo, if it changed
+
+    Only the hash of the remote projrc is asked for, when the server can
+    send it on its own. The filtered projrc is fetched if it differs from
+    the local and the staged ones, and staged for applystagedprojrc.
+    Return 'staged', 'unchanged', 'invalid' or None if other is not a
+    projrc server.
+    """
+    if not isprojrcserver(ui, other):
+        return None
+    localtoken = readprojrctoken(repo)
+    staged = readstagedprojrc(repo)
+    keys = other.listkeys('projrc-hash')
+    if 'hash' in keys:
+        includedkeys, excludedkeys = getallowedkeys(ui)
+        token = projrctoken(keys['hash'], includedkeys, excludedkeys)
+        if token == localtoken:
+            return 'unchanged'
+        if staged is not None and token == staged[0]:
+            return 'staged'
+
+    data, valid, token, rev = fetchremoteprojrc(ui, repo, other)
+    if not valid:
+        return 'invalid'
+    if data is None:
+        return None
+    if token is not None and token == localtoken:
+        return 'unchanged'
+    if os.path.exists(repo_join(repo, 'projrc')) and \
+            data == readcurrentprojrc(repo):
+        writeprojrctoken(repo, token, rev)
+        return 'unchanged'
+    writestagedprojrc(repo, token, rev, data)
+    return 'staged'
+
+def watchdelay(interval, failures, jitter):
+    """return the delay until the next check of a repository
+
+    The checks that failed are retried after exponentially longer delays,
+    up to 16 intervals. jitter, a random number between 0 and 1, spreads
+    the checks of many clients over an extra tenth of the delay.
+
+    >>> watchdelay(300, 0, 0.5)
+    315.0
+    >>> watchdelay(300, 3, 0)
+    2400.0
+    >>> watchdelay(300, 10, 0)
+    4800.0
+    """
+    return interval * min(2 ** failures, 16) * (1 + jitter / 10.0)
+
+def projrcwatch(ui, repo, *paths, **opts):
+    """poll the projrc of many repositories and stage the changes"""
+    if not paths:
+        if repo is None:
+            raise abort(_('no repositories specified'))
+        paths = [repo.root]
+    roots = findrepos(paths)
+
+    jobs = opts.get('jobs') or int(ui.config('projrc', 'jobs', default=4))
+    interval = opts.get('interval') or \
+        float(ui.config('projrc', 'watchinterval', default=300))
+    failures = dict.fromkeys(roots, 0)
+    due = dict.fromkeys(roots, 0)
+    while True:
+        now = time.time()
+        batch = [root for root in roots if due[root] <= now]
+        results = runparallel(
+            lambda root: withdefaultpeer(ui, root,
+                lambda repo, other: stageprojrc(repo.ui, repo, other)),
+            batch, jobs)
+        for root, (result, failed, output) in zip(batch, results):
+            if failed:
+                failures[root] += 1
+                ui.warn('%s: %s\n' % (root, result))
+            elif result == 'staged':
+                failures[root] = 0
+                ui.status('%s: %s\n' % (root, result))
+            else:
+                failures[root] = 0
+                ui.note('%s: %s\n' % (root, result))
+            if output:
+                ui.debug(''.join(['  %s\n' % l for l in output.splitlines()]))
+            due[root] = time.time() + watchdelay(interval, failures[root],
+                                                 random.random())
+        if opts.get('once'):
+            return [r for r in roots if failures[r]] and 1 or 0
+        ui.flush()
+        time.sleep(max(0, min(due.values()) - time.time()))
+
+def publishrepoprojrc(root, payload):
+    """atomically write payload as the projrc file of the repository at root
+
+    The projrc caches of the repository are dropped, so that they are
+    rebuilt from the new file. Return 'updated', 'unchanged' or an error
+    message.
+    """
+    projrc = os.path.join(root, '.hg', 'projrc')
+    if not os.path.isdir(os.path.dirname(projrc)):
+        return _('repository %s not found') % root
+    try:
+        try:
+            fp = open(projrc, 'rb')
+            try:
+                if fp.read() == payload:
+                    return 'unchanged'
+            finally:
+                fp.close()
+        except IOError:
+            pass
+        fp = util.atomictempfile(projrc, 'wb')
+        fp.write(payload)
+        fp.close()
+        _payloadcache.discard(projrc)
+        for path in (parsedcachepath(projrc),
+                     os.path.join(root, '.hg', 'cache', 'projrc-wire')):
+            if os.path.exists(path):
+                os.unlink(path)
+    except (IOError, OSError), e:
+        return str(e).replace('\n', ' ')
+    return 'updated'
+
+def publishprojrc(payload, targets):
+    """publish payload to each (index, repository root) target
+
+    This runs in the worker processes; it yields (index, result) tuples.
+    """
+    for i, root in targets:
+        yield i, publishrepoprojrc(root, payload)
+
+def projrcpublish(ui, repo, source=None, *paths, **opts):
+    """write a projrc file into many repositories"""
+    if source is None:
+        raise abort(_('no projrc source specified'))
+    roots = findrepos(list(paths) + opts.get('collection', []))
+    if not roots:
+        raise abort(_('no target repositories specified'))
+
+    # The source is validated and filtered once for all the targets
+    try:
+        fp = open(source, 'rb')
+        try:
+            data = fp.read()
+        finally:
+            fp.close()
+    except IOError, e:
+        raise abort(_('cannot read projrc source: %s') % e)
+    c = config.config()
+    try:
+        c.parse(os.path.abspath(source), data, include=c.read)
+    except error.ParseError, e:
+        raise abort(_("parse error at '%s' on %s") % e.args)
+    includedkeys = parsekeylist(opts.get('include') or ['*'])
+    excludedkeys = parsekeylist(opts.get('exclude') or [])
+    payload = ENCODING_CHECK + serializeconfig(c, includedkeys, excludedkeys)
+
+    targets = list(enumerate(roots))
+    if worker is not None:
+        results = worker.worker(ui, 0.01, publishprojrc, (payload,), targets)
+    else:
+        results = publishprojrc(payload, targets)
+    outcomes = [None] * len(roots)
+    for i, result in results:
+        outcomes[i] = result
+
+    updated = failed = 0
+    for root, result in zip(roots, outcomes):
+        ui.write('%s: %s\n' % (root, result))
+        if result == 'updated':
+            updated += 1
+        elif result != 'unchanged':
+            failed += 1
+    ui.status(_('%d repositories, %d updated, %d failed\n')
+              % (len(roots), updated, failed))
+    return failed and 1 or 0
+
+def projrcgc(ui, repo, *args, **opts):
+    """remove the projrc store entries that no repository refers to"""
+    store = projrcstore(ui)
+    if store is None:
+        raise abort(_('the projrc store is not enabled (see projrc.store)'))
+    # Entries and references this recent may be in the middle of being
+    # written (see storeprojrc)
+    recent = time.time() - int(ui.config('projrc', 'storegrace',
+                                         default=3600))
+    try:
+        names = sorted(os.listdir(store))
+    except OSError:
+        names = []
+    entries = removed = 0
+    for name in names:
+        entrydir = os.path.join(store, name)
+        entry = os.path.join(entrydir, 'projrc')
+        if not os.path.isdir(entrydir):
+            continue
+        entries += 1
+        refs = os.path.join(entrydir, 'refs')
+        try:
+            refnames = os.listdir(refs)
+        except OSError:
+            refnames = []
+        users = 0
+        for refname in refnames:
+            ref = os.path.join(refs, refname)
+            try:
+                fp = open(ref, 'rb')
+                try:
+                    projrc = fp.read()
+                finally:
+                    fp.close()
+                if readstorereference(projrc) == entry or \
+                        os.stat(ref).st_mtime > recent:
+                    users += 1
+                    continue
+                ui.debug('projrc: %s no longer refers to %s\n'
+                         % (projrc, name))
+                os.unlink(ref)
+            except (IOError, OSError):
+                pass
+        try:
+            created = os.stat(entry).st_mtime
+        except OSError:
+            created = 0
+        if users or created > recent:
+            ui.note(_('%s: %d repositories\n') % (name, users))
+            continue
+        try:
+            shutil.rmtree(entrydir)
+        except OSError, e:
+            ui.warn(_('could not remove %s: %s\n') % (entrydir, e.strerror))
+            continue
+        ui.note(_('%s: removed\n') % name)
+        removed += 1
+    ui.status(_('%d projrc store entries, %d removed\n') % (entries, removed))
+
+_projrcactions = {
+    'sync': projrcsync,
+    'watch': projrcwatch,
+    'publish': projrcpublish,
+    'gc': projrcgc,
+}
+
+@command('projrc',
+    [('j', 'jobs', 0, _('number of repositories to process in parallel'),
+      _('N')),
+     ('', 'accept', None,
+      _('accept projrc changes that would need a confirmation')),
+     ('', 'interval', 0, _('seconds between two checks of a repository'),
+      _('SECONDS')),
+     ('', 'once', None, _('check every repository once, then exit')),
+     ('', 'collection', [],
+      _('publish to the repositories below this directory'), _('DIR')),
+     ('', 'include', [], _('keys to publish (default: all)'), _('KEY')),
+     ('', 'exclude', [], _('keys not to publish'), _('KEY'))],
+    _('hg projrc sync [-j N] [--accept] [PATH]...\n'
+      'hg projrc watch [-j N] [--interval SECONDS] [--once] [PATH]...\n'
+      'hg projrc publish [--collection DIR]... SOURCE [PATH]...\n'
+      'hg projrc gc'),
+    optionalrepo=True)
+def projrccommand(ui, repo, action, *args, **opts):
+    """manage the projrc file of local repositories
+
+    sync [PATH]...
+        Fetch the projrc file of each repository from its default path,
+        without pulling any changesets. PATH can be a repository or a
+        directory that is scanned for repositories; by default the
+        current repository is used. Up to --jobs repositories (or
+        projrc.jobs, 4 by default) are processed at the same time.
+        Nothing is prompted: changes that need a confirmation (see
+        projrc.confirm) are declined unless --accept is given.
+
+        A line is printed for each repository with the outcome (updated,
+        unchanged, declined, skipped when the source does not send a
+        projrc, or an error). Returns 1 if any repository failed.
+
+    watch [PATH]...
+        Keep checking the projrc file of the default path of each
+        repository (see sync for PATH and --jobs), every --interval
+        seconds (or projrc.watchinterval, 300 by default), plus a random
+        tenth of that. Failed checks are retried after longer and longer
+        delays. Only the hash of the remote projrc is fetched, unless it
+        changed: the new projrc file is then stored in .hg/projrc.staged,
+        and installed by the next command run in the repository, without
+        contacting the server. When projrc changes must be confirmed
+        (see projrc.confirm) the next pull prompts for them instead.
+        With --once, every repository is checked once and 1 is returned
+        if any of them failed.
+
+    publish SOURCE [PATH]...
+        Write the SOURCE projrc file into the repositories at or below
+        the given paths and --collection directories (e.g. the
+        directories of an hgweb collection). SOURCE is parsed and
+        filtered (see --include and --exclude) only once; each target
+        is then written atomically, by several processes (see
+        worker.numcpus) when there are many targets. Targets that
+        already have the same projrc file are left untouched. Returns 1
+        if any repository could not be written.
+
+    gc
+        Remove the entries of the projrc store (see projrc.store) that
+        no repository refers to anymore. Entries and references written
+        in the last projrc.storegrace seconds (3600 by default) are kept.
+    """
+    if action not in _projrcactions:
+        raise abort(_("unknown projrc action '%s'") % action)
+    return _projrcactions[action](ui, repo, *args, **opts)
+
+@command('debugprojrc',
+    [('', 'timing', None, _('show how long each projrc phase took'))],
+    _('hg debugprojrc [--timing]'),
+    optionalrepo=True)
+def debugprojrc(ui, repo, **opts):
+    """show the projrc file of the repository and how it was handled
+
+    With --timing, show how long each phase of the projrc handling took
+    in this process so far: the module imports, finding the repository
+    (findrepo), reading and parsing the projrc file and its includes
+    (read), merging it into the configuration (merge) and loading the
+    extensions that it enables (loadall). These timings can also be
+    printed to stderr by any command, and sent to the ui.log facility,
+    by setting projrc.timing or the HGPROJRCTIMING environment variable;
+    pulls then also report getting (listkeys), decoding (decode),
+    filtering (filter) and writing (write) the remote projrc.
+    """
+    if repo is not None:
+        projrc = repo_join(repo, 'projrc')
+        if os.path.exists(projrc):
+            ui.write(_('projrc file: %s\n') % projrc)
+        else:
+            ui.write(_('projrc file: %s (missing)\n') % projrc)
+        entry = readstorereference(projrc)
+        if entry is not None:
+            ui.write(_('projrc store entry: %s\n') % entry)
+        token, rev = readprojrcstate(repo)
+        ui.write(_('payload token: %s\n') % (token or _('none')))
+        if rev is not None:
+            ui.write(_('payload revision: %d\n') % rev)
+    if opts.get('timing'):
+        total = 0
+        for phase, seconds in _timings:
+            ui.write('%-10s %8.3f ms\n' % (phase + ':', seconds * 1000))
+            total += seconds
+        ui.write('%-10s %8.3f ms\n' % (_('total:'), total * 1000))
+
+# Set when running as a command server (hg serve --cmdserver, chg)
+_commandserver = False
+
+def runcommand(orig, lui, repo, *args, **kwargs):
+    global _commandrunning
+    _commandrunning = True
+    if _pendinglog:
+        logtimings(lui)
+    return orig(lui, repo, *args, **kwargs)
+
+def requestpaths(req):
+    """return the --cwd and -R options of a dispatch request"""
+    if hasattr(dispatch, '_earlyreqoptstr'):
+        # hg >= 4.4.2
+        cwd = dispatch._earlyreqoptstr(req, 'cwd', ['--cwd'])
+        rpath = dispatch._earlyreqoptstr(req, 'repository',
+                                         ["-R", "--repository", "--repo"])
+        return cwd, rpath and [rpath] or []
+    args = list(req.args)
+    cwd = dispatch._earlygetopt(['--cwd'], args)
+    rpath = dispatch._earlygetopt(["-R", "--repository", "--repo"], args)
+    return cwd and cwd[-1] or None, rpath
+
+def dispatchrequest(orig, req):
+    # A command server only runs uisetup once, so the projrc is merged into
+    # the fresh ui of every command that it runs instead
+    if _commandserver and req.ui is not None:
+        # The timings are those of this command (see debugprojrc)
+        del _timings[:]
+        cwd, rpath = requestpaths(req)
+        wd = os.getcwd()
+        if cwd:
+            wd = os.path.normpath(os.path.join(wd, cwd))
+        if rpath:
+            # -R is relative to --cwd, which is only applied later on
+            rpath = [os.path.normpath(os.path.join(
+                wd, req.ui.expandpath(rpath[-1])))]
+        readprojrc(req.ui, rpath, wd=wd, load=loadcachedprojrc)
+        if req.repo is not None:
+            loadcachedprojrc(req.repo.ui, repo_join(req.repo, 'projrc'),
+                             req.repo.root)
+    return orig(req)
 
 def extsetup(ui):
     # Modelled after dispatch._dispatch. We have to re-parse the
@@ -629,42 +3046,42 @@ def extsetup(ui):
     #rpath = dispatch._earlygetopt(["-R", "--repository", "--repo"], args)
     #readprojrc(ui, rpath)
     
-    extensions.loadall(ui)
-
-    if hasattr(dispatch, "_loaded"):
-        for name, module in extensions.extensions():
-            if name in dispatch._loaded:
-                continue
-            cmdtable = getattr(module, 'cmdtable', {})
-            overrides = [cmd for cmd in cmdtable if cmd in commands.table]
-            if overrides:
-                ui.warn(_("extension '%s' overrides commands: %s\n")
-                        % (name, " ".join(overrides)))
-            commands.table.update(cmdtable)
-            dispatch._loaded.add(name)
-    else:
-
-         #dispatch._loaded was removed in the latest mercurial
-        faux_loaded = set()
-
-        for name in extensions._extensions:
-            faux_loaded.add(name)
-
-        for name, module in extensions.extensions():
-            if name in faux_loaded:
-                continue
-            cmdtable = getattr(module, 'cmdtable', {})
-            overrides = [cmd for cmd in cmdtable if cmd in commands.table]
-            if overrides:
-                ui.warn(_("extension '%s' overrides commands: %s\n")
-                        % (name, " ".join(overrides)))
-            commands.table.update(cmdtable)
-            faux_loaded.add(name)
+    # Load the extensions that the projrc file added
+    loadextensions(ui)
 
     extensions.wrapfunction(hg, 'clone', clone)
+    extensions.wrapfunction(hg, 'update', deferupdate)
+    if hasattr(hg, '_update'):
+        # hg.clone calls the original update through this alias
+        extensions.wrapfunction(hg, '_update', deferupdate)
+    extensions.wrapfunction(dispatch, 'runcommand', runcommand)
+    extensions.wrapfunction(dispatch, '_dispatch', dispatchrequest)
     extensions.wrapfunction(hg, 'incoming', incoming)
+    if hasattr(hg, 'peer'):
+        # hg >= 2.3
+        extensions.wrapfunction(hg, 'peer', peer)
     extensions.wrapfunction(exchange, 'pull', pull)
+    # The pushkey namespace is what old clients and servers use
     pushkey.register('projrc', pushprojrc, listprojrc)
+    pushkey.register('projrc-hash', pushprojrc, listprojrchash)
+    if bundle2 is not None and \
+            hasattr(exchange, 'getbundle2partsgenerator') and \
+            'projrc' not in exchange.getbundle2partsmapping:
+        # hg >= 3.2
+        # The capability is only computed when it is advertised, so that
+        # the other commands do not import zstd (see wireengines)
+        extensions.wrapfunction(bundle2, 'getrepocaps', getrepocaps)
+        exchange.getbundle2partsgenerator('projrc')(getbundleprojrcpart)
+        # The projrc is sent ahead of the changesets (see handleprojrcpart)
+        order = exchange.getbundle2partsorder
+        if 'changegroup' in order:
+            order.remove('projrc')
+            order.insert(order.index('changegroup'), 'projrc')
+        if hasattr(exchange, '_pullbundle2extraprepare'):
+            # hg >= 3.2
+            extensions.wrapfunction(exchange, '_pullbundle2extraprepare',
+                                    pullbundle2extraprepare)
+        bundle2.parthandler('projrc')(handleprojrcpart)
 
 def uisetup(ui):
     # uisetup is called when the extension is first loaded and receives a ui object:
@@ -674,6 +3091,13 @@ def uisetup(ui):
     rpath = []
     if hasattr(dispatch, "_earlygetopt"):
         rpath = dispatch._earlygetopt(["-R", "--repository", "--repo"], args)
+    if timingenabled(ui):
+        reporttiming(ui, *_timings[0])
+    global _commandserver
+    if [a for a in args if a == '--cmdserver' or a.startswith('--cmdserver=')]:
+        # The projrc is read by every command instead (see dispatchrequest)
+        _commandserver = True
+        return
     readprojrc(ui, rpath)
     
 def repo_join(repo, file):
@@ -694,6 +3118,29 @@ def repo_read(repo, file):
     
     # Because the mercurial helper methods keep moving around read the file using pure python methods.
     try:
-        with open(repo_join(repo,file), "rb") as fo: return ''.join(fo.readlines())
+        with open(repo_join(repo,file), "rb") as fo: return fo.read()
     except IOError:
         return ""
+
+def writechunks(fp, chunks, oldpath):
+    """write chunks to fp, comparing them with the contents of oldpath
+
+    The old file is read along, chunk by chunk. Return True if the data
+    that was written differs from it (or if it does not exist).
+    """
+    try:
+        old = open(oldpath, 'rb')
+    except IOError:
+        old = None
+    same = old is not None
+    try:
+        for chunk in chunks:
+            fp.write(chunk)
+            if same and old.read(len(chunk)) != chunk:
+                same = False
+        if same and old.read(1):
+            same = False
+    finally:
+        if old is not None:
+            old.close()
+    return not same
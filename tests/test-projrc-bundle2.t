@@ -0,0 +1,87 @@
+  $ echo "[extensions]" >> $HGRCPATH
+  $ echo "projrc = $TESTDIR/../projrc.py" >> $HGRCPATH
+  $ echo "[projrc]" >> $HGRCPATH
+  $ echo "include = *" >> $HGRCPATH
+  $ echo "servers = *" >> $HGRCPATH
+  $ echo "confirm = False" >> $HGRCPATH
+
+make initial repository with a projrc file
+
+  $ hg init a
+  $ cd a
+  $ touch a.txt
+  $ hg add a.txt
+  $ hg commit -m a
+  $ echo "[foo]" > .hg/projrc
+  $ echo "bar = baz" >> .hg/projrc
+  $ hg serve -p $HGPORT -d --pid-file ../hg.pid -A ../access.log -E ../error.log
+  $ cat ../hg.pid >> "$DAEMON_PIDS"
+  $ cd ..
+
+the server sends the projrc file in the bundle2 reply to the pull, there
+is no separate listkeys request for it
+
+  $ hg init b
+  $ cd b
+  $ hg pull -q http://localhost:$HGPORT/
+  $ grep -c 'cmd=listkeys' ../access.log
+  0
+  [1]
+  $ cat .hg/projrc
+  #\ projrc encoding check, line must begin with '#\ '
+  [foo]
+  bar = baz
+
+clients that do not advertise the bundle2 capability use listkeys
+
+  $ echo "qux = quux" >> ../a/.hg/projrc
+  $ : > ../access.log
+  $ cat > $TESTTMP/nopart.py <<EOF
+  > from mercurial import bundle2, extensions
+  > def getrepocaps(orig, repo, *args, **kwargs):
+  >     caps = orig(repo, *args, **kwargs)
+  >     caps.pop('projrc', None)
+  >     return caps
+  > def extsetup(ui):
+  >     extensions.wrapfunction(bundle2, 'getrepocaps', getrepocaps)
+  > EOF
+  $ hg pull --config extensions.nopart=$TESTTMP/nopart.py http://localhost:$HGPORT/
+  pulling from http://localhost:$HGPORT/
+  projrc settings file updated and applied
+  searching for changes
+  no changes found
+  $ grep -c 'cmd=listkeys' ../access.log
+  1
+  $ cat .hg/projrc
+  #\ projrc encoding check, line must begin with '#\ '
+  [foo]
+  bar = baz
+  qux = quux
+
+the projrc is applied before the pulled changesets, so that the hooks
+that it brings already run for them
+
+  $ cat >> ../a/.hg/projrc <<EOF
+  > [hooks]
+  > changegroup.projrc = echo changegroup hook from the projrc
+  > EOF
+  $ echo b > ../a/b.txt
+  $ hg -R ../a commit -qAm b
+  $ hg pull -q http://localhost:$HGPORT/
+  changegroup hook from the projrc
+
+clients that do not pull the projrc from the server do not get it in the
+reply
+
+  $ echo c > ../a/c.txt
+  $ hg -R ../a commit -qAm c
+  $ hg pull --debug --config projrc.servers=http://elsewhere/ \
+  >     http://localhost:$HGPORT/ | grep 'bundle2-input-part: "projrc"'
+  [1]
+  $ hg pull --debug http://localhost:$HGPORT/ | grep 'bundle2-input-part: "projrc"'
+  bundle2-input-part: "projrc" (advisory) (params: * advisory) supported (glob)
+
+kill hg serve
+
+  $ "$TESTDIR/killdaemons.py"
+  $ cat ../error.log
@@ -0,0 +1,56 @@
+  $ echo "[extensions]" >> $HGRCPATH
+  $ echo "projrc = $TESTDIR/../projrc.py" >> $HGRCPATH
+  $ echo "[projrc]" >> $HGRCPATH
+  $ echo "include = *" >> $HGRCPATH
+  $ echo "servers = *main, *sub1, *sub2" >> $HGRCPATH
+  $ echo "confirm = False" >> $HGRCPATH
+
+A superproject with three subrepositories that have a projrc file, one
+of which is not on the projrc.servers list
+
+  $ hg init main
+  $ cd main
+  $ for r in sub1 sub2 sub3; do
+  >     hg init $r
+  >     printf "[foo]\n$r = $r\n" > $r/.hg/projrc
+  >     echo $r > $r/a
+  >     hg -R $r ci -qAm $r
+  >     echo "$r = $r" >> .hgsub
+  > done
+  $ hg ci -qAm subrepos
+  $ cd ..
+
+The projrc files of the subrepositories are fetched before the update,
+and applied as each subrepository gets cloned
+
+  $ hg clone -v main clone 2>&1 | grep 'projrc\|^cloning'
+  cloning subrepo sub1 from $TESTTMP/main/sub1
+  projrc settings file updated and applied
+  cloning subrepo sub2 from $TESTTMP/main/sub2
+  projrc settings file updated and applied
+  cloning subrepo sub3 from $TESTTMP/main/sub3
+  projrc: subrepository sub1: updated
+  projrc: subrepository sub2: updated
+  projrc: subrepository sub3: skipped
+  projrc: 3 subrepositories, 2 updated, 0 failed
+  $ grep sub clone/sub1/.hg/projrc clone/sub2/.hg/projrc
+  clone/sub1/.hg/projrc:sub1 = sub1
+  clone/sub2/.hg/projrc:sub2 = sub2
+  $ ls clone/sub3/.hg/projrc
+  ls: *: No such file or directory (glob)
+  [2]
+
+Over http, the subrepositories are cloned over the connection that their
+projrc was fetched with
+
+  $ hg serve -R main -S -p $HGPORT -d --pid-file hg.pid -A access.log -E error.log
+  $ cat hg.pid >> "$DAEMON_PIDS"
+  $ hg clone -q --config projrc.servers=* http://localhost:$HGPORT/ http
+  $ grep -c 'cmd=capabilities' access.log
+  4
+  $ grep sub http/sub1/.hg/projrc http/sub2/.hg/projrc http/sub3/.hg/projrc
+  http/sub1/.hg/projrc:sub1 = sub1
+  http/sub2/.hg/projrc:sub2 = sub2
+  http/sub3/.hg/projrc:sub3 = sub3
+  $ "$TESTDIR/killdaemons.py"
+  $ cat error.log
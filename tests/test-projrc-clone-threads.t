@@ -0,0 +1,81 @@
+  $ echo "[extensions]" >> $HGRCPATH
+  $ echo "projrc = $TESTDIR/../projrc.py" >> $HGRCPATH
+  $ echo "[projrc]" >> $HGRCPATH
+  $ echo "include = *" >> $HGRCPATH
+  $ echo "servers = *" >> $HGRCPATH
+  $ echo "confirm = False" >> $HGRCPATH
+
+a command that clones many repositories at once, in threads of the same
+process
+
+  $ cat > clonemany.py <<EOF
+  > import threading
+  > from mercurial import cmdutil, hg, registrar
+  > cmdtable = {}
+  > command = getattr(registrar, 'command', getattr(cmdutil, 'command', None))(cmdtable)
+  > @command('clonemany', [], 'SOURCE... ', norepo=True)
+  > def clonemany(ui, *sources):
+  >     errors = []
+  >     def run(source):
+  >         try:
+  >             hg.clone(ui.copy(), {}, source, source + '-clone')
+  >         except Exception, e:
+  >             errors.append('%s: %s' % (source, e))
+  >     threads = [threading.Thread(target=run, args=(s,)) for s in sources]
+  >     for t in threads:
+  >         t.start()
+  >     for t in threads:
+  >         t.join()
+  >     for e in errors:
+  >         ui.warn(e + '\n')
+  > EOF
+
+twelve superprojects with their own projrc, each with a subrepository
+that has another one
+
+  $ for n in 0 1 2 3 4 5 6 7 8 9 10 11; do
+  >     hg init main$n
+  >     printf "[foo]\nmain = $n\n" > main$n/.hg/projrc
+  >     hg init main$n/sub
+  >     printf "[foo]\nsub = $n\n" > main$n/sub/.hg/projrc
+  >     echo $n > main$n/sub/a
+  >     hg -R main$n/sub ci -qAm sub
+  >     echo "sub = sub" > main$n/.hgsub
+  >     hg -R main$n ci -qAm main
+  > done
+
+every clone gets its own projrc, and its working directory and
+subrepository are checked out after the projrc was transferred
+
+  $ hg --config extensions.clonemany=clonemany.py clonemany \
+  >     main0 main1 main2 main3 main4 main5 main6 main7 main8 main9 main10 main11 \
+  >     > clonemany.out
+  $ grep -c '^projrc settings file updated' clonemany.out
+  24
+  $ grep -c '^projrc: 1 subrepositories, 1 updated, 0 failed' clonemany.out
+  12
+  $ grep -v '^updating to\|^cloning subrepo\|^projrc\|files updated' clonemany.out
+  [1]
+  $ for n in 0 1 2 3 4 5 6 7 8 9 10 11; do
+  >     echo "$n:" `grep -h = main$n-clone/.hg/projrc main$n-clone/sub/.hg/projrc` \
+  >          "`cat main$n-clone/sub/a`" "`hg -R main$n-clone id -n`"
+  > done
+  0: main = 0 sub = 0 0 0
+  1: main = 1 sub = 1 1 0
+  2: main = 2 sub = 2 2 0
+  3: main = 3 sub = 3 3 0
+  4: main = 4 sub = 4 4 0
+  5: main = 5 sub = 5 5 0
+  6: main = 6 sub = 6 6 0
+  7: main = 7 sub = 7 7 0
+  8: main = 8 sub = 8 8 0
+  9: main = 9 sub = 9 9 0
+  10: main = 10 sub = 10 10 0
+  11: main = 11 sub = 11 11 0
+
+updates outside of a clone are not deferred
+
+  $ hg -R main0-clone update -q null
+  $ hg -R main0-clone update -q tip
+  $ cat main0-clone/sub/a
+  0
@@ -0,0 +1,166 @@
+  $ echo "[extensions]" >> $HGRCPATH
+  $ echo "projrc = $TESTDIR/../projrc.py" >> $HGRCPATH
+  $ echo "[projrc]" >> $HGRCPATH
+  $ echo "include = *" >> $HGRCPATH
+  $ echo "servers = *" >> $HGRCPATH
+  $ echo "confirm = False" >> $HGRCPATH
+
+A small command server client: it runs the commands read from stdin in a
+single "hg serve --cmdserver pipe" process, and the lines starting with
+"$ " in a shell
+
+  $ cat > cmdserver.py <<EOF
+  > import os, struct, subprocess, sys
+  > def readchannel(server):
+  >     channel, length = struct.unpack('>cI', server.stdout.read(5))
+  >     return channel, server.stdout.read(length)
+  > def runcommand(server, args):
+  >     data = '\0'.join(args)
+  >     server.stdin.write('runcommand\n' + struct.pack('>I', len(data)) + data)
+  >     server.stdin.flush()
+  >     while True:
+  >         channel, data = readchannel(server)
+  >         if channel == 'r':
+  >             return
+  >         sys.stdout.write(data)
+  > server = subprocess.Popen(['hg', 'serve', '--cmdserver', 'pipe'] +
+  >                           sys.argv[1:], stdin=subprocess.PIPE,
+  >                           stdout=subprocess.PIPE)
+  > readchannel(server)
+  > for line in sys.stdin:
+  >     sys.stdout.write('*** %s' % line)
+  >     sys.stdout.flush()
+  >     if line.startswith('$ '):
+  >         os.system(line[2:])
+  >     else:
+  >         runcommand(server, line.split())
+  >     sys.stdout.flush()
+  > server.stdin.close()
+  > server.wait()
+  > EOF
+
+  $ hg init a
+  $ hg init b
+  $ printf '[foo]\nbar = a\n' > a/.hg/projrc
+  $ printf '[foo]\nbar = b\n' > b/.hg/projrc
+  $ touch -t 200001010000 a/.hg/projrc b/.hg/projrc
+  $ cd a
+
+The projrc is read by every command, but only parsed again when it changed
+
+  $ $PYTHON ../cmdserver.py --config ui.debug=True 2>&1 <<EOF
+  > config foo
+  > config foo
+  > $ printf '[foo]\nbar = A\n' > .hg/projrc
+  > config foo
+  > config foo -R ../b
+  > config foo -R b --cwd ..
+  > EOF
+  *** config foo
+  read config from: * (glob)
+  $TESTTMP/a/.hg/projrc:2: foo.bar=a
+  *** config foo
+  projrc: reusing the settings read from $TESTTMP/a/.hg/projrc
+  read config from: * (glob)
+  $TESTTMP/a/.hg/projrc:2: foo.bar=a
+  *** $ printf '[foo]\nbar = A\n' > .hg/projrc
+  *** config foo
+  read config from: * (glob)
+  $TESTTMP/a/.hg/projrc:2: foo.bar=A
+  *** config foo -R ../b
+  read config from: * (glob)
+  $TESTTMP/b/.hg/projrc:2: foo.bar=b
+  *** config foo -R b --cwd ..
+  projrc: reusing the settings read from $TESTTMP/b/.hg/projrc
+  read config from: * (glob)
+  $TESTTMP/b/.hg/projrc:2: foo.bar=b
+
+The payload served to the clients is only encoded again when the projrc
+changed, here shown by an extension that reports the encodings
+
+  $ cat > ../showencode.py <<EOF
+  > from mercurial import extensions
+  > def encodeprojrc(orig, repo):
+  >     repo.ui.write('encoding the projrc payload\n')
+  >     return orig(repo)
+  > def extsetup(ui):
+  >     projrc = extensions.find('projrc')
+  >     extensions.wrapfunction(projrc, 'encodeprojrc', encodeprojrc)
+  > EOF
+  $ touch -t 200001010000 .hg/projrc
+  $ $PYTHON ../cmdserver.py --config extensions.showencode=../showencode.py <<EOF
+  > debugpushkey . projrc
+  > debugpushkey . projrc
+  > $ printf '[foo]\nbar = AA\n' > .hg/projrc && touch -t 200001010001 .hg/projrc
+  > debugpushkey . projrc
+  > debugpushkey . projrc
+  > EOF
+  *** debugpushkey . projrc
+  encoding the projrc payload
+  data	#\\\\ projrc encoding check, line must begin with \\\'#\\\\ \\\'\\n[foo]\\nbar = A\\n
+  hash	a4122b43497ee7d5685360182d84c15ef0046368
+  rev	1
+  *** debugpushkey . projrc
+  data	#\\\\ projrc encoding check, line must begin with \\\'#\\\\ \\\'\\n[foo]\\nbar = A\\n
+  hash	a4122b43497ee7d5685360182d84c15ef0046368
+  rev	1
+  *** $ printf '[foo]\nbar = AA\n' > .hg/projrc && touch -t 200001010001 .hg/projrc
+  *** debugpushkey . projrc
+  encoding the projrc payload
+  data	#\\\\ projrc encoding check, line must begin with \\\'#\\\\ \\\'\\n[foo]\\nbar = AA\\n
+  hash	7b733c66b978bf3a8baaaf5dd418e40a0865e884
+  rev	2
+  *** debugpushkey . projrc
+  data	#\\\\ projrc encoding check, line must begin with \\\'#\\\\ \\\'\\n[foo]\\nbar = AA\\n
+  hash	7b733c66b978bf3a8baaaf5dd418e40a0865e884
+  rev	2
+
+With projrc.wirecache, the payload is also kept on disk for the next
+server processes
+
+  $ hg debugpushkey . projrc --config projrc.wirecache=True \
+  >     --config extensions.showencode=../showencode.py
+  encoding the projrc payload
+  data	#\\\\ projrc encoding check, line must begin with \\\'#\\\\ \\\'\\n[foo]\\nbar = AA\\n
+  hash	7b733c66b978bf3a8baaaf5dd418e40a0865e884
+  rev	2
+  $ hg debugpushkey . projrc --config projrc.wirecache=True \
+  >     --config extensions.showencode=../showencode.py
+  data	#\\\\ projrc encoding check, line must begin with \\\'#\\\\ \\\'\\n[foo]\\nbar = AA\\n
+  hash	7b733c66b978bf3a8baaaf5dd418e40a0865e884
+  rev	2
+  $ printf '[foo]\nbar = AAA\n' > .hg/projrc
+  $ touch -t 200001010002 .hg/projrc
+  $ hg debugpushkey . projrc --config projrc.wirecache=True \
+  >     --config extensions.showencode=../showencode.py
+  encoding the projrc payload
+  data	#\\\\ projrc encoding check, line must begin with \\\'#\\\\ \\\'\\n[foo]\\nbar = AAA\\n
+  hash	9ecefcbdeee6519bd9590aa0014a07f49cdf66a5
+  rev	3
+  $ hg debugpushkey . projrc --config projrc.wirecache=True \
+  >     --config extensions.showencode=../showencode.py
+  data	#\\\\ projrc encoding check, line must begin with \\\'#\\\\ \\\'\\n[foo]\\nbar = AAA\\n
+  hash	9ecefcbdeee6519bd9590aa0014a07f49cdf66a5
+  rev	3
+
+The timings shown by debugprojrc are those of the current command
+
+  $ $PYTHON ../cmdserver.py <<EOF
+  > debugprojrc --timing
+  > debugprojrc --timing
+  > EOF
+  *** debugprojrc --timing
+  projrc file: $TESTTMP/a/.hg/projrc
+  payload token: none
+  findrepo: +\d+\.\d{3} ms (re)
+  read: +\d+\.\d{3} ms (re)
+  merge: +\d+\.\d{3} ms (re)
+  merge: +\d+\.\d{3} ms (re)
+  total: +\d+\.\d{3} ms (re)
+  *** debugprojrc --timing
+  projrc file: $TESTTMP/a/.hg/projrc
+  payload token: none
+  findrepo: +\d+\.\d{3} ms (re)
+  merge: +\d+\.\d{3} ms (re)
+  merge: +\d+\.\d{3} ms (re)
+  total: +\d+\.\d{3} ms (re)
@@ -0,0 +1,155 @@
+  $ echo "[extensions]" >> $HGRCPATH
+  $ echo "projrc = $TESTDIR/../projrc.py" >> $HGRCPATH
+  $ echo "[projrc]" >> $HGRCPATH
+  $ echo "include = *" >> $HGRCPATH
+  $ echo "servers = *" >> $HGRCPATH
+  $ echo "confirm = False" >> $HGRCPATH
+
+the server numbers the revisions of its projrc file, and keeps the
+changes of the last two
+
+  $ hg init a
+  $ cat > a/.hg/projrc <<EOF
+  > [foo]
+  > bar = 1
+  > baz = 2
+  > [long]
+  > value = multi
+  >   line
+  > EOF
+  $ hg serve -R a -p $HGPORT -d --pid-file hg.pid -A access.log -E error.log --config projrc.history=2
+  $ cat hg.pid >> "$DAEMON_PIDS"
+
+  $ hg init b
+  $ cd b
+  $ hg pull -q http://localhost:$HGPORT/
+  $ hg debugprojrc
+  projrc file: $TESTTMP/b/.hg/projrc
+  payload token: [0-9a-f]{40} (re)
+  payload revision: 1
+
+a client that has a revision of the projrc only gets the changes since
+then
+
+  $ cat > ../a/.hg/projrc <<EOF
+  > [foo]
+  > bar = 2
+  > [long]
+  > value = multi
+  >   line
+  > [new]
+  > key = value
+  > EOF
+  $ hg pull -q --debug http://localhost:$HGPORT/ | grep '^projrc'
+  projrc: received a \d+ bytes (zstd|zlib) payload (re)
+  projrc: applied the changes since revision 1
+  projrc settings file updated and applied
+  $ cat .hg/projrc
+  #\ projrc encoding check, line must begin with '#\ '
+  [foo]
+  bar = 2
+  
+  [long]
+  value = multi
+    line
+  
+  [new]
+  key = value
+  $ hg debugprojrc | grep revision
+  payload revision: 2
+
+the changes are applied through the local filter
+
+  $ echo "key = other" >> ../a/.hg/projrc
+  $ hg pull -q --debug --config projrc.exclude=foo http://localhost:$HGPORT/ | grep '^projrc'
+  projrc: received a \d+ bytes (zstd|zlib) payload (re)
+  projrc settings file updated and applied
+  $ grep -c 'cmd=listkeys' ../access.log
+  1
+  $ cat .hg/projrc
+  #\ projrc encoding check, line must begin with '#\ '
+  [long]
+  value = multi
+    line
+  
+  [new]
+  key = other
+
+the full projrc is sent when the history does not reach back far enough
+
+  $ hg init ../c
+  $ echo "[more]" >> ../a/.hg/projrc
+  $ echo "x = 1" >> ../a/.hg/projrc
+  $ hg -R ../c pull -q http://localhost:$HGPORT/
+  $ echo "y = 2" >> ../a/.hg/projrc
+  $ hg -R ../c pull -q http://localhost:$HGPORT/
+  $ hg pull -q --debug http://localhost:$HGPORT/ | grep '^projrc'
+  projrc: received a \d+ bytes (zstd|zlib) payload (re)
+  projrc settings file updated and applied
+  $ hg debugprojrc | grep revision
+  payload revision: 5
+  $ cmp .hg/projrc ../c/.hg/projrc
+
+the keys of the changed sections keep the order of the server's projrc,
+which is the order in which hooks run and extensions are loaded
+
+  $ cat > ../a/.hg/projrc <<EOF
+  > [hooks]
+  > pre-status.a = echo A1
+  > pre-status.b = echo B
+  > pre-status.c = echo C
+  > [extensions]
+  > rebase = !x
+  > strip = !
+  > [foo]
+  > bar = 1
+  > EOF
+  $ hg pull -q http://localhost:$HGPORT/
+  $ sed -i.bak -e 's/A1/A2/' -e 's/^rebase = !x/rebase = !/' ../a/.hg/projrc
+  $ hg pull -q --debug http://localhost:$HGPORT/ | grep '^projrc'
+  projrc: received a \d+ bytes (zstd|zlib) payload (re)
+  projrc: applied the changes since revision 6
+  projrc settings file updated and applied
+  $ cat .hg/projrc
+  #\ projrc encoding check, line must begin with '#\ '
+  [extensions]
+  rebase = !
+  strip = !
+  
+  [foo]
+  bar = 1
+  
+  [hooks]
+  pre-status.a = echo A2
+  pre-status.b = echo B
+  pre-status.c = echo C
+  $ hg init ../d
+  $ hg -R ../d pull -q http://localhost:$HGPORT/
+  $ cmp .hg/projrc ../d/.hg/projrc
+
+and so do sections whose keys are only reordered
+
+  $ cat > ../a/.hg/projrc <<EOF
+  > [hooks]
+  > pre-status.c = echo C
+  > pre-status.a = echo A2
+  > pre-status.b = echo B
+  > [extensions]
+  > rebase = !
+  > strip = !
+  > [foo]
+  > bar = 1
+  > EOF
+  $ hg pull -q --debug http://localhost:$HGPORT/ | grep '^projrc'
+  projrc: received a \d+ bytes (zstd|zlib) payload (re)
+  projrc: applied the changes since revision 7
+  projrc settings file updated and applied
+  $ grep pre-status .hg/projrc
+  pre-status.c = echo C
+  pre-status.a = echo A2
+  pre-status.b = echo B
+  $ hg -R ../d pull -q http://localhost:$HGPORT/
+  $ cmp .hg/projrc ../d/.hg/projrc
+
+  $ "$TESTDIR/killdaemons.py"
+  $ cat ../error.log
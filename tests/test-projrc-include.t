@@ -36,9 +36,9 @@ create .hg/projrc file
   >     World!
   > EOM
   $ hg showconfig foo
+  foo.b=Hello\nWorld!
   foo.c=1000
   foo.a=10000
-  foo.b=Hello\nWorld!
   $ hg showconfig bar
   bar.x=Hello
   bar.y=World
@@ -0,0 +1,66 @@
+  $ echo "[extensions]" >> $HGRCPATH
+  $ echo "projrc = $TESTDIR/../projrc.py" >> $HGRCPATH
+  $ echo "[projrc]" >> $HGRCPATH
+  $ echo "include = *" >> $HGRCPATH
+  $ echo "servers = *" >> $HGRCPATH
+  $ echo "confirm = False" >> $HGRCPATH
+
+make initial repository with a projrc file
+
+  $ hg init a
+  $ cd a
+  $ touch a.txt
+  $ hg add a.txt
+  $ hg commit -m a
+  $ echo "[foo]" > .hg/projrc
+  $ echo "bar = baz" >> .hg/projrc
+
+serve it and log every request, each new connection starts with a
+capabilities request
+
+  $ hg serve -p $HGPORT -d --pid-file ../hg.pid -A ../access.log -E ../error.log
+  $ cat ../hg.pid >> "$DAEMON_PIDS"
+  $ cd ..
+  $ hg clone -q http://localhost:$HGPORT/ b
+  $ cd b
+  $ cat .hg/projrc
+  #\ projrc encoding check, line must begin with '#\ '
+  [foo]
+  bar = baz
+
+incoming looks for changes to the projrc file on the connection that it
+already opened to look for changesets
+
+  $ echo "qux = quux" >> ../a/.hg/projrc
+  $ : > ../access.log
+  $ hg incoming http://localhost:$HGPORT/
+  comparing with http://localhost:$HGPORT/
+  searching for changes
+  no changes found
+  remote and local projrc files are different
+  [1]
+  $ grep -c 'cmd=capabilities' ../access.log
+  1
+
+with projrc.updateonincoming the projrc file is updated using that
+connection as well
+
+  $ : > ../access.log
+  $ hg incoming --config projrc.updateonincoming=auto http://localhost:$HGPORT/
+  comparing with http://localhost:$HGPORT/
+  searching for changes
+  no changes found
+  projrc settings file updated and applied
+  [1]
+  $ grep -c 'cmd=capabilities' ../access.log
+  1
+  $ cat .hg/projrc
+  #\ projrc encoding check, line must begin with '#\ '
+  [foo]
+  bar = baz
+  qux = quux
+
+kill hg serve
+
+  $ "$TESTDIR/killdaemons.py"
+  $ cat ../error.log
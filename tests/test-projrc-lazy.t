@@ -0,0 +1,91 @@
+  $ echo "[extensions]" >> $HGRCPATH
+  $ echo "projrc = $TESTDIR/../projrc.py" >> $HGRCPATH
+  $ echo "[projrc]" >> $HGRCPATH
+  $ echo "lazy = True" >> $HGRCPATH
+
+an extension enabled by the projrc file, and one that shows which projrc
+settings have been merged into the configuration, without looking them
+up, then looks them up
+
+  $ cat > eager.py <<EOF
+  > def uisetup(ui):
+  >     ui.write('eager loaded\n')
+  > EOF
+  $ cat > showlazy.py <<EOF
+  > def merged(ui, section, name):
+  >     return ui._data(False).get(section, name)
+  > def show(ui, name):
+  >     ui.write('%s: foo.bar=%s, pending %s\n' % (name,
+  >         merged(ui, 'foo', 'bar'),
+  >         sorted(s for p in getattr(ui, '_projrcpending', ())
+  >                for s in p[2])))
+  > def uisetup(ui):
+  >     show(ui, 'startup')
+  >     ui.write('startup: hooks.pre-id=%s\n' % merged(ui, 'hooks', 'pre-id'))
+  >     copy = ui.copy()
+  >     show(copy, 'copy')
+  >     ui.write('copy foo.bar: %s\n' % copy.config('foo', 'bar'))
+  >     show(copy, 'copy')
+  >     show(ui, 'ui')
+  >     ui.write('foo.bar: %s\n' % ui.config('foo', 'bar'))
+  >     show(ui, 'ui')
+  > EOF
+
+  $ hg init a
+  $ cd a
+  $ cat > .hg/projrc <<EOF
+  > [extensions]
+  > eager = $TESTTMP/eager.py
+  > [hooks]
+  > pre-id = echo pre-id hook
+  > [foo]
+  > bar = projrc
+  > [baz]
+  > qux = projrc
+  > EOF
+  $ echo "[extensions]" >> .hg/hgrc
+  $ echo "showlazy = $TESTTMP/showlazy.py" >> .hg/hgrc
+
+the [extensions] and [hooks] sections are loaded right away, the other
+sections on the first lookup of any of them; copies of the ui inherit
+the pending projrc files
+
+  $ hg id -q
+  startup: foo.bar=None, pending ['baz', 'foo']
+  startup: hooks.pre-id=echo pre-id hook
+  copy: foo.bar=None, pending ['baz', 'foo']
+  copy foo.bar: projrc
+  copy: foo.bar=projrc, pending []
+  ui: foo.bar=None, pending ['baz', 'foo']
+  foo.bar: projrc
+  ui: foo.bar=projrc, pending []
+  eager loaded
+  000000000000
+
+--config still overrides the settings merged on the first lookup
+
+  $ hg id -q --config foo.bar=cli
+  startup: foo.bar=cli, pending ['baz', 'foo']
+  startup: hooks.pre-id=echo pre-id hook
+  copy: foo.bar=cli, pending ['baz', 'foo']
+  copy foo.bar: cli
+  copy: foo.bar=cli, pending []
+  ui: foo.bar=cli, pending ['baz', 'foo']
+  foo.bar: cli
+  ui: foo.bar=cli, pending []
+  eager loaded
+  000000000000
+
+without projrc.lazy everything is merged right away
+
+  $ hg id -q --config projrc.lazy=False
+  startup: foo.bar=projrc, pending []
+  startup: hooks.pre-id=echo pre-id hook
+  copy: foo.bar=projrc, pending []
+  copy foo.bar: projrc
+  copy: foo.bar=projrc, pending []
+  ui: foo.bar=projrc, pending []
+  foo.bar: projrc
+  ui: foo.bar=projrc, pending []
+  eager loaded
+  000000000000
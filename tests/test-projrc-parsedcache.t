@@ -0,0 +1,83 @@
+  $ echo "[extensions]" >> $HGRCPATH
+  $ echo "projrc = $TESTDIR/../projrc.py" >> $HGRCPATH
+
+an extension that shows the projrc settings, and a script that marks the
+values of the parsed projrc cache, to tell whether they are used
+
+  $ cat > showfoo.py <<EOF
+  > def uisetup(ui):
+  >     ui.write('foo.bar=%s foo.inc=%s\n'
+  >              % (ui.config('foo', 'bar'), ui.config('foo', 'inc')))
+  > EOF
+  $ cat > markcache.py <<EOF
+  > import marshal, sys
+  > fp = open(sys.argv[1], 'rb')
+  > header, items = marshal.load(fp), marshal.load(fp)
+  > fp.close()
+  > items = [(s, k, 'cached ' + v, src) for s, k, v, src in items]
+  > fp = open(sys.argv[1], 'wb')
+  > fp.write(marshal.dumps(header) + marshal.dumps(items))
+  > fp.close()
+  > EOF
+
+a projrc file that includes another file, both older than the current
+second, so that their parse is cached
+
+  $ hg init a
+  $ cd a
+  $ echo "[extensions]" >> .hg/hgrc
+  $ echo "showfoo = $TESTTMP/showfoo.py" >> .hg/hgrc
+  $ printf '[foo]\nbar = 1\n%%include inc.rc\n' > .hg/projrc
+  $ printf '[foo]\ninc = 1\n' > .hg/inc.rc
+  $ touch -t 200001010000 .hg/projrc .hg/inc.rc
+  $ hg id -q
+  foo.bar=1 foo.inc=1
+  000000000000
+  $ ls .hg/cache/projrc-parsed
+  .hg/cache/projrc-parsed
+
+the cache is used while the files do not change
+
+  $ python $TESTTMP/markcache.py .hg/cache/projrc-parsed
+  $ hg id -q
+  foo.bar=cached 1 foo.inc=cached 1
+  000000000000
+
+it is rebuilt when the projrc file changes
+
+  $ printf '[foo]\nbar = 22\n%%include inc.rc\n' > .hg/projrc
+  $ touch -t 200001010001 .hg/projrc
+  $ hg id -q
+  foo.bar=22 foo.inc=1
+  000000000000
+  $ python $TESTTMP/markcache.py .hg/cache/projrc-parsed
+  $ hg id -q
+  foo.bar=cached 22 foo.inc=cached 1
+  000000000000
+
+when an included file changes
+
+  $ printf '[foo]\ninc = 22\n' > .hg/inc.rc
+  $ touch -t 200001010001 .hg/inc.rc
+  $ hg id -q
+  foo.bar=22 foo.inc=22
+  000000000000
+  $ python $TESTTMP/markcache.py .hg/cache/projrc-parsed
+  $ hg id -q
+  foo.bar=cached 22 foo.inc=cached 22
+  000000000000
+
+and when an included file is removed, or comes back
+
+  $ mv .hg/inc.rc inc.rc
+  $ hg id -q
+  foo.bar=22 foo.inc=None
+  000000000000
+  $ python $TESTTMP/markcache.py .hg/cache/projrc-parsed
+  $ hg id -q
+  foo.bar=cached 22 foo.inc=None
+  000000000000
+  $ mv inc.rc .hg/inc.rc
+  $ hg id -q
+  foo.bar=22 foo.inc=22
+  000000000000
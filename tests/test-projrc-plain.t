@@ -0,0 +1,55 @@
+  $ echo "[extensions]" >> $HGRCPATH
+  $ echo "projrc = $TESTDIR/../projrc.py" >> $HGRCPATH
+
+an extension that shows the projrc settings that HGPLAIN is about
+
+  $ cat > showplain.py <<EOF
+  > def uisetup(ui):
+  >     for item in ('ui.verbose', 'alias.foo', 'revsetalias.mine',
+  >                  'templatealias.short', 'foo.bar'):
+  >         ui.write('%s=%s\n' % (item, ui.config(*item.split('.'))))
+  > EOF
+  $ hg init a
+  $ cd a
+  $ echo "[extensions]" >> .hg/hgrc
+  $ echo "showplain = $TESTTMP/showplain.py" >> .hg/hgrc
+  $ cat > .hg/projrc <<EOF
+  > [ui]
+  > verbose = True
+  > [alias]
+  > foo = log -l1
+  > [revsetalias]
+  > mine = user(me)
+  > [templatealias]
+  > short = node|short
+  > [foo]
+  > bar = baz
+  > EOF
+
+  $ hg root -q
+  ui.verbose=True
+  alias.foo=log -l1
+  revsetalias.mine=user(me)
+  templatealias.short=node|short
+  foo.bar=baz
+  $TESTTMP/a
+
+HGPLAIN drops the aliases of the projrc, like those of any hgrc
+
+  $ HGPLAIN=1 hg root
+  ui.verbose=False
+  alias.foo=None
+  revsetalias.mine=None
+  templatealias.short=None
+  foo.bar=baz
+  $TESTTMP/a
+
+unless HGPLAINEXCEPT keeps them
+
+  $ HGPLAINEXCEPT=alias,revsetalias hg root
+  ui.verbose=False
+  alias.foo=log -l1
+  revsetalias.mine=user(me)
+  templatealias.short=None
+  foo.bar=baz
+  $TESTTMP/a
@@ -0,0 +1,69 @@
+  $ echo "[extensions]" >> $HGRCPATH
+  $ echo "projrc = $TESTDIR/../projrc.py" >> $HGRCPATH
+
+make a collection of repositories
+
+  $ mkdir -p collection/group
+  $ hg init collection/a
+  $ hg init collection/group/b
+  $ hg init collection/group/c
+  $ hg init other
+  $ cat > settings <<EOF
+  > [foo]
+  > bar = baz
+  > %include more-settings
+  > [secret]
+  > password = hunter2
+  > EOF
+  $ cat > more-settings <<EOF
+  > [foo]
+  > qux = quux
+  > EOF
+
+publish a projrc file to the whole collection and to another repository
+
+  $ hg projrc publish settings --collection collection other --exclude secret
+  other: updated
+  collection/a: updated
+  collection/group/b: updated
+  collection/group/c: updated
+  4 repositories, 4 updated, 0 failed
+  $ cat collection/group/c/.hg/projrc
+  #\ projrc encoding check, line must begin with '#\ '
+  [foo]
+  bar = baz
+  qux = quux
+
+repositories that already have the same projrc file are not written again
+
+  $ echo "[foo]" > collection/a/.hg/projrc
+  $ hg projrc publish settings --collection collection --exclude secret
+  collection/a: updated
+  collection/group/b: unchanged
+  collection/group/c: unchanged
+  3 repositories, 1 updated, 0 failed
+
+the stale projrc caches of the targets are removed
+
+  $ hg serve -R collection/a -p $HGPORT -d --pid-file hg.pid --config projrc.wirecache=True
+  $ cat hg.pid >> "$DAEMON_PIDS"
+  $ hg init client
+  $ hg -R client pull -q --config projrc.servers=* --config projrc.include=* --config projrc.confirm=False http://localhost:$HGPORT/
+  $ test -f collection/a/.hg/cache/projrc-wire
+  $ hg projrc publish settings collection/a
+  collection/a: updated
+  1 repositories, 1 updated, 0 failed
+  $ test -f collection/a/.hg/cache/projrc-wire
+  [1]
+  $ "$TESTDIR/killdaemons.py"
+
+the source is checked before anything is written
+
+  $ echo "this is broken" > broken
+  $ hg projrc publish broken other
+  abort: parse error at 'this is broken' on $TESTTMP/broken:1
+  [255]
+  $ hg projrc publish settings missing
+  missing: repository missing not found
+  1 repositories, 0 updated, 1 failed
+  [1]
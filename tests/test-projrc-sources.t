@@ -0,0 +1,94 @@
+  $ echo "[extensions]" >> $HGRCPATH
+  $ echo "projrc = $TESTDIR/../projrc.py" >> $HGRCPATH
+  $ echo "[projrc]" >> $HGRCPATH
+  $ echo "include = *" >> $HGRCPATH
+  $ echo "servers = *" >> $HGRCPATH
+  $ echo "confirm = False" >> $HGRCPATH
+
+an extension that makes a server slow to list its projrc
+
+  $ cat > delay.py <<EOF
+  > import time
+  > from mercurial import extensions, pushkey
+  > def listkeys(orig, repo, namespace):
+  >     if namespace == 'projrc':
+  >         time.sleep(float(repo.ui.config('delay', 'seconds', 0)))
+  >     return orig(repo, namespace)
+  > def extsetup(ui):
+  >     extensions.wrapfunction(pushkey, 'list', listkeys)
+  > EOF
+
+two mirrors: a slow one and a fast one
+
+  $ hg init slow
+  $ printf "[foo]\nbar = slow\n" > slow/.hg/projrc
+  $ hg serve -R slow -p $HGPORT -d --pid-file hg.pid --config extensions.delay=delay.py --config delay.seconds=2
+  $ cat hg.pid >> "$DAEMON_PIDS"
+  $ hg init fast
+  $ printf '[foo]\nbar = fast\n' > fast/.hg/projrc
+  $ hg serve -R fast -p $HGPORT1 -d --pid-file hg.pid -A fast.log
+  $ cat hg.pid >> "$DAEMON_PIDS"
+
+a repository that gets its projrc from the mirrors
+
+  $ hg init c
+  $ cat >> c/.hg/hgrc <<EOF
+  > [paths]
+  > default = http://localhost:$HGPORT1/
+  > [projrc]
+  > sources = http://localhost:$HGPORT/, http://localhost:$HGPORT1/
+  > EOF
+
+by default the first answer wins
+
+  $ hg projrc sync -v c
+  c: updated
+    projrc settings file updated
+  1 repositories, 1 updated, 0 failed
+  $ grep bar c/.hg/projrc
+  bar = fast
+
+the slow source is abandoned when it does not answer in time, here with
+another source that is down
+
+  $ hg projrc sync -v c --config projrc.sourcetimeout=1 \
+  >     --config projrc.sources="http://localhost:$HGPORT/ http://localhost:$HGPORT2/"
+  c: skipped
+    projrc source http://localhost:$HGPORT2/ failed: * (glob)
+    projrc source http://localhost:$HGPORT/ did not answer in time
+  1 repositories, 0 updated, 0 failed
+  $ grep bar c/.hg/projrc
+  bar = fast
+
+the projrc sent along with the pulled changes is used as is, even a
+delta, and the mirrors are not asked: neither the slow one, nor the one
+that is down
+
+  $ printf '[foo]\nbar = fast2\n' > fast/.hg/projrc
+  $ grep -c 'cmd=listkeys' fast.log
+  1
+  $ hg -R c pull -q --config projrc.sourcetimeout=1 \
+  >     --config projrc.sources="http://localhost:$HGPORT/ http://localhost:$HGPORT2/"
+  $ grep bar c/.hg/projrc
+  bar = fast2
+  $ grep -c 'cmd=listkeys' fast.log
+  1
+
+a source that fails in an unexpected way is reported as failed at once,
+not as one that did not answer
+
+  $ cat > brokensource.py <<EOF
+  > from mercurial import extensions
+  > def fetchsourceprojrc(orig, ui, source):
+  >     if 'broken' in source:
+  >         raise RuntimeError('unexpected listkeys reply')
+  >     return orig(ui, source)
+  > def extsetup(ui):
+  >     projrc = extensions.find('projrc')
+  >     extensions.wrapfunction(projrc, 'fetchsourceprojrc', fetchsourceprojrc)
+  > EOF
+  $ hg projrc sync -v c --config extensions.brokensource=brokensource.py \
+  >     --config projrc.sources=http://broken.example.com/
+  c: skipped
+    projrc source http://broken.example.com/ failed: unexpected listkeys reply
+  1 repositories, 0 updated, 0 failed
@@ -0,0 +1,95 @@
+  $ echo "[extensions]" >> $HGRCPATH
+  $ echo "projrc = $TESTDIR/../projrc.py" >> $HGRCPATH
+  $ echo "[projrc]" >> $HGRCPATH
+  $ echo "include = *" >> $HGRCPATH
+  $ echo "servers = *" >> $HGRCPATH
+  $ echo "confirm = False" >> $HGRCPATH
+  $ echo "store = $TESTTMP/store" >> $HGRCPATH
+
+  $ hg init server
+  $ printf '[foo]\nbar = 1\n' > server/.hg/projrc
+
+clones share a single copy of the projrc file, and of its parse
+
+  $ hg clone -q server c1
+  $ hg clone -q server c2
+  $ cat c1/.hg/projrc
+  # projrc settings shared through the projrc store
+  %include $TESTTMP/store/*/projrc (glob)
+  $ cmp c1/.hg/projrc c2/.hg/projrc
+  $ cd store
+  $ find . -type f | sed 's/[0-9a-f]\{40\}/HASH/g' | sort
+  ./HASH/cache/projrc-parsed
+  ./HASH/projrc
+  ./HASH/refs/HASH
+  ./HASH/refs/HASH
+  $ cat */projrc
+  #\ projrc encoding check, line must begin with '#\ '
+  [foo]
+  bar = 1
+  $ cd ..
+  $ hg -R c1 debugprojrc
+  projrc file: $TESTTMP/c1/.hg/projrc
+  projrc store entry: $TESTTMP/store/*/projrc (glob)
+  payload token: * (glob)
+  payload revision: 1
+
+the shared settings are used like the ones of a projrc file of its own
+
+  $ cat > showfoo.py <<EOF
+  > def uisetup(ui):
+  >     ui.write('foo.bar=%s\n' % ui.config('foo', 'bar'))
+  > EOF
+  $ hg -R c1 --config extensions.showfoo=showfoo.py id -q
+  foo.bar=1
+  000000000000
+
+a pull of a projrc change moves the repository to another store entry
+
+  $ printf '[foo]\nbar = 2\n' > server/.hg/projrc
+  $ hg -R c1 pull -q
+  $ hg -R c1 --config extensions.showfoo=showfoo.py id -q
+  foo.bar=2
+  000000000000
+  $ ls store | wc -l
+  \s*2 (re)
+
+gc keeps the entries that repositories refer to, and the recent ones
+
+  $ hg projrc gc -v
+  *: * repositories (glob)
+  *: * repositories (glob)
+  2 projrc store entries, 0 removed
+  $ hg -R c2 pull -q
+  $ hg projrc gc -v --config projrc.storegrace=0
+  *: 2 repositories (glob)
+  *: removed (glob)
+  2 projrc store entries, 1 removed
+  $ rm -r c1
+  $ hg projrc gc --config projrc.storegrace=0
+  1 projrc store entries, 0 removed
+  $ rm -r c2
+  $ hg projrc gc --config projrc.storegrace=0
+  1 projrc store entries, 1 removed
+  $ ls store
+
+a missing store entry is fetched again by the next pull
+
+  $ hg clone -q server c3
+  $ rm -r store
+  $ hg -R c3 pull -q
+  $ cat store/*/projrc
+  #\ projrc encoding check, line must begin with '#\ '
+  [foo]
+  bar = 2
+
+without a store the projrc files are not shared
+
+  $ hg clone -q --config projrc.store=False server c4
+  $ cat c4/.hg/projrc
+  #\ projrc encoding check, line must begin with '#\ '
+  [foo]
+  bar = 2
+  $ hg projrc gc --config projrc.store=False
+  abort: the projrc store is not enabled (see projrc.store)
+  [255]
@@ -53,9 +53,9 @@ change .hg/projrc file and test pull:
   $ echo '# empty' > ../outer/.hg/projrc
   $ hg pull --traceback
   pulling from $TESTTMP/outer
-  projrc settings file updated and applied
   searching for changes
   no changes found
+  projrc settings file updated and applied
   $ hg debugsub
   path inner
    source   http://example.net/libfoo
@@ -190,3 +190,4 @@ test propagation of .hg/projrc file on clone with nested subrepos
   projrc settings file updated and applied
   cloning subrepo outer/inner from $TESTTMP/inner
   2 files updated, 0 files merged, 0 files removed, 0 files unresolved
+  projrc: 1 subrepositories, 1 updated, 0 failed
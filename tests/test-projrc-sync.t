@@ -0,0 +1,84 @@
+  $ echo "[extensions]" >> $HGRCPATH
+  $ echo "projrc = $TESTDIR/../projrc.py" >> $HGRCPATH
+  $ echo "[projrc]" >> $HGRCPATH
+  $ echo "include = *" >> $HGRCPATH
+  $ echo "servers = *" >> $HGRCPATH
+  $ echo "confirm = first" >> $HGRCPATH
+
+make a repository with a projrc file and a few clones of it
+
+  $ hg init a
+  $ echo "[foo]" > a/.hg/projrc
+  $ echo "bar = baz" >> a/.hg/projrc
+  $ mkdir clones
+  $ for n in 1 2 3; do hg clone -q --config projrc.confirm=False a clones/c$n; done
+  $ hg init clones/nodefault
+
+sync all the clones at once, only the changed projrc files are written
+
+  $ echo "qux = quux" >> a/.hg/projrc
+  $ hg projrc sync -j 2 clones
+  clones/c1: updated
+  clones/c2: updated
+  clones/c3: updated
+  clones/nodefault: no default path
+  4 repositories, 3 updated, 1 failed
+  [1]
+  $ cat clones/c2/.hg/projrc
+  #\ projrc encoding check, line must begin with '#\ '
+  [foo]
+  bar = baz
+  qux = quux
+  $ hg projrc sync clones/c1 clones/c3
+  clones/c1: unchanged
+  clones/c3: unchanged
+  2 repositories, 0 updated, 0 failed
+
+changes that need a confirmation are declined, unless --accept is given
+
+  $ echo "[projrc]" >> clones/c1/.hg/hgrc
+  $ echo "confirm = True" >> clones/c1/.hg/hgrc
+  $ echo "more = stuff" >> a/.hg/projrc
+  $ hg projrc sync -v clones/c1 clones/c3
+  clones/c1: declined
+  clones/c3: updated
+    projrc settings file updated
+  2 repositories, 1 updated, 0 failed
+  $ cd clones/c1
+  $ hg projrc sync --accept
+  $TESTTMP/clones/c1: updated
+  1 repositories, 1 updated, 0 failed
+  $ grep more .hg/projrc
+  more = stuff
+  $ cd ../..
+
+errors are reported per repository
+
+  $ hg projrc sync clones/c2 missing
+  clones/c2: updated
+  missing: repository missing not found
+  2 repositories, 1 updated, 1 failed
+  [1]
+
+a clone with a broken hgrc is one more failure, the other ones are still
+synchronized
+
+  $ hg clone -q --config projrc.confirm=False a clones/broken
+  $ echo " broken" >> clones/broken/.hg/hgrc
+  $ echo "again = more" >> a/.hg/projrc
+  $ hg projrc sync clones
+  clones/broken: parse error at ' broken' on $TESTTMP/clones/broken/.hg/hgrc:15
+  clones/c1: declined
+  clones/c2: updated
+  clones/c3: updated
+  clones/nodefault: no default path
+  5 repositories, 2 updated, 2 failed
+  [1]
+  $ hg projrc watch --once clones/broken
+  clones/broken: parse error at ' broken' on $TESTTMP/clones/broken/.hg/hgrc:15
+  [1]
+  $ rm -r clones/broken
+
+  $ hg projrc frob
+  abort: unknown projrc action 'frob'
+  [255]
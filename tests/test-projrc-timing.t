@@ -0,0 +1,46 @@
+  $ echo "[extensions]" >> $HGRCPATH
+  $ echo "projrc = $TESTDIR/../projrc.py" >> $HGRCPATH
+  $ echo "[projrc]" >> $HGRCPATH
+  $ echo "include = *" >> $HGRCPATH
+  $ echo "servers = *" >> $HGRCPATH
+  $ echo "confirm = False" >> $HGRCPATH
+
+  $ hg init a
+  $ echo "[foo]" > a/.hg/projrc
+  $ echo "bar = baz" >> a/.hg/projrc
+  $ hg clone -q a b
+  $ cd b
+
+debugprojrc shows the projrc file, and how long each phase took
+
+  $ hg debugprojrc --timing
+  projrc file: $TESTTMP/b/.hg/projrc
+  payload token: [0-9a-f]{40} (re)
+  payload revision: 1
+  import: +\d+\.\d{3} ms (re)
+  findrepo: +\d+\.\d{3} ms (re)
+  read: +\d+\.\d{3} ms (re)
+  merge: +\d+\.\d{3} ms (re)
+  total: +\d+\.\d{3} ms (re)
+
+the timings of any command can be reported, and logged
+
+  $ echo "qux = quux" >> ../a/.hg/projrc
+  $ hg pull -q --config projrc.timing=True --config extensions.blackbox=
+  projrc: import took \d+\.\d{3} ms (re)
+  projrc: findrepo took \d+\.\d{3} ms (re)
+  projrc: read took \d+\.\d{3} ms (re)
+  projrc: merge took \d+\.\d{3} ms (re)
+  projrc: decode took \d+\.\d{3} ms (re)
+  projrc: filter took \d+\.\d{3} ms (re)
+  projrc: write took \d+\.\d{3} ms (re)
+  projrc: read took \d+\.\d{3} ms (re)
+  projrc: merge took \d+\.\d{3} ms (re)
+  $ grep -c 'projrc [a-z]* took' .hg/blackbox.log
+  9
+  $ HGPROJRCTIMING=1 hg root
+  projrc: import took \d+\.\d{3} ms (re)
+  projrc: findrepo took \d+\.\d{3} ms (re)
+  projrc: read took \d+\.\d{3} ms (re)
+  projrc: merge took \d+\.\d{3} ms (re)
+  $TESTTMP/b
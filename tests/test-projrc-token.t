@@ -0,0 +1,71 @@
+  $ echo "[extensions]" >> $HGRCPATH
+  $ echo "projrc = $TESTDIR/../projrc.py" >> $HGRCPATH
+  $ echo "[projrc]" >> $HGRCPATH
+  $ echo "include = *" >> $HGRCPATH
+  $ echo "servers = *" >> $HGRCPATH
+  $ echo "confirm = False" >> $HGRCPATH
+
+  $ hg init a
+  $ printf '[foo]\nbar = 1\n' > a/.hg/projrc
+  $ hg clone -q a b
+  $ cd b
+  $ hg debugprojrc
+  projrc file: $TESTTMP/b/.hg/projrc
+  payload token: [0-9a-f]{40} (re)
+  payload revision: 1
+
+a payload with the token of the local projrc file is neither decoded nor
+filtered again
+
+  $ printf '[foo]\nbar = 2\n' > ../a/.hg/projrc
+  $ hg pull -q --config projrc.timing=True 2>&1 | grep -v 'findrepo\|read\|merge\|import'
+  projrc: decode took \d+\.\d{3} ms (re)
+  projrc: filter took \d+\.\d{3} ms (re)
+  projrc: write took \d+\.\d{3} ms (re)
+  $ hg pull -q --config projrc.timing=True 2>&1 | grep -v 'findrepo\|read\|merge\|import'
+  [1]
+
+editing the projrc file by hand invalidates its token, so that the next
+pull restores it
+
+  $ echo "baz = 1" >> .hg/projrc
+  $ hg debugprojrc
+  projrc file: $TESTTMP/b/.hg/projrc
+  payload token: none
+  $ hg pull -q
+  $ grep baz .hg/projrc
+  [1]
+  $ hg debugprojrc
+  projrc file: $TESTTMP/b/.hg/projrc
+  payload token: [0-9a-f]{40} (re)
+  payload revision: 2
+
+a server that only sends the data of its projrc, without its hash
+
+  $ cat > ../datakey.py <<EOF
+  > from mercurial import extensions
+  > def listprojrc(orig, repo):
+  >     keys = orig(repo)
+  >     return dict((k, v) for k, v in keys.items() if k == 'data')
+  > def extsetup(ui):
+  >     projrc = extensions.find('projrc')
+  >     extensions.wrapfunction(projrc, 'listprojrc', listprojrc)
+  > EOF
+  $ echo "[extensions]" >> ../a/.hg/hgrc
+  $ echo "datakey = $TESTTMP/datakey.py" >> ../a/.hg/hgrc
+  $ printf '[foo]\nbar = 3\n' > ../a/.hg/projrc
+  $ hg pull -q
+  $ grep bar .hg/projrc
+  bar = 3
+  $ hg debugprojrc
+  projrc file: $TESTTMP/b/.hg/projrc
+  payload token: none
+
+its payload is processed again on every pull, as there is no token to
+compare
+
+  $ hg pull -q --config projrc.timing=True 2>&1 | grep -v 'findrepo\|read\|merge\|import'
+  projrc: decode took \d+\.\d{3} ms (re)
+  projrc: filter took \d+\.\d{3} ms (re)
+  $ grep bar .hg/projrc
+  bar = 3
@@ -0,0 +1,71 @@
+  $ echo "[extensions]" >> $HGRCPATH
+  $ echo "projrc = $TESTDIR/../projrc.py" >> $HGRCPATH
+  $ echo "[projrc]" >> $HGRCPATH
+  $ echo "include = *" >> $HGRCPATH
+  $ echo "servers = *" >> $HGRCPATH
+  $ echo "confirm = False" >> $HGRCPATH
+
+  $ hg init a
+  $ printf '[foo]\nbar = 1\n' > a/.hg/projrc
+  $ hg serve -R a -p $HGPORT -d --pid-file hg.pid -A access.log -E error.log
+  $ cat hg.pid >> "$DAEMON_PIDS"
+  $ hg clone -q http://localhost:$HGPORT/ b
+  $ hg init c
+
+watch only asks for the hash of the remote projrc while it is unchanged
+
+  $ hg projrc watch --once -v b c
+  b: unchanged
+  c: no default path
+  [1]
+  $ grep -c 'cmd=listkeys' access.log
+  1
+  $ grep 'cmd=listkeys' access.log | tail -1 | grep -o 'namespace=[a-z-]*'
+  namespace=projrc-hash
+
+a changed projrc is fetched and staged, but not installed yet
+
+  $ printf '[foo]\nbar = 2\n' > a/.hg/projrc
+  $ hg projrc watch --once b
+  b: staged
+  $ grep bar b/.hg/projrc
+  bar = 1
+  $ hg projrc watch --once -v b
+  b: staged
+  $ grep -c 'cmd=listkeys' access.log
+  4
+
+the next command installs it without contacting the server
+
+  $ hg -R b root
+  projrc settings file updated
+  $TESTTMP/b
+  $ grep bar b/.hg/projrc
+  bar = 2
+  $ ls b/.hg/projrc.staged
+  ls: *: No such file or directory (glob)
+  [2]
+  $ grep -c 'cmd=listkeys' access.log
+  4
+  $ hg projrc watch --once -v b
+  b: unchanged
+
+when changes must be confirmed, the staged projrc is left to the next pull
+
+  $ printf '[foo]\nbar = 3\n' > a/.hg/projrc
+  $ hg projrc watch --once b
+  b: staged
+  $ hg -R b root --config projrc.confirm=True
+  $TESTTMP/b
+  $ grep bar b/.hg/projrc
+  bar = 2
+  $ hg -R b pull -q --config projrc.confirm=True --config ui.interactive=True <<EOF
+  > y
+  > EOF
+  The project settings file (projrc) has changed.
+  Do you want to update it? (y/n)  y
+  $ ls b/.hg/projrc.staged
+  ls: *: No such file or directory (glob)
+  [2]
+
+  $ cat error.log
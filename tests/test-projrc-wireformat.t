@@ -0,0 +1,66 @@
+  $ echo "[extensions]" >> $HGRCPATH
+  $ echo "projrc = $TESTDIR/../projrc.py" >> $HGRCPATH
+  $ echo "[projrc]" >> $HGRCPATH
+  $ echo "include = *" >> $HGRCPATH
+  $ echo "servers = *" >> $HGRCPATH
+  $ echo "confirm = False" >> $HGRCPATH
+
+a projrc full of backslashes
+
+  $ hg init a
+  $ cat > a/.hg/projrc <<'EOF'
+  > [subpaths]
+  > http://example.net/lib(.*) = C:\libs\\1-lib\
+  > [foo]
+  > bar = \\server\share
+  > EOF
+  $ hg serve -R a -p $HGPORT -d --pid-file hg.pid -E error.log
+  $ cat hg.pid >> "$DAEMON_PIDS"
+
+clients that support it get the projrc in the compressed v2 format
+
+  $ hg clone --debug http://localhost:$HGPORT/ b 2>&1 | grep 'projrc:'
+  projrc: received a \d+ bytes (zstd|zlib) payload (re)
+  $ cat b/.hg/projrc
+  #\ projrc encoding check, line must begin with '#\ '
+  [foo]
+  bar = \\server\share
+  
+  [subpaths]
+  http://example.net/lib(.*) = C:\libs\\1-lib\
+
+and so do the changes since their revision
+
+  $ printf '%s\n' 'baz = \\other' >> a/.hg/projrc
+  $ hg -R b pull --debug 2>&1 | grep 'projrc:'
+  projrc: received a \d+ bytes (zstd|zlib) payload (re)
+  projrc: applied the changes since revision 1
+  $ grep baz b/.hg/projrc
+  baz = \\other
+
+clients that cannot use bundle2 still get the listkeys encoding
+
+  $ printf '%s\n' 'qux = \\\\' >> a/.hg/projrc
+  $ hg -R b pull -q --config devel.legacy.exchange=bundle1
+  $ grep qux b/.hg/projrc
+  qux = \\\\
+
+  $ cat error.log
+
+the compression engines are only looked up when the capability is
+advertised, not by every command
+
+  $ cat > zstdcheck.py <<EOF
+  > import atexit
+  > from mercurial import extensions
+  > def uisetup(ui):
+  >     def report():
+  >         looked = bool(extensions.find('projrc')._zstd)
+  >         ui.write('compression engines looked up: %s\n' % looked)
+  >     atexit.register(report)
+  > EOF
+  $ hg -R b id -q --config extensions.zstdcheck=zstdcheck.py
+  000000000000
+  compression engines looked up: False
+  $ hg -R b pull -q --config extensions.zstdcheck=zstdcheck.py
+  compression engines looked up: True
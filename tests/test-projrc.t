@@ -61,14 +61,23 @@ test pull of changes into .hg/projrc file
   $ echo "relink =" >> ../a/.hg/projrc
   $ hg pull
   pulling from $TESTTMP/a
-  projrc settings file updated and applied
   searching for changes
   no changes found
+  projrc settings file updated and applied
   $ hg showconfig extensions
   extensions.children=
   extensions.relink=
   extensions.projrc=*/projrc.py (glob)
 
+the content hash of the accepted payload is kept next to the projrc file,
+pulling the same payload again does not change anything
+
+  $ test -f .hg/projrc.hash
+  $ hg pull
+  pulling from $TESTTMP/a
+  searching for changes
+  no changes found
+
 test pull of deleted .hg/projrc file
 
   $ rm ../a/.hg/projrc
@@ -92,9 +101,9 @@ test pull of .hg/projrc file with special characters over HTTP
   $ cd ../b
   $ hg pull http://localhost:$HGPORT/
   pulling from http://localhost:$HGPORT/
-  projrc settings file updated and applied
   searching for changes
   no changes found
+  projrc settings file updated and applied
   $ cat .hg/projrc
   #\ projrc encoding check, line must begin with '#\ '
   [test]
@@ -106,9 +115,9 @@ test pull of broken .hg/projrc file over HTTP
   $ echo 'this is broken' > ../a/.hg/projrc
   $ hg pull http://localhost:$HGPORT/
   pulling from http://localhost:$HGPORT/
-  not saving retrieved projrc file: parse error at 'this is broken' on projrc:1
   searching for changes
   no changes found
+  not saving retrieved projrc file: parse error at 'this is broken' on projrc:1
 
 kill hg serve
 